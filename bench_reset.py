@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+قياس التصفير الأسبوعي على مخزن وهمي في الذاكرة (بلا Firestore حقيقي):
+  - legacy: المسح الكامل القديم — قراءة وكتابة كل المستخدمين، batches متتالية
+  - season: start_new_season الحالي — رفع season_id في Transaction واحد
+  - rollover: كلفة التصفير الكسول خلال الأسبوع التالي — ensure_current_season
+    لكل لاعب نشط عند أول كسب له (خارج مسار التصفير نفسه)
+
+المخزن الوهمي يضيف زمن استجابة ثابتاً لكل طلب ويعدّ القراءات والكتابات.
+
+    python bench_reset.py                       # 100k مستخدم، 5% نشطون
+    python bench_reset.py --users 200000 --active 0.1 --latency-ms 30
+"""
+import argparse
+import random
+import threading
+import time
+import types
+from datetime import datetime, timezone
+
+import firebase_utils
+
+
+class _Snap:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _Ref:
+    def __init__(self, store, col, doc_id):
+        self.store, self.col, self.id = store, col, str(doc_id)
+
+    def get(self, transaction=None):
+        self.store.rpc(reads=1)
+        return _Snap(self, self.store.docs(self.col).get(self.id))
+
+    def set(self, data, merge=False):
+        self.store.rpc(writes=1)
+        self.store.apply(self.col, self.id, data, merge)
+
+
+class _Query:
+    def __init__(self, store, col, limit=None, after=None):
+        self.store, self.col, self._limit, self._after = store, col, limit, after
+
+    def limit(self, n):
+        return _Query(self.store, self.col, n, self._after)
+
+    def start_after(self, snap):
+        return _Query(self.store, self.col, self._limit, snap)
+
+    def stream(self):
+        store = self.store
+        with store.lock:
+            ids = store.user_ids
+            start = 0
+            if self._after is not None:
+                start = ids.index(self._after.id) + 1
+            rows = [(i, store.users[i]) for i in ids[start:start + (self._limit or len(ids))]]
+        store.rpc(reads=max(1, len(rows)))
+        return [_Snap(_Ref(store, self.col, i), dict(d)) for i, d in rows]
+
+
+class _Collection(_Query):
+    def document(self, doc_id):
+        return _Ref(self.store, self.col, doc_id)
+
+
+class _Batch:
+    def __init__(self, store):
+        self.store, self.ops = store, []
+
+    def update(self, ref, data):
+        self.ops.append((ref, data, True))
+
+    def set(self, ref, data, merge=False):
+        self.ops.append((ref, data, merge))
+
+    def commit(self):
+        self.store.rpc(writes=len(self.ops))
+        for ref, data, merge in self.ops:
+            self.store.apply(ref.col, ref.id, data, merge)
+
+
+class FakeStore:
+    """مجموعتا users و meta فقط."""
+
+    def __init__(self, n_users, active_ratio, latency_ms, seed=7):
+        rnd = random.Random(seed)
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.RLock()
+        self.users = {}
+        self.meta = {"leaderboard": {"season_id": 1}}
+        for i in range(n_users):
+            pts = rnd.randint(1, 500) if rnd.random() < active_ratio else 0
+            self.users[f"{100000000 + i}"] = {"user_id": 100000000 + i, "points": pts,
+                                              "season_id": 1}
+        self.user_ids = sorted(self.users)
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.reads = self.writes = self.rpcs = 0
+
+    def rpc(self, reads=0, writes=0):
+        with self.lock:
+            self.reads += reads
+            self.writes += writes
+            self.rpcs += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def docs(self, col):
+        return self.users if col == "users" else self.meta
+
+    def apply(self, col, doc_id, data, merge):
+        with self.lock:
+            docs = self.docs(col)
+            docs[doc_id] = dict(docs.get(doc_id) or {}, **data) if merge else dict(data)
+
+    def collection(self, name):
+        return _Collection(self, name)
+
+    def batch(self):
+        return _Batch(self)
+
+    def transaction(self):
+        return _Batch(self)
+
+    def active_ids(self):
+        return [i for i, d in self.users.items() if d.get("points")]
+
+
+def _transactional(fn):
+    """Transaction المخزن الوهمي: تنفيذ ثم commit تحت القفل (لا تعارضات لإعادة المحاولة)."""
+    def _run(transaction, *args, **kwargs):
+        with transaction.store.lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return _run
+
+
+def legacy_reset(db):
+    """الخوارزمية القديمة: مسح كل المستخدمين و batches متتالية."""
+    count = 0
+    batch = db.batch()
+    ops = 0
+    last = None
+    while True:
+        query = db.collection("users").limit(450)
+        if last is not None:
+            query = query.start_after(last)
+        docs = query.stream()
+        if not docs:
+            break
+        for d in docs:
+            batch.update(d.reference, {"points": 0})
+            ops += 1
+            count += 1
+            if ops >= 450:
+                batch.commit()
+                batch = db.batch()
+                ops = 0
+        last = docs[-1]
+    if ops:
+        batch.commit()
+    return count
+
+
+def season_reset(store):
+    firebase_utils.start_new_season(datetime.now(timezone.utc))
+    return 0
+
+
+def lazy_rollover(store):
+    """أول كسب لكل لاعب نشط في الموسم الجديد — موزّع على الأسبوع في الواقع."""
+    return sum(1 for uid in store.active_ids() if firebase_utils.ensure_current_season(uid))
+
+
+def _run(label, fn, store):
+    store.reset_counters()
+    t0 = time.perf_counter()
+    n = fn(store)
+    dt = time.perf_counter() - t0
+    print(f"{label:<10} {dt:8.2f}s  users_written={n:>7}  reads={store.reads:>7}  "
+          f"writes={store.writes:>7}  rpcs={store.rpcs:>6}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--users", type=int, default=100_000)
+    ap.add_argument("--active", type=float, default=0.05, help="نسبة من لديهم نقاط")
+    ap.add_argument("--latency-ms", type=float, default=5.0, help="زمن كل طلب وهمي")
+    args = ap.parse_args()
+
+    print(f"users={args.users} active={args.active:.0%} latency={args.latency_ms}ms")
+
+    store = FakeStore(args.users, args.active, args.latency_ms)
+    _run("legacy", legacy_reset, store)
+
+    store = FakeStore(args.users, args.active, args.latency_ms)
+    firebase_utils.db = store
+    # Transaction المخزن الوهمي بدل مُزخرف مكتبة Firestore (يتوقع Transaction حقيقياً)
+    firebase_utils.firestore = types.SimpleNamespace(
+        transactional=_transactional, SERVER_TIMESTAMP=None,
+        Increment=firebase_utils.firestore.Increment,
+    )
+    firebase_utils._meta_load("leaderboard")
+    _run("season", season_reset, store)
+    _run("rollover", lazy_rollover, store)
+    print("rollover: موزّعة على أول كسب لكل لاعب نشط خلال الأسبوع (قراءة + كتابة لكلٍّ)، "
+          "لا في لحظة التصفير")
+
+
+if __name__ == "__main__":
+    main()
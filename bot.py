@@ -3,13 +3,15 @@
 """
 بوت تيليجرام - لعبة XO (إكس-أو)
 الأنماط:
-  - ضد البوت (سهل / صعب Minimax لا يُهزم)
+  - ضد البوت (سهل / صعب: جدول لعب مثالي لا يُهزم)
   - ضد لاعب ثاني عبر رابط تحدٍّ
   - إحصائيات شخصية + لوحة شرف
 """
 
 import secrets
 import random
+import signal
+import sys
 import threading
 import time as time_mod
 import json
@@ -18,18 +20,25 @@ from datetime import datetime, timezone, timedelta
 import telebot
 from telebot import types
 
-from config import BOT_TOKEN, ADMIN_ID
+from config import (
+    BOT_TOKEN, ADMIN_ID, BOT_MODE, BOT_WORKERS,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, PORT,
+)
 from firebase_utils import (
     get_or_create_user, record_result, get_user_stats, get_leaderboard,
-    create_game, create_game_symbol, get_game, update_game, delete_game,
+    get_leaderboard_rank, start_leaderboard_index, leaderboard_stats,
+    LEADERBOARD_RECONCILE_SECONDS,
+    create_game, create_game_symbol, get_game, update_game, update_game_cas, delete_game,
     get_pending_games, backfill_points,
-    reset_all_points, archive_season, get_meta, set_last_reset,
-    queue_add, queue_remove, queue_in, queue_size, queue_try_match,
+    start_new_season,
+    archive_season, get_meta, set_last_reset,
     get_last_season,
     get_flags, set_flag, export_all,
     get_active_game_for_user,
     get_help_sections, set_help_section, delete_help_section,
-    get_bot_config, set_bot_config,
+    get_bot_config, set_bot_config, start_meta_listeners, on_meta_change, META_REFRESH_SECONDS,
+    flush_pending_writes, user_cache_stats,
+    load_active_games, flush_games, games_store_stats,
 )
 from moderation import (
     is_banned, is_muted, ban_user, unban_user,
@@ -39,6 +48,16 @@ from moderation import (
     check_and_increment_daily_matches, record_pair_match, get_pair_count,
     get_pair_points, add_pair_points,
 )
+from xo_board import (
+    EMPTY, PLAYER_X, PLAYER_O, EMPTY_BOARD, from_str as board_from_str, to_str as board_to_str,
+    cell as board_cell, is_free, free_cells, place,
+    winner as board_winner,
+)
+from xo_engine import best_move_hard, engine_stats
+import matchmaking
+import scheduler
+import telegram_io
+from update_dispatcher import OrderedDispatcher
 from security_utils import (
     encrypt_field, decrypt_field,
     totp_enabled, verify_totp, totp_provisioning_uri, generate_totp_secret,
@@ -55,10 +74,10 @@ def _enforce_daily_limit(uid):
     """يفحص الحد اليومي ويُزيده بناءً على الإعدادات الديناميكية."""
     if ADMIN_ID and int(uid) == int(ADMIN_ID):
         return True
-        
-    config = get_bot_config()
+
+    config = get_bot_config()  # من الذاكرة
     current_limit = config.get("daily_limit", DAILY_MATCH_LIMIT)
-    
+
     if not current_limit:
         return True
     try:
@@ -68,7 +87,7 @@ def _enforce_daily_limit(uid):
         return True
     if not allowed:
         try:
-            bot.send_message(
+            telegram_io.send_message(
                 uid,
                 f"⛔ *وصلت الحد اليومي*\n\n"
                 f"الحد المسموح: *{limit}* مباريات/يوم.\n"
@@ -103,7 +122,7 @@ def _has_active_game_block(uid):
     kb.add(types.InlineKeyboardButton("🏳️ استسلام (تنتهي المباراة)",
                                        callback_data=f"resign_{gid}"))
     try:
-        bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
     except Exception:
         pass
     return True
@@ -117,7 +136,51 @@ if not BOT_TOKEN:
     print("❌ يرجى تعيين BOT_TOKEN في متغيرات البيئة")
     raise SystemExit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode=None)
+def update_key(update):
+    """
+    مفتاح الترتيب: المباراة لأزرار PvP (حتى لا تتسابق نقرتا اللاعبين على نفس
+    المباراة)، وإلا المستخدم المرسل.
+    """
+    cq = update.callback_query
+    if cq is not None:
+        data = cq.data or ""
+        if data.startswith("pvp:"):
+            return "game:" + data.split(":")[1]
+        if data.startswith(("resign_", "resume_")):
+            return "game:" + data.split("_", 1)[1]
+        if data.startswith("gchal:"):
+            parts = data.split(":")
+            return "gchal:" + (parts[3] if parts[1] == "pick" and len(parts) > 3 else parts[-1])
+        return f"user:{cq.from_user.id}"
+    for obj in (update.message, update.edited_message,
+                update.inline_query, update.chosen_inline_result):
+        if obj is not None and getattr(obj, "from_user", None) is not None:
+            return f"user:{obj.from_user.id}"
+    return f"update:{update.update_id}"
+
+
+class OrderedTeleBot(telebot.TeleBot):
+    """
+    TeleBot بلا threads داخلية (threaded=False): كل تحديث يمر عبر OrderedDispatcher
+    فيُعالج بالتوازي بين المفاتيح وبالترتيب داخل المفتاح الواحد (polling و webhook).
+    """
+
+    def process_new_updates(self, updates):
+        for update in updates:
+            # الإزاحة تتقدم عند الاستلام لا عند المعالجة: وإلا يعيد get_updates
+            # التالي في polling التحديثات التي ما زالت في الطوابير فتُعالج مرتين
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            _update_dispatcher.submit(update)
+
+    def process_update_now(self, update):
+        super().process_new_updates([update])
+
+
+bot = OrderedTeleBot(BOT_TOKEN, parse_mode=None, threaded=False)
+_update_dispatcher = OrderedDispatcher(bot.process_update_now, update_key, workers=BOT_WORKERS,
+                                       id_fn=lambda u: u.update_id)
+telegram_io.init(bot)
 
 
 # ============================
@@ -280,12 +343,9 @@ def team_points(popularity):
     return TEAM_TIERS[-1][2]
 
 
-EMPTY = "-"
-PLAYER_X = "X"
-PLAYER_O = "O"
-
 CHALLENGE_TIMEOUT_SECONDS = 120
 MOVE_TIMEOUT_SECONDS = 10
+MOVE_CAS_RETRIES = 3              # محاولات compare-and-set للحركة عند التعارض
 QUICK_MATCH_TIMEOUT_SECONDS = 60
 quick_search_sessions = {}
 _qs_lock = threading.Lock()
@@ -298,16 +358,28 @@ FEATURES = {
 }
 
 
+def _apply_flags(stored):
+    for k in list(FEATURES.keys()):
+        if k in stored:
+            FEATURES[k] = bool(stored[k])
+
+
 def load_flags():
     try:
-        stored = get_flags() or {}
-        for k in list(FEATURES.keys()):
-            if k in stored:
-                FEATURES[k] = bool(stored[k])
+        _apply_flags(get_flags() or {})
     except Exception as e:
         print(f"⚠️ load_flags: {e}")
 
 
+def _on_meta_change(name, data):
+    # تعديل meta/flags من نسخة أخرى أو من الكونسول يصل FEATURES دون إعادة تشغيل
+    if name == "flags":
+        _apply_flags(data)
+
+
+on_meta_change(_on_meta_change)
+
+
 # ====== جدولة إعادة ضبط النقاط الأسبوعية ======
 RIYADH_OFFSET = timedelta(hours=3)
 RESET_WEEKDAY = 4  # الجمعة
@@ -340,76 +412,17 @@ def format_time_left(delta):
     return f"{minutes} دقيقة"
 
 
-WIN_LINES = [
-    (0, 1, 2), (3, 4, 5), (6, 7, 8),
-    (0, 3, 6), (1, 4, 7), (2, 5, 8),
-    (0, 4, 8), (2, 4, 6),
-]
-
-
 # ============================
 # === منطق اللعبة ===
 # ============================
+# اللوحة = bitboard (x_bits, o_bits) من xo_board — النص "X-O..." للتخزين فقط
 
 def check_winner(board):
-    for a, b, c in WIN_LINES:
-        if board[a] != EMPTY and board[a] == board[b] == board[c]:
-            return board[a]
-    if EMPTY not in board:
-        return "draw"
-    return None
-
-
-def available_moves(board):
-    return [i for i, v in enumerate(board) if v == EMPTY]
-
-
-def minimax(board, is_maximizing, ai_symbol, human_symbol):
-    result = check_winner(board)
-    if result == ai_symbol:
-        return 1
-    if result == human_symbol:
-        return -1
-    if result == "draw":
-        return 0
-
-    if is_maximizing:
-        best = -2
-        for m in available_moves(board):
-            board[m] = ai_symbol
-            score = minimax(board, False, ai_symbol, human_symbol)
-            board[m] = EMPTY
-            if score > best:
-                best = score
-        return best
-    else:
-        best = 2
-        for m in available_moves(board):
-            board[m] = human_symbol
-            score = minimax(board, True, ai_symbol, human_symbol)
-            board[m] = EMPTY
-            if score < best:
-                best = score
-        return best
-
-
-def best_move_hard(board, ai_symbol, human_symbol):
-    best_score = -2
-    best = None
-    moves = available_moves(board)
-    random.shuffle(moves)
-    for m in moves:
-        board[m] = ai_symbol
-        score = minimax(board, False, ai_symbol, human_symbol)
-        board[m] = EMPTY
-        if score > best_score:
-            best_score = score
-            best = m
-    return best
+    return board_winner(board)
 
 
 def best_move_easy(board):
-    moves = available_moves(board)
+    moves = free_cells(board)
     return random.choice(moves) if moves else None
 
 
@@ -581,7 +594,8 @@ def pvp_menu_kb():
 def board_kb(board, prefix, disabled=False):
     kb = types.InlineKeyboardMarkup(row_width=3)
     row = []
-    for i, cell in enumerate(board):
+    for i in range(9):
+        cell = board_cell(board, i)
         if cell == PLAYER_X:
             label = "❌"
         elif cell == PLAYER_O:
@@ -654,14 +668,6 @@ def fmt_pvp_game(game, viewer_id, is_group=False):
     return header
 
 
-def board_list(board_str):
-    return list(board_str)
-
-
-def board_str(board_list_):
-    return "".join(board_list_)
-
-
 # ============================
 # === أوامر البوت ===
 # ============================
@@ -683,7 +689,7 @@ def cmd_start(message):
         if not require_username(message):
             return
         if not FEATURES["xo_enabled"] and not is_admin(uid):
-            bot.send_message(uid, "🔒 لعبة XO متوقفة مؤقتاً")
+            telegram_io.send_message(uid, "🔒 لعبة XO متوقفة مؤقتاً")
             return
         handle_join_game(uid, name, game_id)
         return
@@ -703,7 +709,7 @@ def cmd_start(message):
     if quest:
         text += f"\n\n🎯 *المهمة اليومية:*\n_{quest}_"
 
-    bot.send_message(uid, text, reply_markup=start_menu_kb(), parse_mode="Markdown")
+    telegram_io.send_message(uid, text, reply_markup=start_menu_kb(), parse_mode="Markdown")
 
 def require_username(message):
     username = (message.from_user.username or "").strip()
@@ -722,7 +728,7 @@ def require_username(message):
         "✅ بعد الإضافة ستتمكن من اللعب والمنافسة على الجوائز."
     )
     try:
-        bot.send_message(uid, text, parse_mode="Markdown")
+        telegram_io.send_message(uid, text, parse_mode="Markdown")
     except Exception:
         pass
     return False
@@ -772,7 +778,7 @@ def require_not_banned_msg(message):
     if _is_spamming(uid):
         try:
             ban_user(uid, reason="نظام الحماية: سبام (إرسال رسائل سريعة)", duration_hours=AUTO_BAN_HOURS, by="Auto-System")
-            bot.send_message(uid, "🚫 *نظام الحماية التلقائي*\n\nتم حظرك مؤقتاً لمدة 15 دقيقة بسبب إرسال رسائل بسرعة غير طبيعية (سبام).\nالرجاء التوقف عن الإزعاج.", parse_mode="Markdown")
+            telegram_io.send_message(uid, "🚫 *نظام الحماية التلقائي*\n\nتم حظرك مؤقتاً لمدة 15 دقيقة بسبب إرسال رسائل بسرعة غير طبيعية (سبام).\nالرجاء التوقف عن الإزعاج.", parse_mode="Markdown")
         except Exception:
             pass
         return False
@@ -788,7 +794,7 @@ def require_not_banned_msg(message):
         else:
             txt += "\n⛔ حظر دائم"
         try:
-            bot.send_message(uid, txt, parse_mode="Markdown")
+            telegram_io.send_message(uid, txt, parse_mode="Markdown")
         except Exception:
             pass
         return False
@@ -803,7 +809,7 @@ def require_not_banned_call(call):
         try:
             ban_user(uid, reason="نظام الحماية: سبام (نقر سريع جداً)", duration_hours=AUTO_BAN_HOURS, by="Auto-System")
             bot.answer_callback_query(call.id, "🚫 تم حظرك 15 دقيقة بسبب الضغط العشوائي والسريع!", show_alert=True)
-            bot.send_message(uid, "🚫 *نظام الحماية التلقائي*\n\nتم حظرك مؤقتاً لمدة 15 دقيقة بسبب استخدام برامج النقر التلقائي أو الضغط السريع (سبام).", parse_mode="Markdown")
+            telegram_io.send_message(uid, "🚫 *نظام الحماية التلقائي*\n\nتم حظرك مؤقتاً لمدة 15 دقيقة بسبب استخدام برامج النقر التلقائي أو الضغط السريع (سبام).", parse_mode="Markdown")
         except Exception:
             pass
         return False
@@ -815,7 +821,7 @@ def require_not_banned_call(call):
         if reason:
             msg += f" — {reason[:60]}"
         try:
-            bot.send_message(uid, msg)
+            telegram_io.send_message(uid, msg)
         except Exception:
             pass
         return False
@@ -836,7 +842,7 @@ def cmd_admin(message):
     uid = message.chat.id
     if not is_admin(uid):
         return
-    bot.send_message(uid, admin_panel_text(),
+    telegram_io.send_message(uid, admin_panel_text(),
                      reply_markup=admin_panel_kb(), parse_mode="Markdown")
 
 
@@ -997,14 +1003,14 @@ def cmd_2fa_setup(message):
             "3️⃣ أعد تشغيل البوت.\n\n"
             "بعدها سيتم طلب رمز 6 أرقام عند تنفيذ /reset أو تصفير النقاط."
         )
-    bot.send_message(uid, text, parse_mode="Markdown")
+    telegram_io.send_message(uid, text, parse_mode="Markdown")
 
 
 def _execute_2fa_action(uid, action):
     if action == "reset":
         try:
             archived, reset_n = _do_full_reset()
-            bot.send_message(
+            telegram_io.send_message(
                 uid,
                 f"✅ *تم التحقق ونُفّذ الإجراء*\n\n"
                 f"• تمت أرشفة: *{archived}* لاعباً\n"
@@ -1012,9 +1018,9 @@ def _execute_2fa_action(uid, action):
                 parse_mode="Markdown",
             )
         except Exception as e:
-            bot.send_message(uid, f"❌ فشل التنفيذ: {e}")
+            telegram_io.send_message(uid, f"❌ فشل التنفيذ: {e}")
     else:
-        bot.send_message(uid, "⚠️ إجراء غير معروف.")
+        telegram_io.send_message(uid, "⚠️ إجراء غير معروف.")
 
 
 def _format_uptime(td):
@@ -1048,10 +1054,14 @@ def _build_status_text():
         print(f"⚠️ status firestore: {e}")
 
     bot_active = len(bot_games)
-    try:
-        qs = queue_size()
-    except Exception:
-        qs = "-"
+    eng = engine_stats()
+    uc = user_cache_stats()
+    gs = games_store_stats()
+    sch = scheduler.stats()
+    tio = telegram_io.stats()
+    upd = _update_dispatcher.stats()
+    qs = matchmaking.size()
+    lb = leaderboard_stats()
 
     mem_str = "-"
     try:
@@ -1073,9 +1083,23 @@ def _build_status_text():
         f"🕒 منذ: `{BOT_START_TIME.strftime('%Y-%m-%d %H:%M UTC')}`\n"
         f"💾 الذاكرة: *{mem_str}*\n\n"
         f"🔥 Firestore: {fs_line}\n"
-        f"👥 المستخدمون: *{users_count}*\n\n"
+        f"👥 المستخدمون: *{users_count}*\n"
+        f"🗂 كاش المستخدمين: *{uc['size']}*/{uc['max']} "
+        f"(hit {uc['hit_rate'] * 100:.0f}% | طرد {uc['evictions']})\n"
+        f"🏆 فهرس لوحة الشرف: *{lb['players']}* لاعب"
+        f"{'' if lb['loaded'] else ' (لم يُبنَ بعد)'} | آخر تصحيح {lb['drift']}\n\n"
         f"🎮 مباريات ضد البوت (نشطة): *{bot_active}*\n"
-        f"📭 طابور Quick Match: *{qs}*\n\n"
+        f"🆚 مباريات PvP بالذاكرة: *{gs['active']}* نشطة / {gs['in_memory']} "
+        f"(بانتظار الحفظ: {gs['dirty']})\n"
+        f"🧠 المحرك: جدول *{eng['table_size']}* | TT *{eng['tt_size']}*/{eng['tt_max']} "
+        f"(hit {eng['tt_hit_rate'] * 100:.0f}%)\n"
+        f"📭 طابور Quick Match: *{qs}*\n"
+        f"⏰ المجدول: *{sch['pending']}* مهمة معلّقة | تأخر "
+        f"{sch['lag_avg_ms']:.0f}ms متوسط / {sch['lag_max_ms']:.0f}ms أقصى\n"
+        f"📤 الصادر: *{tio['sent']}* مُرسل | مدموج {tio['coalesced']} | "
+        f"بلا تغيير {tio['unchanged']} | 429: {tio['rate_limited']} | بالطابور {tio['queued']}\n"
+        f"📥 التحديثات: *{upd['processed']}* عولجت | {upd['workers']} عامل | "
+        f"بالطابور {upd['queued']} | مكرر {upd['duplicates']}\n\n"
         f"🎯 لعبة XO: {xo_line}\n"
         f"🔥 حاسبة المعركة الفردية: {pc_line}\n"
         f"⚔️ حاسبة معركة الفريق: {tc_line}"
@@ -1088,7 +1112,7 @@ def cmd_status(message):
     uid = message.chat.id
     if not is_admin(uid):
         return
-    bot.send_message(uid, _build_status_text(), parse_mode="Markdown")
+    telegram_io.send_message(uid, _build_status_text(), parse_mode="Markdown")
 
 
 def _send_backup(uid):
@@ -1112,7 +1136,7 @@ def _send_backup(uid):
         bot.send_document(uid, f, caption=caption, parse_mode="Markdown",
                           visible_file_name=fname)
     except Exception as e:
-        bot.send_message(uid, f"❌ فشل التصدير: {e}")
+        telegram_io.send_message(uid, f"❌ فشل التصدير: {e}")
 
 
 # ============================
@@ -1179,20 +1203,20 @@ def _send_users_page(uid, mid, page, edit=False):
 
     try:
         if edit:
-            bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown", wait=True)
         else:
-            bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown", wait=True)
     except Exception as e:
         print(f"⚠️ users_page Markdown fail: {e}")
         plain = text.replace("*", "").replace("_", "").replace("`", "")
         try:
             if edit:
-                bot.edit_message_text(plain, uid, mid, reply_markup=kb)
+                telegram_io.edit_message_text(plain, uid, mid, reply_markup=kb, wait=True)
             else:
-                bot.send_message(uid, plain, reply_markup=kb)
+                telegram_io.send_message(uid, plain, reply_markup=kb, wait=True)
         except Exception as e2:
             print(f"⚠️ users_page plain fail: {e2}")
-            bot.send_message(uid, f"❌ خطأ: {e2}")
+            telegram_io.send_message(uid, f"❌ خطأ: {e2}")
 
 
 def _render_banned_list(banned):
@@ -1215,7 +1239,7 @@ def _send_admin_search_results(uid, query, results):
         text = f"🔍 *البحث*: `{query}`\n\nلا توجد نتائج."
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
-        bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
         return
     text = f"🔍 *نتائج البحث*: `{query}` — عددها {len(results)}\n\n"
     text += "\n\n".join(_user_line_short(u, idx=i+1) for i, u in enumerate(results[:20]))
@@ -1227,7 +1251,7 @@ def _send_admin_search_results(uid, query, results):
             callback_data=f"admin_u_{tid}",
         ))
     kb.add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
-    bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+    telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
 
 
 def _send_user_profile(uid, mid, target_id, edit=False):
@@ -1237,9 +1261,9 @@ def _send_user_profile(uid, mid, target_id, edit=False):
         kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_back"))
         txt = f"❌ لا يوجد لاعب بالـID `{target_id}`"
         if edit:
-            bot.edit_message_text(txt, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(txt, uid, mid, reply_markup=kb, parse_mode="Markdown")
         else:
-            bot.send_message(uid, txt, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.send_message(uid, txt, reply_markup=kb, parse_mode="Markdown")
         return
 
     name = u.get("name", "لاعب")
@@ -1309,11 +1333,11 @@ def _send_user_profile(uid, mid, target_id, edit=False):
 
     if edit:
         try:
-            bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown", wait=True)
         except Exception:
-            bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
     else:
-        bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
 
 
 def _handle_admin_action(call, data):
@@ -1388,9 +1412,9 @@ def _send_full_log(uid, mid, target_id):
                                       callback_data=f"admin_u_{target_id}"))
     kb.add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
     try:
-        bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown", wait=True)
     except Exception:
-        bot.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.send_message(uid, text, reply_markup=kb, parse_mode="Markdown")
 
 
 @bot.message_handler(commands=["reset"])
@@ -1404,7 +1428,7 @@ def cmd_reset(message):
         types.InlineKeyboardButton("✅ نعم، صفّر الآن", callback_data="admin_reset_confirm"),
         types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_reset_cancel"),
     )
-    bot.send_message(
+    telegram_io.send_message(
         uid,
         "⚠️ *تحذير*\n\nسيتم أرشفة أفضل 25 لاعباً في الموسم الحالي "
         "ثم *تصفير نقاط جميع المستخدمين*.\n\nهل أنت متأكد؟",
@@ -1412,15 +1436,22 @@ def cmd_reset(message):
     )
 
 
+_reset_running = threading.Lock()
+
+
 def _do_full_reset():
-    now = datetime.now(timezone.utc)
-    top = get_leaderboard(25)
-    target = last_scheduled_reset(now)
-    season_id = target.strftime("%G-W%V") + "-manual-" + now.strftime("%H%M%S")
-    archive_season(season_id, now, top)
-    n = reset_all_points()
-    set_last_reset(now)
-    return len(top), n
+    if not _reset_running.acquire(blocking=False):
+        raise RuntimeError("يوجد تصفير قيد التنفيذ بالفعل")
+    try:
+        now = datetime.now(timezone.utc)
+        top = get_leaderboard(25)
+        target = last_scheduled_reset(now)
+        season_id = target.strftime("%G-W%V") + "-manual-" + now.strftime("%H%M%S")
+        archive_season(season_id, now, top)
+        n = start_new_season(now)  # يكتب last_reset_at أيضاً
+        return len(top), n
+    finally:
+        _reset_running.release()
 
 
 def render_dynamic_help(active_tab="default"):
@@ -1467,23 +1498,23 @@ def handle_join_game(uid, name, game_id):
         return
     game = get_game(game_id)
     if not game:
-        bot.send_message(uid, "❌ التحدّي غير موجود أو انتهت صلاحيته.",
+        telegram_io.send_message(uid, "❌ التحدّي غير موجود أو انتهت صلاحيته.",
                          reply_markup=main_menu_kb())
         return
 
     if game["status"] != "waiting":
-        bot.send_message(uid, "⚠️ هذا التحدّي بدأ بالفعل أو انتهى.",
+        telegram_io.send_message(uid, "⚠️ هذا التحدّي بدأ بالفعل أو انتهى.",
                          reply_markup=main_menu_kb())
         return
 
     if game["player_x_id"] == uid:
-        bot.send_message(uid, "😅 لا يمكنك الانضمام لتحدٍّ أنشأته بنفسك. شارك الرابط مع صديق.",
+        telegram_io.send_message(uid, "😅 لا يمكنك الانضمام لتحدٍّ أنشأته بنفسك. شارك الرابط مع صديق.",
                          reply_markup=main_menu_kb())
         return
 
     creator_id = game.get("player_x_id")
     if creator_id and not _enforce_daily_limit(creator_id):
-        bot.send_message(
+        telegram_io.send_message(
             uid,
             "⚠️ منشئ هذا التحدّي وصل الحد اليومي للمباريات. اطلب منه المحاولة لاحقاً.",
         )
@@ -1491,30 +1522,35 @@ def handle_join_game(uid, name, game_id):
 
     get_or_create_user(uid, name)
 
-    board = board_list(game["board"])
-    sent = bot.send_message(
-        uid,
-        fmt_pvp_game({**game, "player_o_id": uid, "player_o_name": name,
-                      "status": "playing"}, uid),
-        reply_markup=board_kb(board, f"pvp:{game_id}"),
-        parse_mode="Markdown",
-    )
-
-    update_game(game_id, {
+    # الانضمام مشروط بالنسخة المقروءة: لاعبان ينضمان معاً (كلٌّ على مفتاحه) → ينجح واحد
+    if not update_game_cas(game_id, game.get("version", 0), {
         "player_o_id": uid,
         "player_o_name": name,
         "status": "playing",
         "o_chat_id": uid,
-        "o_msg_id": sent.message_id,
-    })
+    }):
+        telegram_io.send_message(uid, "⚠️ هذا التحدّي بدأ بالفعل أو انتهى.",
+                                 reply_markup=main_menu_kb())
+        return
+    scheduler.cancel(f"expire:{game_id}")
+
+    game = get_game(game_id)
+    sent = telegram_io.send_message(
+        uid,
+        fmt_pvp_game(game, uid),
+        reply_markup=board_kb(board_from_str(game["board"]), f"pvp:{game_id}"),
+        parse_mode="Markdown",
+        wait=True,
+    )
+    update_game(game_id, {"o_msg_id": sent.message_id})
 
     game = get_game(game_id)
     try:
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             fmt_pvp_game(game, game["player_x_id"]),
             chat_id=game["x_chat_id"],
             message_id=game["x_msg_id"],
-            reply_markup=board_kb(board_list(game["board"]), f"pvp:{game_id}"),
+            reply_markup=board_kb(board_from_str(game["board"]), f"pvp:{game_id}"),
             parse_mode="Markdown",
         )
     except Exception as e:
@@ -1539,7 +1575,7 @@ def on_callback(call):
             return
         print(f"❌ خطأ: {e}")
         try:
-            bot.send_message(call.from_user.id, "❌ حدث خطأ، حاول مرة أخرى")
+            telegram_io.send_message(call.from_user.id, "❌ حدث خطأ، حاول مرة أخرى")
         except Exception:
             pass
 
@@ -1551,7 +1587,7 @@ def _dispatch(call):
         # أمر إخفاء الدليل
         if data == "hide_guide":
             try:
-                bot.edit_message_text("❌ *تم إخفاء الشرح .*", inline_message_id=call.inline_message_id, parse_mode="Markdown")
+                telegram_io.edit_message_text("❌ *تم إخفاء الشرح .*", inline_message_id=call.inline_message_id, parse_mode="Markdown")
                 bot.answer_callback_query(call.id, "تم الإخفاء ✅")
             except Exception:
                 pass
@@ -1620,7 +1656,7 @@ def _dispatch(call):
                 types.InlineKeyboardButton("✅ نعم، صفّر الآن", callback_data="admin_reset_confirm"),
                 types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_reset_cancel"),
             )
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "⚠️ *تحذير*\n\nسيتم أرشفة أفضل 25 لاعباً "
                 "ثم *تصفير نقاط جميع المستخدمين*.\n\nهل أنت متأكد؟",
                 uid, mid, reply_markup=kb, parse_mode="Markdown",
@@ -1628,13 +1664,13 @@ def _dispatch(call):
             return
 
         if data == "admin_reset_cancel":
-            bot.edit_message_text("❎ تم الإلغاء.", uid, mid)
+            telegram_io.edit_message_text("❎ تم الإلغاء.", uid, mid)
             return
 
         if data == "admin_reset_confirm":
             if totp_enabled():
                 request_2fa(uid, "reset")
-                bot.edit_message_text(
+                telegram_io.edit_message_text(
                     "🔐 *مطلوب التحقق الثنائي*\n\n"
                     "أرسل الآن *رمز 6 أرقام* من تطبيق Authenticator "
                     "للموافقة على *تصفير كل النقاط*.\n\n"
@@ -1644,14 +1680,14 @@ def _dispatch(call):
                 return
             try:
                 archived, reset_n = _do_full_reset()
-                bot.edit_message_text(
+                telegram_io.edit_message_text(
                     f"✅ *تمت إعادة التعيين بنجاح*\n\n"
                     f"• تمت أرشفة: *{archived}* لاعباً\n"
                     f"• تم تصفير نقاط: *{reset_n}* مستخدماً",
                     uid, mid, parse_mode="Markdown",
                 )
             except Exception as e:
-                bot.edit_message_text(f"❌ فشل التنفيذ: {e}", uid, mid)
+                telegram_io.edit_message_text(f"❌ فشل التنفيذ: {e}", uid, mid)
             return
 
         if data == "admin_toggle_xo":
@@ -1660,7 +1696,7 @@ def _dispatch(call):
                 set_flag("xo_enabled", FEATURES["xo_enabled"])
             except Exception as e:
                 print(f"⚠️ set_flag xo: {e}")
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 admin_panel_text(), uid, mid,
                 reply_markup=admin_panel_kb(), parse_mode="Markdown",
             )
@@ -1672,7 +1708,7 @@ def _dispatch(call):
                 set_flag("popcalc_enabled", FEATURES["popcalc_enabled"])
             except Exception as e:
                 print(f"⚠️ set_flag popcalc: {e}")
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 admin_panel_text(), uid, mid,
                 reply_markup=admin_panel_kb(), parse_mode="Markdown",
             )
@@ -1684,7 +1720,7 @@ def _dispatch(call):
                 set_flag("teamcalc_enabled", FEATURES["teamcalc_enabled"])
             except Exception as e:
                 print(f"⚠️ set_flag teamcalc: {e}")
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 admin_panel_text(), uid, mid,
                 reply_markup=admin_panel_kb(), parse_mode="Markdown",
             )
@@ -1703,12 +1739,12 @@ def _dispatch(call):
             text = render_admin_leaderboard(board)
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_back"))
-            bot.edit_message_text(text, uid, mid,
+            telegram_io.edit_message_text(text, uid, mid,
                                   reply_markup=kb, parse_mode="Markdown")
             return
 
         if data == "admin_back":
-            bot.edit_message_text(admin_panel_text(), uid, mid,
+            telegram_io.edit_message_text(admin_panel_text(), uid, mid,
                                   reply_markup=admin_panel_kb(), parse_mode="Markdown")
             return
 
@@ -1724,7 +1760,7 @@ def _dispatch(call):
             kb.add(types.InlineKeyboardButton("🔄 تحديث", callback_data="admin_status"))
             kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_back"))
             try:
-                bot.edit_message_text(_build_status_text(), uid, mid,
+                telegram_io.edit_message_text(_build_status_text(), uid, mid,
                                       reply_markup=kb, parse_mode="Markdown")
             except Exception:
                 pass
@@ -1746,7 +1782,7 @@ def _dispatch(call):
             admin_search_waiting[uid] = True
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_back"))
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "🔍 *بحث عن لاعب*\n\n"
                 "أرسل الآن أحد الخيارات:\n"
                 "• ID رقمي (مثل `123456789`)\n"
@@ -1766,7 +1802,7 @@ def _dispatch(call):
                     callback_data=f"admin_u_{u.get('user_id') or u.get('id')}",
                 ))
             kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_back"))
-            bot.edit_message_text(text, uid, mid,
+            telegram_io.edit_message_text(text, uid, mid,
                                   reply_markup=kb, parse_mode="Markdown")
             return
 
@@ -1788,14 +1824,14 @@ def _dispatch(call):
                 kb.add(types.InlineKeyboardButton(f"✏️ {sec.get('title')}", callback_data=f"admin_help_edit_{tid}"))
             kb.add(types.InlineKeyboardButton("➕ إضافة قسم جديد", callback_data="admin_help_new"))
             kb.add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
-            bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
             return
 
         if data == "admin_help_new":
             admin_help_state[uid] = {"action": "wait_title", "msg_id": mid}
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_help_list"))
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "➕ *إضافة قسم جديد*\n\nأرسل الآن **عنوان الزر** (مثال: القوانين 📜):",
                 uid, mid, reply_markup=kb, parse_mode="Markdown",
             )
@@ -1809,7 +1845,7 @@ def _dispatch(call):
             kb.add(types.InlineKeyboardButton("📝 تعديل المحتوى", callback_data=f"admin_help_settext_{tid}"))
             kb.add(types.InlineKeyboardButton("❌ حذف القسم", callback_data=f"admin_help_del_{tid}"))
             kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_help_list"))
-            bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
             return
 
         if data.startswith("admin_help_settext_"):
@@ -1817,7 +1853,7 @@ def _dispatch(call):
             admin_help_state[uid] = {"action": "wait_content", "tab_id": tid, "msg_id": mid}
             kb = types.InlineKeyboardMarkup()
             kb.add(types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_help_list"))
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "📝 *تعديل المحتوى*\n\nأرسل الآن **النص الجديد** لهذا القسم:",
                 uid, mid, reply_markup=kb, parse_mode="Markdown",
             )
@@ -1839,26 +1875,26 @@ def _dispatch(call):
             kb.add(types.InlineKeyboardButton("➕ إضافة قسم جديد", callback_data="admin_help_new"))
             kb.add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
             try:
-                bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+                telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
             except Exception:
                 pass
             return
 
         # --- أوامر لوحة النقاط الجديدة ---
         if data == "admin_points_menu":
-            bot.edit_message_text(admin_points_menu_text(), uid, mid, reply_markup=admin_points_menu_kb(), parse_mode="Markdown")
+            telegram_io.edit_message_text(admin_points_menu_text(), uid, mid, reply_markup=admin_points_menu_kb(), parse_mode="Markdown")
             return
             
         if data == "admin_toggle_x2":
             config = get_bot_config()
             current = config.get("x2_event_enabled", False)
             set_bot_config("x2_event_enabled", not current)
-            bot.edit_message_text(admin_points_menu_text(), uid, mid, reply_markup=admin_points_menu_kb(), parse_mode="Markdown")
+            telegram_io.edit_message_text(admin_points_menu_text(), uid, mid, reply_markup=admin_points_menu_kb(), parse_mode="Markdown")
             return
 
         # --- معالجة أوامر لوحة المهام الفرعية ---
         if data == "admin_quest_menu":
-            bot.edit_message_text(admin_quest_menu_text(), uid, mid, reply_markup=admin_quest_menu_kb(), parse_mode="Markdown")
+            telegram_io.edit_message_text(admin_quest_menu_text(), uid, mid, reply_markup=admin_quest_menu_kb(), parse_mode="Markdown")
             return
             
         if data == "admin_quest_del":
@@ -1867,13 +1903,13 @@ def _dispatch(call):
                 bot.answer_callback_query(call.id, "✅ تم حذف المهمة بنجاح!")
             except Exception:
                 pass
-            bot.edit_message_text(admin_quest_menu_text(), uid, mid, reply_markup=admin_quest_menu_kb(), parse_mode="Markdown")
+            telegram_io.edit_message_text(admin_quest_menu_text(), uid, mid, reply_markup=admin_quest_menu_kb(), parse_mode="Markdown")
             return
             
         if data == "admin_quest_add":
             admin_help_state[uid] = {"action": "wait_config", "key": "daily_quest", "msg_id": mid}
             kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_quest_menu"))
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "📝 أرسل الآن نص **المهمة اليومية** الجديد:", 
                 uid, mid, reply_markup=kb, parse_mode="Markdown"
             )
@@ -1894,7 +1930,7 @@ def _dispatch(call):
             admin_help_state[uid] = {"action": "wait_config", "key": key, "msg_id": mid}
             kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ إلغاء", callback_data="admin_back"))
             try:
-                bot.edit_message_text(msg, uid, mid, reply_markup=kb, parse_mode="Markdown")
+                telegram_io.edit_message_text(msg, uid, mid, reply_markup=kb, parse_mode="Markdown")
             except Exception:
                 pass
             return
@@ -1913,11 +1949,11 @@ def _dispatch(call):
                 bot.answer_callback_query(call.id, "🔒 لعبة XO متوقفة مؤقتاً")
             except Exception:
                 pass
-            bot.edit_message_text("🏠 القائمة الرئيسية:\n(لعبة XO متوقفة حالياً)", uid, mid, reply_markup=start_menu_kb())
+            telegram_io.edit_message_text("🏠 القائمة الرئيسية:\n(لعبة XO متوقفة حالياً)", uid, mid, reply_markup=start_menu_kb())
             return
 
         bot_games.pop(uid, None)
-        bot.edit_message_text("🎮 *لعبة XO*\n\nاختر:", uid, mid,
+        telegram_io.edit_message_text("🎮 *لعبة XO*\n\nاختر:", uid, mid,
                               reply_markup=main_menu_kb(), parse_mode="Markdown")
         return
 
@@ -1932,23 +1968,23 @@ def _dispatch(call):
             f"👤 اليوزر: `@{username}`\n\n"
             "اختر من القائمة:"
         )
-        bot.edit_message_text(text, uid, mid,
+        telegram_io.edit_message_text(text, uid, mid,
                               reply_markup=start_menu_kb(), parse_mode="Markdown")
         return
 
     if data == "open_xo":
         if not FEATURES["xo_enabled"] and not is_admin(uid):
             try:
-                bot.send_message(uid, "🔒 لعبة XO متوقفة مؤقتاً")
+                telegram_io.send_message(uid, "🔒 لعبة XO متوقفة مؤقتاً")
             except Exception:
                 pass
             return
-        bot.edit_message_text("🎮 *لعبة XO*\n\nاختر:", uid, mid,
+        telegram_io.edit_message_text("🎮 *لعبة XO*\n\nاختر:", uid, mid,
                               reply_markup=main_menu_kb(), parse_mode="Markdown")
         return
 
     if data == "open_calcs":
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "🧮 *معركة الشعبية*\n\nاختر الحاسبة:",
             uid, mid, reply_markup=calcs_menu_kb(), parse_mode="Markdown",
         )
@@ -1957,12 +1993,12 @@ def _dispatch(call):
     if data == "open_popcalc":
         if not FEATURES["popcalc_enabled"] and not is_admin(uid):
             try:
-                bot.send_message(uid, "🔒 حاسبة المعركة الفردية متوقفة مؤقتاً")
+                telegram_io.send_message(uid, "🔒 حاسبة المعركة الفردية متوقفة مؤقتاً")
             except Exception:
                 pass
             return
         popcalc_sessions.pop(uid, None)
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             popcalc_intro_text(), uid, mid,
             reply_markup=popcalc_menu_kb(), parse_mode="Markdown",
         )
@@ -1970,7 +2006,7 @@ def _dispatch(call):
 
     if data == "popcalc_new":
         popcalc_sessions[uid] = {"stage": "your_pop", "msg_id": mid, "mode": "pop"}
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "🔥 *حاسبة المعركة الفردية*\n\n"
             "1️⃣ أرسل شعبيتك الآن كرقم (مثال: `50000`)",
             uid, mid,
@@ -1979,7 +2015,7 @@ def _dispatch(call):
         return
 
     if data == "popcalc_tiers":
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             popcalc_tiers_text(), uid, mid,
             reply_markup=popcalc_back_kb(), parse_mode="Markdown",
         )
@@ -1987,7 +2023,7 @@ def _dispatch(call):
 
     if data == "popcalc_cancel":
         popcalc_sessions.pop(uid, None)
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             popcalc_intro_text(), uid, mid,
             reply_markup=popcalc_menu_kb(), parse_mode="Markdown",
         )
@@ -1996,12 +2032,12 @@ def _dispatch(call):
     if data == "open_teamcalc":
         if not FEATURES["teamcalc_enabled"] and not is_admin(uid):
             try:
-                bot.send_message(uid, "🔒 حاسبة معركة الفريق متوقفة مؤقتاً")
+                telegram_io.send_message(uid, "🔒 حاسبة معركة الفريق متوقفة مؤقتاً")
             except Exception:
                 pass
             return
         popcalc_sessions.pop(uid, None)
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             teamcalc_intro_text(), uid, mid,
             reply_markup=teamcalc_menu_kb(), parse_mode="Markdown",
         )
@@ -2009,7 +2045,7 @@ def _dispatch(call):
 
     if data == "teamcalc_new":
         popcalc_sessions[uid] = {"stage": "your_pop", "msg_id": mid, "mode": "team"}
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "⚔️ *حاسبة معركة الفريق*\n\n"
             "1️⃣ أرسل شعبيتك الآن كرقم (مثال: `50000`)",
             uid, mid,
@@ -2020,7 +2056,7 @@ def _dispatch(call):
     if data == "teamcalc_tiers":
         kb = types.InlineKeyboardMarkup(row_width=1)
         kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="open_teamcalc"))
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             teamcalc_tiers_text(), uid, mid,
             reply_markup=kb, parse_mode="Markdown",
         )
@@ -2028,18 +2064,18 @@ def _dispatch(call):
 
     if data == "teamcalc_cancel":
         popcalc_sessions.pop(uid, None)
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             teamcalc_intro_text(), uid, mid,
             reply_markup=teamcalc_menu_kb(), parse_mode="Markdown",
         )
         return
 
     if data == "menu_bot":
-        bot.edit_message_text("🤖 اختر مستوى الصعوبة:", uid, mid, reply_markup=difficulty_kb())
+        telegram_io.edit_message_text("🤖 اختر مستوى الصعوبة:", uid, mid, reply_markup=difficulty_kb())
         return
 
     if data == "menu_pvp":
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "👥 *لعب ضد صديق*\n\n"
             "أنشئ تحدّياً وشارك الرابط مع صديقك.",
             uid, mid, reply_markup=pvp_menu_kb(), parse_mode="Markdown",
@@ -2059,17 +2095,18 @@ def _dispatch(call):
         g = get_game(gid)
         if not g or g.get("status") != "playing":
             try:
-                bot.send_message(uid, "⚠️ المباراة لم تعد متاحة.")
+                telegram_io.send_message(uid, "⚠️ المباراة لم تعد متاحة.")
             except Exception:
                 pass
             return
         try:
-            board = board_list(g["board"])
-            sent = bot.send_message(
+            board = board_from_str(g["board"])
+            sent = telegram_io.send_message(
                 uid,
                 fmt_pvp_game(g, uid),
                 reply_markup=board_kb(board, f"pvp:{gid}"),
                 parse_mode="Markdown",
+                wait=True,
             )
             if uid == g.get("player_x_id"):
                 update_game(gid, {"x_chat_id": uid, "x_msg_id": sent.message_id})
@@ -2084,7 +2121,7 @@ def _dispatch(call):
         g = get_game(gid)
         if not g or g.get("status") != "playing":
             try:
-                bot.send_message(uid, "⚠️ المباراة لم تعد متاحة.")
+                telegram_io.send_message(uid, "⚠️ المباراة لم تعد متاحة.")
             except Exception:
                 pass
             return
@@ -2094,16 +2131,16 @@ def _dispatch(call):
             winner = PLAYER_X
         else:
             try:
-                bot.send_message(uid, "⚠️ لست لاعباً في هذه المباراة.")
+                telegram_io.send_message(uid, "⚠️ لست لاعباً في هذه المباراة.")
             except Exception:
                 pass
             return
         try:
             finalize_pvp(gid, winner, resigned=True)
-            bot.send_message(uid, "🏳️ تم الاستسلام. يمكنك الآن بدء مباراة جديدة.")
+            telegram_io.send_message(uid, "🏳️ تم الاستسلام. يمكنك الآن بدء مباراة جديدة.")
         except Exception as e:
             print(f"⚠️ resign: {e}")
-            bot.send_message(uid, "❌ تعذّر الاستسلام، حاول لاحقاً.")
+            telegram_io.send_message(uid, "❌ تعذّر الاستسلام، حاول لاحقاً.")
         return
 
     if data == "menu_stats":
@@ -2111,7 +2148,7 @@ def _dispatch(call):
         text = render_stats(user)
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-        bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
         return
 
     if data == "menu_leaderboard":
@@ -2132,21 +2169,16 @@ def _dispatch(call):
                     break
             
             if not found:
-                try:
-                    from firebase_utils import db
-                    # حساب عدد الأشخاص اللي نقاطهم أعلى من المستخدم لنجيب تصنيفه بدقة
-                    count_query = db.collection("users").where("points", ">", viewer_pts).count().get()
-                    higher_users = count_query[0][0].value
-                    viewer_rank = str(higher_users + 1)
-                except Exception as e:
-                    print(f"⚠️ error getting rank: {e}")
-                    viewer_rank = "خارج التوب 5"
+                # الترتيب من فهرس الذاكرة فقط: count() على points في Firestore يعدّ
+                # نقاط المواسم السابقة غير المُصفَّرة، فقبل بناء الفهرس لا رقم
+                rank = get_leaderboard_rank(viewer_pts)
+                viewer_rank = str(rank) if rank is not None else "خارج التوب 5"
                     
         text = render_leaderboard(board, uid, viewer_pts, viewer_rank)
         kb = types.InlineKeyboardMarkup(row_width=1)
         kb.add(types.InlineKeyboardButton("🏅 الأسبوع السابق", callback_data="menu_last_season"))
         kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-        bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
         return
 
     if data == "menu_last_season":
@@ -2155,29 +2187,29 @@ def _dispatch(call):
         kb = types.InlineKeyboardMarkup(row_width=1)
         kb.add(types.InlineKeyboardButton("🏆 لوحة الحالية", callback_data="menu_leaderboard"))
         kb.add(types.InlineKeyboardButton("🔙 رجوع", callback_data="back_main"))
-        bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
         return
 
     if data == "menu_help":
         text, kb = render_dynamic_help("default")
-        bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+        telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
         return
 
     if data.startswith("help_"):
         section = data[len("help_"):]
         text, kb = render_dynamic_help(section)
         try:
-            bot.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
+            telegram_io.edit_message_text(text, uid, mid, reply_markup=kb, parse_mode="Markdown")
         except Exception:
             pass
         return
 
     if data in ("bot_start_easy", "bot_start_hard"):
         diff = "easy" if data == "bot_start_easy" else "hard"
-        board = [EMPTY] * 9
+        board = EMPTY_BOARD
         bot_games[uid] = {"board": board, "difficulty": diff, "msg_id": mid}
         game_view = {"board": board, "difficulty": diff, "turn": PLAYER_X}
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             fmt_bot_game(game_view), uid, mid,
             reply_markup=board_kb(board, "bot"),
             parse_mode="Markdown",
@@ -2211,7 +2243,7 @@ def handle_bot_move(call, data):
 
     if not game:
         bot.answer_callback_query(call.id, "لا توجد لعبة نشطة، ابدأ من جديد")
-        bot.edit_message_text("القائمة الرئيسية:", uid, mid, reply_markup=main_menu_kb())
+        telegram_io.edit_message_text("القائمة الرئيسية:", uid, mid, reply_markup=main_menu_kb())
         return
 
     if action == "noop":
@@ -2221,7 +2253,7 @@ def handle_bot_move(call, data):
     if action == "resign":
         bot_games.pop(uid, None)
         record_result(uid, f"bot_{game['difficulty']}", "loss")
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "🏳️ انسحبت من اللعبة. احتُسبت خسارة.",
             uid, mid, reply_markup=main_menu_kb(),
         )
@@ -2238,11 +2270,12 @@ def handle_bot_move(call, data):
         return
 
     board = game["board"]
-    if board[pos] != EMPTY:
+    if not 0 <= pos < 9 or not is_free(board, pos):
         bot.answer_callback_query(call.id, "الخانة مأخوذة")
         return
 
-    board[pos] = PLAYER_X
+    board = place(board, pos, PLAYER_X)
+    game["board"] = board
     result = check_winner(board)
     if result:
         finish_bot_game(uid, mid, game, board, result)
@@ -2254,7 +2287,8 @@ def handle_bot_move(call, data):
         bot_pos = best_move_hard(board, PLAYER_O, PLAYER_X)
 
     if bot_pos is not None:
-        board[bot_pos] = PLAYER_O
+        board = place(board, bot_pos, PLAYER_O)
+        game["board"] = board
 
     result = check_winner(board)
     if result:
@@ -2262,7 +2296,7 @@ def handle_bot_move(call, data):
         return
 
     game_view = {"board": board, "difficulty": game["difficulty"], "turn": PLAYER_X}
-    bot.edit_message_text(
+    telegram_io.edit_message_text(
         fmt_bot_game(game_view), uid, mid,
         reply_markup=board_kb(board, "bot"),
         parse_mode="Markdown",
@@ -2313,7 +2347,7 @@ def finish_bot_game(uid, mid, game, board, result):
         ),
         types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"),
     )
-    bot.edit_message_text(
+    telegram_io.edit_message_text(
         final_text, uid, mid,
         reply_markup=kb, parse_mode="Markdown",
     )
@@ -2340,65 +2374,83 @@ def handle_quick_match(call):
     uid = call.message.chat.id
     mid = call.message.message_id
     name = call.from_user.first_name or "لاعب"
-    get_or_create_user(uid, name)
+    user = get_or_create_user(uid, name)
 
     if _has_active_game_block(uid):
         return
     if not _enforce_daily_limit(uid):
         return
 
-    try:
-        opponent = queue_try_match(uid, name, uid)
-    except Exception as e:
-        print(f"⚠️ queue_try_match: {e}")
-        bot.answer_callback_query(call.id, "تعذّر الاتصال، حاول مجدداً")
-        return
+    # الجلسة والمهلة ورسالة البحث قبل دخول الحوض: تمريرة المطابقة قد تزاوج
+    # اللاعب فور دخوله، وعندها يجب أن تجد جلسته فتحوّل رسالة البحث نفسها للوح
+    with _qs_lock:
+        prev = quick_search_sessions.get(uid)
+        joined_at = prev["joined_at"] if prev else datetime.now(timezone.utc)
+        session = {"chat_id": uid, "msg_id": mid, "joined_at": joined_at, "name": name}
+        quick_search_sessions[uid] = session
+    arm_quick_search_timeout(uid, joined_at)
 
-    if opponent is None:
-        try:
-            qsz = queue_size()
-        except Exception:
-            qsz = 1
-            
-        try:
-            bot.edit_message_text(
-                _qm_search_text(qsz), uid, mid,
-                reply_markup=_qm_cancel_kb(), parse_mode="Markdown",
-            )
-        except Exception:
-            pass
+    try:
+        telegram_io.edit_message_text(
+            _qm_search_text(matchmaking.size() + (0 if prev else 1)), uid, mid,
+            reply_markup=_qm_cancel_kb(), parse_mode="Markdown",
+        )
+    except Exception:
+        pass
 
+    # الانضمام لحوض المطابقة فقط — تمريرة المطابقة الدورية تختار الخصم
+    try:
+        entry = matchmaking.join(uid, name, uid, mid, user.get("points", 0), joined_at=joined_at)
+    except Exception:
         with _qs_lock:
-            quick_search_sessions[uid] = {
-                "chat_id": uid, "msg_id": mid,
-                "joined_at": datetime.now(timezone.utc),
-                "name": name,
-            }
-            
-        try:
-            bot.answer_callback_query(call.id, "🔍 يبحث عن خصم...")
-        except Exception:
-            pass
-        return
+            if quick_search_sessions.get(uid) is session:
+                quick_search_sessions.pop(uid, None)
+        scheduler.cancel(f"qs:{uid}")
+        raise
+    if entry["joined_at"] != joined_at:
+        # كان في الحوض قبل الجلسة (استعادة بعد التشغيل): مدة الانتظار من الحوض
+        with _qs_lock:
+            current = quick_search_sessions.get(uid) is session
+            if current:
+                session["joined_at"] = entry["joined_at"]
+        if current:
+            arm_quick_search_timeout(uid, entry["joined_at"])
 
-    _start_quick_match(
-        x_player={"id": opponent["user_id"], "name": opponent["name"], "chat_id": opponent["chat_id"]},
-        o_player={"id": uid, "name": name, "chat_id": uid, "msg_id": mid},
-    )
-    
     try:
-        bot.answer_callback_query(call.id, "✅ وُجد خصم!")
+        bot.answer_callback_query(call.id, "🔍 يبحث عن خصم...")
     except Exception:
         pass
 
 
+def _on_matchmaking_pair(x, o):
+    _start_quick_match(
+        x_player={"id": x["id"], "name": x["name"], "chat_id": x["chat_id"]},
+        o_player={"id": o["id"], "name": o["name"], "chat_id": o["chat_id"], "msg_id": o["msg_id"]},
+    )
+
+
+def restore_quick_search_sessions():
+    """يعيد جلسات البحث ومهلاتها من حوض المطابقة المستعاد عند التشغيل."""
+    entries = matchmaking.restore()
+    for e in entries:
+        with _qs_lock:
+            quick_search_sessions[e["id"]] = {
+                "chat_id": e["chat_id"], "msg_id": e["msg_id"],
+                "joined_at": e["joined_at"],
+                "name": e["name"],
+            }
+        arm_quick_search_timeout(e["id"], e["joined_at"])
+    return len(entries)
+
+
 def handle_quick_match_cancel(call):
     uid = call.message.chat.id
     mid = call.message.message_id
-    queue_remove(uid)
+    matchmaking.leave(uid)
     with _qs_lock:
         quick_search_sessions.pop(uid, None)
-    bot.edit_message_text(
+    scheduler.cancel(f"qs:{uid}")
+    telegram_io.edit_message_text(
         "✅ تم إلغاء البحث.", uid, mid, reply_markup=main_menu_kb(),
     )
     try:
@@ -2412,7 +2464,7 @@ def _start_quick_match(x_player, o_player):
     create_game(game_id, x_player["id"], x_player["name"], x_player["chat_id"])
     deadline = datetime.now(timezone.utc) + timedelta(seconds=MOVE_TIMEOUT_SECONDS)
 
-    board = [EMPTY] * 9
+    board = EMPTY_BOARD
 
     with _qs_lock:
         x_sess = quick_search_sessions.get(x_player["id"])
@@ -2420,11 +2472,12 @@ def _start_quick_match(x_player, o_player):
     if x_sess:
         x_msg_id = x_sess["msg_id"]
         try:
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 f"🎮 *وُجد خصم!*\n❌ أنت  ⚔️  ⭕ {o_player['name']}\n\nاللوحة تُحمّل...",
                 x_player["chat_id"], x_msg_id,
                 reply_markup=board_kb(board, f"pvp:{game_id}"),
                 parse_mode="Markdown",
+                wait=True,
             )
         except Exception as e:
             print(f"⚠️ quick_match edit X: {e}")
@@ -2432,11 +2485,12 @@ def _start_quick_match(x_player, o_player):
 
     if not x_msg_id:
         try:
-            sent_x = bot.send_message(
+            sent_x = telegram_io.send_message(
                 x_player["chat_id"],
                 f"🎮 *وُجد خصم!*\n❌ أنت  ⚔️  ⭕ {o_player['name']}\n\nاللوحة تُحمّل...",
                 reply_markup=board_kb(board, f"pvp:{game_id}"),
                 parse_mode="Markdown",
+                wait=True,
             )
             x_msg_id = sent_x.message_id
         except Exception as e:
@@ -2453,60 +2507,51 @@ def _start_quick_match(x_player, o_player):
         "o_chat_id": int(o_player["chat_id"]),
         "o_msg_id": int(o_player["msg_id"]),
     })
+    arm_move_timeout(game_id, deadline)
 
     with _qs_lock:
         quick_search_sessions.pop(o_player["id"], None)
         quick_search_sessions.pop(x_player["id"], None)
+    scheduler.cancel(f"qs:{o_player['id']}")
+    scheduler.cancel(f"qs:{x_player['id']}")
 
     refresh_pvp_messages(game_id)
 
 
-def quick_match_checker():
+def arm_quick_search_timeout(uid, joined_at):
+    scheduler.schedule_at(
+        f"qs:{uid}",
+        (joined_at + timedelta(seconds=QUICK_MATCH_TIMEOUT_SECONDS)).timestamp(),
+        _on_quick_search_timeout, uid, joined_at,
+    )
+
+
+def _on_quick_search_timeout(uid, joined_at):
     """
-    التوثيق: فاحص الطابور (العد الصامت). يتحقق من الوقت المنقضي في الذاكرة فقط،
+    انتهاء مهلة البحث لجلسة واحدة — يُنفَّذ بالضبط عند الموعد من المجدول،
     ولا يرسل أي تعديلات لتيليجرام إلا عند حدوث (حدث الانتهاء).
     """
-    while True:
-        try:
-            now = datetime.now(timezone.utc)
-            with _qs_lock:
-                sessions = list(quick_search_sessions.items())
-                
-            for uid, s in sessions:
-                with _qs_lock:
-                    if uid not in quick_search_sessions:
-                        continue
-
-                elapsed = int((now - s["joined_at"]).total_seconds())
-
-                if elapsed >= QUICK_MATCH_TIMEOUT_SECONDS:
-                    try:
-                        queue_remove(uid)
-                    except Exception:
-                        pass
-                    
-                    with _qs_lock:
-                        quick_search_sessions.pop(uid, None)
-                        
-                    try:
-                        kb = types.InlineKeyboardMarkup(row_width=1)
-                        kb.add(types.InlineKeyboardButton("🤖 العب ضد البوت", callback_data="menu_bot"))
-                        kb.add(types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"))
-                        
-                        bot.edit_message_text(
-                            "😔 *لم نجد لك خصماً الآن.*\n\nانتهى وقت البحث المخصص.",
-                            s["chat_id"], s["msg_id"],
-                            reply_markup=kb, parse_mode="Markdown",
-                        )
-                    except Exception as e:
-                        if "message is not modified" not in str(e):
-                            print(f"⚠️ فشل تحديث رسالة انتهاء البحث: {e}")
-                    continue
-                    
-        except Exception as e:
-            print(f"⚠️ خطأ في فاحص اللعب العشوائي: {e}")
-            
-        time_mod.sleep(3)
+    with _qs_lock:
+        s = quick_search_sessions.get(uid)
+        if not s or s["joined_at"] != joined_at:
+            return  # وُجد خصم أو أُلغي البحث أو بدأ بحث جديد
+    if not matchmaking.leave(uid):
+        return  # زُوِّج في تمريرة المطابقة للتو
+    with _qs_lock:
+        quick_search_sessions.pop(uid, None)
+
+    kb = types.InlineKeyboardMarkup(row_width=1)
+    kb.add(types.InlineKeyboardButton("🤖 العب ضد البوت", callback_data="menu_bot"))
+    kb.add(types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"))
+
+    # على thread المجدول: لا انتظار لتيليجرام، والفشل يُسجَّل بالـ label
+    telegram_io.edit_message_text(
+        "😔 *لم نجد لك خصماً الآن.*\n\nانتهى وقت البحث المخصص.",
+        s["chat_id"], s["msg_id"],
+        reply_markup=kb, parse_mode="Markdown",
+        wait=False, label="quick search timeout",
+    )
+
 
 # ============================
 # === PvP ===
@@ -2538,7 +2583,7 @@ def handle_pvp_create(call):
         switch_inline_query="XO",
     ))
     kb.add(types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"))
-    bot.edit_message_text(
+    telegram_io.edit_message_text(
         text, uid, mid, reply_markup=kb,
         parse_mode="Markdown", disable_web_page_preview=True,
     )
@@ -2578,7 +2623,7 @@ def handle_pvp_action(call, data):
             pass
         if not is_inline:
             try:
-                bot.edit_message_text(
+                telegram_io.edit_message_text(
                     "🏁 انتهت المباراة.",
                     call.message.chat.id, call.message.message_id,
                     reply_markup=main_menu_kb(),
@@ -2604,7 +2649,10 @@ def handle_pvp_action(call, data):
         if status not in ("waiting", "posted"):
             bot.answer_callback_query(call.id, "المباراة بدأت بالفعل")
             return
-        expire_game(game_id, "❌ *ألغى المنشئ التحدّي.*")
+        if not expire_game(game_id, "❌ *ألغى المنشئ التحدّي.*",
+                           expected_version=game.get("version", 0)):
+            bot.answer_callback_query(call.id, "المباراة بدأت بالفعل")
+            return
         try:
             bot.answer_callback_query(call.id, "تم الإلغاء")
         except Exception:
@@ -2653,7 +2701,15 @@ def handle_pvp_action(call, data):
             updates["player_x_id"] = user_id
             updates["player_x_name"] = user_name
 
-        update_game(game_id, updates)
+        if not update_game_cas(game_id, game.get("version", 0), updates):
+            # تغيّرت المباراة منذ قراءتها (انضم لاعب آخر أو أُلغيت)
+            try:
+                bot.answer_callback_query(call.id, "⏳ سبقك لاعب آخر أو تغيّرت المباراة")
+            except Exception:
+                pass
+            return
+        scheduler.cancel(f"expire:{game_id}")
+        arm_move_timeout(game_id, deadline)
         try:
             msg = (
                 "✅ انضممت كـ ⭕ ! ينتظر دور ❌ أولاً"
@@ -2668,44 +2724,56 @@ def handle_pvp_action(call, data):
         return
 
     if action == "move":
-        if status != "playing":
-            bot.answer_callback_query(call.id, "المباراة غير نشطة")
-            return
-        if user_id not in (game.get("player_x_id"), game.get("player_o_id")):
-            bot.answer_callback_query(call.id, "لست طرفاً في هذه المباراة")
-            return
-
         try:
             pos = int(parts[3])
         except (IndexError, ValueError):
             bot.answer_callback_query(call.id)
             return
 
-        turn = game.get("turn", PLAYER_X)
-        expected_uid = game.get("player_x_id") if turn == PLAYER_X else game.get("player_o_id")
-        if user_id != expected_uid:
-            bot.answer_callback_query(call.id, "ليس دورك ⏳")
-            return
+        # compare-and-set على version: التحقق والتطبيق على نفس اللقطة، وإعادة المحاولة عند التعارض
+        for _ in range(MOVE_CAS_RETRIES):
+            if game.get("status") != "playing":
+                bot.answer_callback_query(call.id, "المباراة غير نشطة")
+                return
+            if user_id not in (game.get("player_x_id"), game.get("player_o_id")):
+                bot.answer_callback_query(call.id, "لست طرفاً في هذه المباراة")
+                return
 
-        board = board_list(game["board"])
-        if board[pos] != EMPTY:
-            bot.answer_callback_query(call.id, "الخانة مأخوذة")
-            return
+            turn = game.get("turn", PLAYER_X)
+            expected_uid = game.get("player_x_id") if turn == PLAYER_X else game.get("player_o_id")
+            if user_id != expected_uid:
+                bot.answer_callback_query(call.id, "ليس دورك ⏳")
+                return
 
-        board[pos] = turn
-        result = check_winner(board)
-        next_turn = PLAYER_O if turn == PLAYER_X else PLAYER_X
+            board = board_from_str(game["board"])
+            if not 0 <= pos < 9 or not is_free(board, pos):
+                bot.answer_callback_query(call.id, "الخانة مأخوذة")
+                return
 
-        new_deadline = datetime.now(timezone.utc) + timedelta(seconds=MOVE_TIMEOUT_SECONDS)
-        update_game(game_id, {
-            "board": board_str(board),
-            "turn": next_turn,
-            "turn_deadline": new_deadline,
-        })
+            board = place(board, pos, turn)
+            result = check_winner(board)
+            next_turn = PLAYER_O if turn == PLAYER_X else PLAYER_X
+
+            new_deadline = datetime.now(timezone.utc) + timedelta(seconds=MOVE_TIMEOUT_SECONDS)
+            version = game.get("version", 0)
+            if update_game_cas(game_id, version, {
+                "board": board_to_str(board),
+                "turn": next_turn,
+                "turn_deadline": new_deadline,
+            }):
+                break
+            game = get_game(game_id)
+            if not game:
+                bot.answer_callback_query(call.id, "المباراة انتهت أو حُذفت")
+                return
+        else:
+            bot.answer_callback_query(call.id, "⏳ حاول مرة أخرى")
+            return
 
         if result:
             finalize_pvp(game_id, result)
         else:
+            arm_move_timeout(game_id, new_deadline)
             refresh_pvp_messages(game_id)
 
         try:
@@ -2715,15 +2783,30 @@ def handle_pvp_action(call, data):
         return
 
 
-def refresh_pvp_messages(game_id):
+def _edit_quietly(label, text, wait=False, **kwargs):
+    """
+    تعديل عبر موزّع telegram_io مع طباعة الأخطاء تحت label بدل رفعها.
+    يعيد Future دون انتظار الإرسال، ومع wait=True ينتظر النتيجة.
+    """
+    if not wait:
+        return telegram_io.edit_message_text(text, wait=False, label=label, **kwargs)
+    try:
+        return telegram_io.edit_message_text(text, wait=True, **kwargs)
+    except Exception as e:
+        print(f"⚠️ {label}: {e}")
+
+
+def refresh_pvp_messages(game_id, wait=False):
+    """يحدّث رسائل المباراة (inline / X / O) بالتوازي عبر telegram_io."""
     game = get_game(game_id)
     if not game:
         return
 
+    futures = []
     if game.get("inline_message_id"):
-        render_inline_board(game_id)
+        futures.append(render_inline_board(game_id, wait=False))
 
-    board = board_list(game["board"])
+    board = board_from_str(game["board"])
     kb = board_kb(board, f"pvp:{game_id}")
 
     for player_key, chat_key, msg_key in [
@@ -2740,23 +2823,37 @@ def refresh_pvp_messages(game_id):
 
         is_group = str(chat_id).startswith("-")
 
-        try:
-            bot.edit_message_text(
-                fmt_pvp_game(game, viewer, is_group),
-                chat_id=chat_id, message_id=msg_id,
-                reply_markup=kb, parse_mode="Markdown",
-            )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                print(f"⚠️ فشل تحديث رسالة {player_key}: {e}")
+        futures.append(_edit_quietly(
+            f"فشل تحديث رسالة {player_key}",
+            fmt_pvp_game(game, viewer, is_group),
+            chat_id=chat_id, message_id=msg_id,
+            reply_markup=kb, parse_mode="Markdown",
+            wait=False,
+        ))
 
+    if wait:
+        telegram_io.wait_all(futures)
 
-def finalize_pvp(game_id, winner, resigned=False):
-    game = get_game(game_id)
-    if not game:
-        return
 
-    update_game(game_id, {"status": "finished", "winner": winner})
+def finalize_pvp(game_id, winner, resigned=False, wait=False, expected_version=None, extra=None):
+    """
+    ينهي المباراة مرة واحدة فقط عبر compare-and-set على version.
+    expected_version: ينهي فقط إن لم تتغير المباراة منذ تحقق المستدعي (مثل المهلة)،
+    وإلا يعيد المحاولة على أحدث نسخة ما دامت المباراة لم تنتهِ.
+    """
+    fields = {"status": "finished", "winner": winner, **(extra or {})}
+    game = get_game(game_id)
+    while True:
+        if not game or game.get("status") == "finished":
+            return  # أنهاها طرف آخر (حركة / مهلة / انسحاب)
+        version = game.get("version", 0) if expected_version is None else expected_version
+        if update_game_cas(game_id, version, fields):
+            break
+        if expected_version is not None:
+            return  # تغيّرت المباراة بعد تحقق المستدعي
+        game = get_game(game_id)
+
+    disarm_move_timeout(game_id)
     game = get_game(game_id)
 
     px = game.get("player_x_id")
@@ -2775,7 +2872,7 @@ def finalize_pvp(game_id, winner, resigned=False):
             if pair_pts_today == PAIR_DAILY_POINTS_CAP:
                 try:
                     if ADMIN_ID:
-                        bot.send_message(
+                        telegram_io.send_message(
                             int(ADMIN_ID),
                             "⚠️ *بلغ الزوج الحد الأقصى للنقاط اليومية*\n\n"
                             f"🆔 `{px}` × `{po}`\n"
@@ -2827,10 +2924,11 @@ def finalize_pvp(game_id, winner, resigned=False):
             if granted > 0:
                 add_pair_points(px, po, granted)
 
+    futures = []
     if game.get("inline_message_id"):
-        render_inline_board(game_id)
+        futures.append(render_inline_board(game_id, wait=False))
 
-    board = board_list(game["board"])
+    board = board_from_str(game["board"])
     final_board_kb = board_kb(board, f"pvp:{game_id}", disabled=True)
 
     for player_key, chat_key, msg_key in [
@@ -2867,15 +2965,16 @@ def finalize_pvp(game_id, winner, resigned=False):
                                 (winner == PLAYER_O and viewer == po)
                 suffix = "\n🎉 فزت!" if winner_is_you else "\n😔 خسرت."
 
-        try:
-            bot.edit_message_text(
-                fmt_pvp_game(game, viewer, is_group) + suffix,
-                chat_id=chat_id, message_id=msg_id,
-                reply_markup=final_board_kb, parse_mode="Markdown",
-            )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                print(f"⚠️ فشل تحديث رسالة النهاية {player_key}: {e}")
+        futures.append(_edit_quietly(
+            f"فشل تحديث رسالة النهاية {player_key}",
+            fmt_pvp_game(game, viewer, is_group) + suffix,
+            chat_id=chat_id, message_id=msg_id,
+            reply_markup=final_board_kb, parse_mode="Markdown",
+            wait=False,
+        ))
+
+    if wait:
+        telegram_io.wait_all(futures)
 
 def get_user_rank(points):
     """
@@ -2946,13 +3045,21 @@ def _mention(u):
         return f"[{name}](tg://user?id={int(uid)})"
     return name
 
-def render_leaderboard(users, viewer_id, viewer_pts=0, viewer_rank="غير مصنف"):
-    try:
-        time_left = format_time_left(
-            next_scheduled_reset(datetime.now(timezone.utc)) - datetime.now(timezone.utc)
-        )
-    except Exception:
-        time_left = "—"
+# جسم لوحة الشرف لا يعتمد على المشاهد: يُرسم مرة ويُعاد استخدامه حتى يتغيّر
+# أعلى N (الأسماء/النقاط) أو نص العدّ التنازلي (يتغيّر بالدقيقة على الأكثر).
+# لكل مشاهد يُضاف فقط علامة "👈 أنت" وسطر التذييل.
+_lb_render_cache = {"key": None, "head": None, "rows": None}
+_lb_render_lock = threading.Lock()
+
+
+def _leaderboard_body(users, time_left):
+    """(سطور الرأس، [(معرّفات الصف، السطر)]) — من الكاش إن لم يتغيّر شيء."""
+    key = (time_left, tuple(
+        (u.get("id"), u.get("user_id"), u.get("name"), u.get("points", 0)) for u in users
+    ))
+    with _lb_render_lock:
+        if _lb_render_cache["key"] == key:
+            return _lb_render_cache["head"], _lb_render_cache["rows"]
 
     all_zero = bool(users) and all((u.get("points", 0) or 0) == 0 for u in users)
 
@@ -2981,34 +3088,57 @@ def render_leaderboard(users, viewer_id, viewer_pts=0, viewer_rank="غير مص
                 pts = u.get("points", 0)
                 name_cut = _md_escape(u.get('name','لاعب'))[:15]
                 head.append(f"{medals[i]} *{name_cut}* • ⭐️ {pts} (🎁 {prizes[i]})")
-        
-        head.append("\n━━━━━━━━━━━━━━")
-        head.append(f"👤 *أنت:* غير مصنف (0 نقطة)")
-        return "\n".join(head)
+        rows = None  # لوحة فارغة: لا صفوف ولا ترتيب للمشاهد
+    else:
+        head = [
+            "🏆 *لوحة الشرف (أفضل 5)*",
+            f"⏳ يُعاد التصفير خلال: *{time_left}*",
+            "",
+            "🎁 *الجوائز:*",
+            "┃ 🥇 الأول: 120 UC",
+            "┃ 🥈 الثاني: 60 UC",
+            "┃ 🥉 الثالث: 60 UC",
+            "",
+        ]
+        rows = []
+        medals = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣"]
+        for i, u in enumerate(users):
+            prefix = medals[i] if i < len(medals) else f"{i+1}."
+            pts = u.get("points", 0)
+
+            rank = get_user_rank(pts)
+            name_cut = _md_escape(u.get('name','لاعب'))[:15]
+
+            # التنسيق الجديد: الاسم ثم الرتبة ثم النقاط، مفصولة بنقاط قوية تمنع التداخل
+            ids = {str(u.get("user_id")), str(u.get("id"))}
+            rows.append((ids, f"{prefix} *{name_cut}* ⟨ {rank} ⟩ ⁞ ⭐️ {pts}"))
+
+    with _lb_render_lock:
+        _lb_render_cache.update(key=key, head=head, rows=rows)
+    return head, rows
+
+
+def render_leaderboard(users, viewer_id, viewer_pts=0, viewer_rank="غير مصنف"):
+    try:
+        time_left = format_time_left(
+            next_scheduled_reset(datetime.now(timezone.utc)) - datetime.now(timezone.utc)
+        )
+    except Exception:
+        time_left = "—"
+
+    head, rows = _leaderboard_body(users, time_left)
+
+    if rows is None:
+        lines = list(head)
+        lines.append("\n━━━━━━━━━━━━━━")
+        lines.append(f"👤 *أنت:* غير مصنف (0 نقطة)")
+        return "\n".join(lines)
+
+    viewer = str(viewer_id)
+    lines = list(head)
+    for ids, line in rows:
+        lines.append(f"{line} 👈 أنت" if viewer in ids else line)
 
-    lines = [
-        "🏆 *لوحة الشرف (أفضل 5)*",
-        f"⏳ يُعاد التصفير خلال: *{time_left}*",
-        "",
-        "🎁 *الجوائز:*",
-        "┃ 🥇 الأول: 120 UC",
-        "┃ 🥈 الثاني: 60 UC",
-        "┃ 🥉 الثالث: 60 UC",
-        "",
-    ]
-    
-    medals = ["🥇", "🥈", "🥉", "4️⃣", "5️⃣"]
-    for i, u in enumerate(users):
-        prefix = medals[i] if i < len(medals) else f"{i+1}."
-        me = " 👈 أنت" if str(u.get("user_id")) == str(viewer_id) or str(u.get("id")) == str(viewer_id) else ""
-        pts = u.get("points", 0)
-        
-        rank = get_user_rank(pts) 
-        name_cut = _md_escape(u.get('name','لاعب'))[:15]
-        
-        # التنسيق الجديد: الاسم ثم الرتبة ثم النقاط، مفصولة بنقاط قوية تمنع التداخل
-        lines.append(f"{prefix} *{name_cut}* ⟨ {rank} ⟩ ⁞ ⭐️ {pts}{me}")
-    
     lines.append("")
     lines.append("━━━━━━━━━━━━━━")
     if viewer_rank == "غير مصنف" or viewer_pts == 0:
@@ -3180,7 +3310,7 @@ def on_inline_query(inline_query):
                 f"🎮 *لعبة XO*\n❌ {name}  ⚔️  ⭕ بانتظار لاعب...\n\n"
                 "⭕ اضغط أي مربع للانضمام كـ ⭕!"
             )
-            kb = board_kb([EMPTY] * 9, f"pvp:{q}")
+            kb = board_kb(EMPTY_BOARD, f"pvp:{q}")
             results.append(types.InlineQueryResultArticle(
                 id=q,
                 title="🎮 إرسال تحدّي XO (أنشأته مسبقاً)",
@@ -3205,12 +3335,14 @@ def on_inline_query(inline_query):
         gid_o = secrets.token_urlsafe(8)
         create_game_symbol(gid_x, uid, name, "X")
         create_game_symbol(gid_o, uid, name, "O")
+        arm_challenge_expiry(gid_x)
+        arm_challenge_expiry(gid_o)
 
         text_x = f"🎮 *لعبة XO*\n❌ {name}  ⚔️  ⭕ بانتظار لاعب...\n\n⭕ اضغط أي مربع للانضمام كـ ⭕!"
-        kb_x = board_kb([EMPTY] * 9, f"pvp:{gid_x}")
+        kb_x = board_kb(EMPTY_BOARD, f"pvp:{gid_x}")
 
         text_o = f"🎮 *لعبة XO*\n❌ بانتظار لاعب...  ⚔️  ⭕ {name}\n\n❌ اضغط أي مربع للانضمام كـ ❌ (وتبدأ أولاً)!"
-        kb_o = board_kb([EMPTY] * 9, f"pvp:{gid_o}")
+        kb_o = board_kb(EMPTY_BOARD, f"pvp:{gid_o}")
 
         results.append(types.InlineQueryResultArticle(
             id=gid_x,
@@ -3270,14 +3402,26 @@ def on_chosen_inline(chosen):
     if not im_id or game_id in ("invalid", "help"):
         return
 
-    game = get_game(game_id)
-    if not game or game.get("status") not in ("waiting", "posted"):
+    # status → posted مشروط بالنسخة: انضمام يسبق الكتابة لا يُعاد إلى posted
+    posted = False
+    for _ in range(MOVE_CAS_RETRIES):
+        game = get_game(game_id)
+        if not game:
+            return
+        if game.get("status") not in ("waiting", "posted"):
+            break
+        if update_game_cas(game_id, game.get("version", 0), {
+            "inline_message_id": im_id,
+            "status": "posted",
+        }):
+            posted = True
+            break
+    if not posted:
+        # بدأت المباراة (أو تعارض متكرر): نحفظ معرّف الرسالة فقط ليُرسم اللوح فيها
+        if game.get("status") in ("waiting", "posted", "playing"):
+            update_game(game_id, {"inline_message_id": im_id})
+            render_inline_board(game_id)
         return
-
-    update_game(game_id, {
-        "inline_message_id": im_id,
-        "status": "posted",
-    })
     render_inline_board(game_id)
 
     try:
@@ -3288,7 +3432,7 @@ def on_chosen_inline(chosen):
             ),
             types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"),
         )
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             "✅ تم إرسال التحدّي إلى المحادثة!\n\n"
             "🎯 افتح تلك المحادثة والعب من هناك.\n"
             f"⏳ إذا لم يبدأ الخصم خلال {CHALLENGE_TIMEOUT_SECONDS // 60} "
@@ -3298,8 +3442,7 @@ def on_chosen_inline(chosen):
             reply_markup=kb,
         )
     except Exception as e:
-        if "message is not modified" not in str(e):
-            print(f"⚠️ update creator DM: {e}")
+        print(f"⚠️ update creator DM: {e}")
 
 
 def _notify_creator_opponent_joined(game_id):
@@ -3324,16 +3467,15 @@ def _notify_creator_opponent_joined(game_id):
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("🏠 القائمة", callback_data="back_main"))
     try:
-        bot.edit_message_text(
+        telegram_io.edit_message_text(
             text, chat_id=chat_id, message_id=msg_id,
             reply_markup=kb, parse_mode="Markdown",
         )
     except Exception as e:
-        if "message is not modified" not in str(e):
-            print(f"⚠️ notify creator: {e}")
+        print(f"⚠️ notify creator: {e}")
 
 
-def render_inline_board(game_id):
+def render_inline_board(game_id, wait=False):
     game = get_game(game_id)
     if not game:
         return
@@ -3379,182 +3521,210 @@ def render_inline_board(game_id):
         if game.get("end_reason") == "timeout":
             header += "\n⌛ (خسر الخصم بانتهاء مهلة الحركة)"
 
-    board = board_list(game.get("board", EMPTY * 9))
+    board = board_from_str(game.get("board"))
     disabled = (status == "finished")
     kb = board_kb(board, f"pvp:{game_id}", disabled=disabled)
 
-    try:
-        bot.edit_message_text(
-            header,
-            inline_message_id=im_id,
-            reply_markup=kb,
-            parse_mode="Markdown",
-        )
-    except Exception as e:
-        if "message is not modified" not in str(e):
-            print(f"⚠️ render_inline_board: {e}")
+    return _edit_quietly(
+        "render_inline_board", header,
+        inline_message_id=im_id,
+        reply_markup=kb,
+        parse_mode="Markdown",
+        wait=wait,
+    )
 
 
 # ============================
 # === انتهاء صلاحية التحدّيات ===
 # ============================
 
-def expire_game(game_id, reason):
+def expire_game(game_id, reason, wait=False, expected_version=None):
+    """
+    ينهي تحدّياً لم يبدأ: انتقال waiting/posted → expired بـ compare-and-set على version،
+    فإن سبقه انضمام خصم يفشل ولا يُحذف شيء. يعيد True إن انتهى التحدّي.
+    """
     game = get_game(game_id)
-    if not game:
-        return
+    if not game or game.get("status") not in ("waiting", "posted"):
+        return False
+    version = game.get("version", 0) if expected_version is None else expected_version
+    if not update_game_cas(game_id, version, {"status": "expired"}):
+        return False
+    disarm_move_timeout(game_id)
+    scheduler.cancel(f"expire:{game_id}")
 
+    futures = []
     if game.get("inline_message_id"):
-        try:
-            bot.edit_message_text(
-                f"🎮 *تحدّي XO*\n\n{reason}",
-                inline_message_id=game["inline_message_id"],
-                parse_mode="Markdown",
-                reply_markup=None  
-            )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                print(f"⚠️ expire inline: {e}")
-
-    if game.get("x_chat_id") and game.get("x_msg_id"):
-        chat_id = game["x_chat_id"]
-        msg_id = game["x_msg_id"]
-        is_group = str(chat_id).startswith("-")  
-        
-        try:
-            if is_group:
-                bot.edit_message_text(
-                    f"{reason}",
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    parse_mode="Markdown",
-                    reply_markup=None  
-                )
-            else:
-                bot.edit_message_text(
-                    f"{reason}\n\nأرسل /menu للبدء من جديد.",
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    reply_markup=main_menu_kb(),
-                    parse_mode="Markdown",
-                )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                print(f"⚠️ expire DM/Group X: {e}")
+        futures.append(_edit_quietly(
+            "expire inline",
+            f"🎮 *تحدّي XO*\n\n{reason}",
+            inline_message_id=game["inline_message_id"],
+            parse_mode="Markdown",
+            reply_markup=None,
+            wait=False,
+        ))
 
-    if game.get("o_chat_id") and game.get("o_msg_id"):
-        chat_id = game["o_chat_id"]
-        msg_id = game["o_msg_id"]
-        is_group = str(chat_id).startswith("-")
-        
-        try:
-            if is_group:
-                bot.edit_message_text(
-                    f"{reason}",
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    parse_mode="Markdown",
-                    reply_markup=None
-                )
-            else:
-                bot.edit_message_text(
-                    f"{reason}\n\nأرسل /menu للبدء من جديد.",
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    reply_markup=main_menu_kb(),
-                    parse_mode="Markdown",
-                )
-        except Exception as e:
-            if "message is not modified" not in str(e):
-                print(f"⚠️ expire DM/Group O: {e}")
+    for chat_key, msg_key, label in (
+        ("x_chat_id", "x_msg_id", "expire DM/Group X"),
+        ("o_chat_id", "o_msg_id", "expire DM/Group O"),
+    ):
+        chat_id = game.get(chat_key)
+        msg_id = game.get(msg_key)
+        if not (chat_id and msg_id):
+            continue
+        if str(chat_id).startswith("-"):
+            futures.append(_edit_quietly(
+                label, f"{reason}",
+                chat_id=chat_id, message_id=msg_id,
+                parse_mode="Markdown", reply_markup=None,
+                wait=False,
+            ))
+        else:
+            futures.append(_edit_quietly(
+                label, f"{reason}\n\nأرسل /menu للبدء من جديد.",
+                chat_id=chat_id, message_id=msg_id,
+                reply_markup=main_menu_kb(), parse_mode="Markdown",
+                wait=False,
+            ))
 
+    if wait:
+        telegram_io.wait_all(futures)
     delete_game(game_id)
+    return True
 
 
-def move_timeout_checker():
-    while True:
-        try:
-            pending = get_pending_games()
-            now = datetime.now(timezone.utc)
-            for g in pending:
-                if g.get("status") != "playing":
-                    continue
-                dl = g.get("turn_deadline")
-                if not dl:
-                    continue
-                try:
-                    if getattr(dl, "tzinfo", None) is None:
-                        dl = dl.replace(tzinfo=timezone.utc)
-                    if (now - dl).total_seconds() <= 0:
-                        continue
-                except Exception:
-                    continue
-                turn = g.get("turn", PLAYER_X)
-                winner = PLAYER_O if turn == PLAYER_X else PLAYER_X
-                loser_name = (g.get("player_x_name") if turn == PLAYER_X
-                              else g.get("player_o_name")) or "اللاعب"
-                print(f"[move_timeout] game_id={g.get('id')} loser={turn} winner={winner}")
-                try:
-                    update_game(g["id"], {"end_reason": "timeout"})
-                    finalize_pvp(g["id"], winner, resigned=False)
-                except Exception as e:
-                    print(f"⚠️ move_timeout finalize: {e}")
-        except Exception as e:
-            print(f"⚠️ move_timeout_checker: {e}")
-        time_mod.sleep(2)
+def _as_utc(dt):
+    if getattr(dt, "tzinfo", None) is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt
 
 
-def expiration_checker():
-    while True:
-        try:
-            pending = get_pending_games()
-            now = datetime.now(timezone.utc)
-            for g in pending:
-                status = g.get("status")
-                if status not in ("waiting", "posted"):
-                    continue
-                created = g.get("created_at")
-                if not created:
-                    continue
-                try:
-                    age = now - created
-                except TypeError:
-                    age = now.replace(tzinfo=None) - created
-                if age.total_seconds() > CHALLENGE_TIMEOUT_SECONDS:
-                    print(f"[expire] game_id={g.get('id')} age={age.total_seconds():.0f}s")
-                    expire_game(
-                        g["id"],
-                        "⌛ *انتهت صلاحية التحدّي*\n\n"
-                        "لم ينضم أي لاعب خلال دقيقتين.",
-                    )
-        except Exception as e:
-            print(f"⚠️ expiration_checker: {e}")
-        time_mod.sleep(15)
+def arm_move_timeout(game_id, deadline):
+    """يجدول فحص المهلة عند turn_deadline بالضبط — إعادة التسليح تستبدل الموعد السابق."""
+    if not deadline:
+        return
+    try:
+        when = _as_utc(deadline).timestamp()
+    except Exception:
+        return
+    scheduler.schedule_at(f"move:{game_id}", when, _on_move_timeout, game_id)
 
 
-def weekly_reset_checker():
-    while True:
-        try:
-            now = datetime.now(timezone.utc)
-            target = last_scheduled_reset(now)
-            meta = get_meta()
-            last = meta.get("last_reset_at")
-            if last is not None and getattr(last, "tzinfo", None) is None:
-                last = last.replace(tzinfo=timezone.utc)
-            if last is None or last < target:
+def disarm_move_timeout(game_id):
+    scheduler.cancel(f"move:{game_id}")
+
+
+def _on_move_timeout(game_id):
+    g = get_game(game_id)
+    if not g or g.get("status") != "playing":
+        return
+    dl = g.get("turn_deadline")
+    if not dl:
+        return
+    try:
+        dl = _as_utc(dl)
+        if (datetime.now(timezone.utc) - dl).total_seconds() <= 0:
+            # تحرّك الموعد بعد التسليح — أعِد الجدولة على الموعد الحالي
+            arm_move_timeout(game_id, dl)
+            return
+    except Exception:
+        return
+    turn = g.get("turn", PLAYER_X)
+    winner = PLAYER_O if turn == PLAYER_X else PLAYER_X
+    print(f"[move_timeout] game_id={game_id} loser={turn} winner={winner}")
+    # finalize_pvp يكتب في Firestore — خارج thread المجدول حتى لا يؤخّر باقي المؤقّتات
+    _timeout_dispatcher.submit((game_id, winner, g.get("version", 0)))
+
+
+def _finalize_timed_out(item):
+    game_id, winner, version = item
+    try:
+        # إن تحرّك اللاعب بعد قراءة g تتغير version فيُلغى الإنهاء
+        finalize_pvp(game_id, winner, resigned=False, wait=False,
+                     expected_version=version, extra={"end_reason": "timeout"})
+    except Exception as e:
+        print(f"⚠️ move_timeout finalize: {e}")
+
+
+_timeout_dispatcher = OrderedDispatcher(_finalize_timed_out, lambda item: item[0],
+                                        workers=2, name="move-timeouts")
+
+
+def seed_move_timeouts():
+    """يسلّح مهلات المباريات الجارية من مخزن الذاكرة (المُحمّل باستعلام واحد عند التشغيل)."""
+    n = 0
+    for g in get_pending_games():
+        if g.get("status") == "playing" and g.get("turn_deadline"):
+            arm_move_timeout(g["id"], g["turn_deadline"])
+            n += 1
+    return n
+
+
+def arm_challenge_expiry(game_id, created_at=None):
+    """يجدول انتهاء صلاحية التحدّي بعد CHALLENGE_TIMEOUT_SECONDS من إنشائه."""
+    created_at = _as_utc(created_at or datetime.now(timezone.utc))
+    scheduler.schedule_at(
+        f"expire:{game_id}",
+        (created_at + timedelta(seconds=CHALLENGE_TIMEOUT_SECONDS)).timestamp(),
+        _on_challenge_expiry, game_id,
+    )
+
+
+def _on_challenge_expiry(game_id):
+    g = get_game(game_id)
+    if not g or g.get("status") not in ("waiting", "posted"):
+        return  # انضم خصم أو حُذفت المباراة
+    # الانتقال مشروط بالنسخة المقروءة: انضمام بعدها يُفشل الانتهاء
+    if expire_game(
+        game_id,
+        "⌛ *انتهت صلاحية التحدّي*\n\n"
+        "لم ينضم أي لاعب خلال دقيقتين.",
+        wait=False,
+        expected_version=g.get("version", 0),
+    ):
+        print(f"[expire] game_id={game_id}")
+
+
+def seed_challenge_expiries():
+    """يسلّح انتهاء التحدّيات المعلّقة من مخزن الذاكرة عند التشغيل."""
+    n = 0
+    for g in get_pending_games():
+        if g.get("status") in ("waiting", "posted"):
+            arm_challenge_expiry(g["id"], g.get("created_at"))
+            n += 1
+    return n
+
+
+WEEKLY_RESET_RETRY_SECONDS = 300
+
+
+def weekly_reset_job():
+    """
+    يُنفَّذ عند موعد التصفير بالضبط (ومرة عند التشغيل لتدارك ما فات)،
+    ثم يعيد جدولة نفسه على الموعد التالي.
+    """
+    next_at = None
+    try:
+        now = datetime.now(timezone.utc)
+        target = last_scheduled_reset(now)
+        meta = get_meta()
+        last = meta.get("last_reset_at")
+        if last is not None and getattr(last, "tzinfo", None) is None:
+            last = last.replace(tzinfo=timezone.utc)
+        if last is None or last < target:
+            with _reset_running:
                 print(f"[weekly_reset] triggering target={target.isoformat()}")
-                try:
-                    top = get_leaderboard(25)
-                    season_id = target.strftime("%G-W%V")
-                    archive_season(season_id, target, top)
-                    n = reset_all_points()
-                    set_last_reset(target)
-                    print(f"[weekly_reset] done — archived={len(top)} reset_users={n}")
-                except Exception as e:
-                    print(f"⚠️ weekly_reset execute: {e}")
-        except Exception as e:
-            print(f"⚠️ weekly_reset_checker: {e}")
-        time_mod.sleep(300)  
+                top = get_leaderboard(25)
+                season_id = target.strftime("%G-W%V")
+                archive_season(season_id, target, top)
+                # O(1): رفع رقم الموسم؛ كل لاعب تُصفَّر نقاطه فعلياً عند أول كسب قادم
+                n = start_new_season(target)
+            print(f"[weekly_reset] done — archived={len(top)} active_players={n}")
+        next_at = next_scheduled_reset(now).timestamp()
+    except Exception as e:
+        print(f"⚠️ weekly_reset_job: {e}")
+    if next_at is None:
+        next_at = time_mod.time() + WEEKLY_RESET_RETRY_SECONDS
+    scheduler.schedule_at("weekly_reset", next_at, weekly_reset_job)
 
 
 # ============================
@@ -3685,7 +3855,7 @@ def handle_group_challenge(call, data):
                 pass
             return
         try:
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "❌ *أُلغي التحدّي.*",
                 call.message.chat.id, call.message.message_id,
                 parse_mode="Markdown",
@@ -3735,6 +3905,7 @@ def handle_group_challenge(call, data):
             except Exception:
                 pass
             return
+        arm_challenge_expiry(game_id)
 
         chat_id = call.message.chat.id
         msg_id = call.message.message_id
@@ -3757,10 +3928,10 @@ def handle_group_challenge(call, data):
             f"❌ {_md_escape(x_name)}  ⚔️  ⭕ {_md_escape(o_name)}\n\n"
             f"⏳ بانتظار *{_md_escape(target_name)}* — اضغط أي خانة للانضمام."
         )
-        board = board_list("---------")
+        board = EMPTY_BOARD
         kb = board_kb(board, f"pvp:{game_id}")
         try:
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 header,
                 chat_id, msg_id,
                 reply_markup=kb, parse_mode="Markdown",
@@ -3793,14 +3964,14 @@ def fallback(message):
             txt = (message.text or "").strip()
             if txt.lower() in ("/cancel", "إلغاء"):
                 cancel_2fa(uid)
-                bot.send_message(uid, "❎ تم إلغاء طلب التحقق الثنائي.")
+                telegram_io.send_message(uid, "❎ تم إلغاء طلب التحقق الثنائي.")
                 return
             if verify_totp(txt):
                 action = pending.get("action")
                 consume_2fa(uid)
                 _execute_2fa_action(uid, action)
             else:
-                bot.send_message(
+                telegram_io.send_message(
                     uid,
                     "❌ رمز غير صحيح. أرسل الرمز الصحيح أو /cancel للإلغاء.",
                 )
@@ -3825,7 +3996,7 @@ def fallback(message):
         if state["action"] == "wait_title":
             tab_id = f"t_{int(time_mod.time())}"
             set_help_section(tab_id, txt, "يرجى تعديل هذا المحتوى..")
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 f"✅ تم إنشاء القسم: {txt}", uid, state["msg_id"],
                 reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("✏️ اكتب المحتوى الآن", callback_data=f"admin_help_settext_{tab_id}"))
             )
@@ -3833,7 +4004,7 @@ def fallback(message):
             tid = state["tab_id"]
             title = get_help_sections().get(tid, {}).get("title", "قسم")
             set_help_section(tid, title, txt)
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 "✅ تم تحديث المحتوى بنجاح!", uid, state["msg_id"],
                 reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 رجوع", callback_data="admin_help_list"))
             )
@@ -3844,19 +4015,19 @@ def fallback(message):
                     # تحويل النص المدخل (15,5,-5) إلى أرقام مفصولة
                     w, d, l = map(int, txt.replace("،", ",").split(","))
                     set_bot_config(key, {"win": w, "draw": d, "loss": l})
-                    bot.edit_message_text(
+                    telegram_io.edit_message_text(
                         "✅ تم تحديث النقاط بنجاح!", uid, state["msg_id"],
                         reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 رجوع لإعدادات النقاط", callback_data="admin_points_menu"))
                     )
                 except Exception:
-                    bot.edit_message_text(
+                    telegram_io.edit_message_text(
                         "❌ تنسيق خاطئ! أرسل أرقاماً فقط يفصل بينها فاصلة.\nمثال: `15,5,-5`", uid, state["msg_id"],
                         reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 رجوع للإعدادات", callback_data="admin_points_menu")), parse_mode="Markdown"
                     )
             else:
                 val = txt if key != "daily_limit" else int(txt if txt.isdigit() else 150)
                 set_bot_config(key, val)
-                bot.edit_message_text(
+                telegram_io.edit_message_text(
                     f"✅ تم تحديث الإعداد بنجاح!", uid, state["msg_id"], 
                     reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔙 رجوع للوحة", callback_data="admin_back"))
                 )
@@ -3871,7 +4042,7 @@ def fallback(message):
         handle_popcalc_input(message, sess)
         return
         
-    bot.send_message(
+    telegram_io.send_message(
         uid,
         "استخدم القائمة 👇",
         reply_markup=start_menu_kb(),
@@ -3902,7 +4073,7 @@ def handle_popcalc_input(message, sess):
     uid = message.chat.id
     value = _parse_popularity(message.text)
     if value is None:
-        bot.send_message(uid, "⚠️ أرسل رقماً صحيحاً فقط (مثال: `50000` أو `1.2M`)",
+        telegram_io.send_message(uid, "⚠️ أرسل رقماً صحيحاً فقط (مثال: `50000` أو `1.2M`)",
                          parse_mode="Markdown")
         return
 
@@ -3929,7 +4100,7 @@ def handle_popcalc_input(message, sess):
         sess["own_pts"] = points_fn(value)
         sess["stage"] = "opp_pop"
         try:
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 f"{title}\n\n"
                 f"✅ شعبيتك: *{value:,}* ({sess['own_pts']} نقطة)\n\n"
                 f"2️⃣ الآن أرسل شعبية الخصم كرقم:",
@@ -3985,12 +4156,13 @@ def handle_popcalc_input(message, sess):
         )
         popcalc_sessions.pop(uid, None)
         try:
-            bot.edit_message_text(
+            telegram_io.edit_message_text(
                 text, uid, msg_id,
                 reply_markup=result_kb, parse_mode="Markdown",
+                wait=True,
             )
         except Exception:
-            bot.send_message(uid, text,
+            telegram_io.send_message(uid, text,
                              reply_markup=result_kb, parse_mode="Markdown")
         return
 
@@ -4000,12 +4172,13 @@ def handle_popcalc_input(message, sess):
 # ============================
 
 if __name__ == "__main__":
-    print("🎮 بوت لعبة XO يعمل الآن...")
-    try:
-        bot.remove_webhook()
-        print("✅ تم حذف الـ webhook (إن وجد)")
-    except Exception as e:
-        print(f"⚠️ تعذر حذف الـ webhook: {e}")
+    print(f"🎮 بوت لعبة XO يعمل الآن... (الوضع: {BOT_MODE}، threads المعالجة: {BOT_WORKERS})")
+    if BOT_MODE != "webhook":
+        try:
+            bot.remove_webhook()
+            print("✅ تم حذف الـ webhook (إن وجد)")
+        except Exception as e:
+            print(f"⚠️ تعذر حذف الـ webhook: {e}")
 
     try:
         me = bot.get_me()
@@ -4014,25 +4187,50 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"⚠️ تعذر جلب معلومات البوت: {e}")
 
+    if not start_meta_listeners():
+        print(f"⚠️ مستمعات meta غير متاحة — إعادة قراءة كل {META_REFRESH_SECONDS}s")
     load_flags()
     print(f"🏁 FEATURES: {FEATURES}")
 
     setup_bot_commands()
 
-    threading.Thread(target=expiration_checker, daemon=True).start()
-    print(f"⏳ فاحص انتهاء الصلاحية يعمل (مدة: {CHALLENGE_TIMEOUT_SECONDS}s)")
+    try:
+        n_games = load_active_games()
+        print(f"♻️ تم تحميل {n_games} مباراة نشطة من Firestore إلى الذاكرة")
+    except Exception as e:
+        print(f"⚠️ load_active_games: {e}")
+
+    try:
+        n_waiting = restore_quick_search_sessions()
+        print(f"♻️ تمت استعادة {n_waiting} لاعب في حوض المطابقة")
+    except Exception as e:
+        print(f"⚠️ restore_quick_search_sessions: {e}")
+    matchmaking.start(_on_matchmaking_pair)
+    print(f"⚡ محرك المطابقة يعمل (كل {matchmaking.MATCH_TICK_SECONDS}s، مهلة البحث: {QUICK_MATCH_TIMEOUT_SECONDS}s)")
 
-    threading.Thread(target=move_timeout_checker, daemon=True).start()
-    print(f"⏱️ فاحص مهلة الحركة يعمل (مدة: {MOVE_TIMEOUT_SECONDS}s لكل حركة)")
+    try:
+        n_armed = seed_challenge_expiries()
+        print(f"⏳ مجدول انتهاء التحدّيات: {n_armed} تحدٍّ معلّق (مدة: {CHALLENGE_TIMEOUT_SECONDS}s)")
+    except Exception as e:
+        print(f"⚠️ seed_challenge_expiries: {e}")
 
-    threading.Thread(target=quick_match_checker, daemon=True).start()
-    print(f"⚡ فاحص Quick Match يعمل (مهلة البحث: {QUICK_MATCH_TIMEOUT_SECONDS}s)")
+    try:
+        n_armed = seed_move_timeouts()
+        print(f"⏱️ مجدول مهلة الحركة: {n_armed} مباراة جارية (مدة: {MOVE_TIMEOUT_SECONDS}s لكل حركة)")
+    except Exception as e:
+        print(f"⚠️ seed_move_timeouts: {e}")
 
     try:
         backfill_points()
     except Exception as e:
         print(f"⚠️ backfill_points at startup: {e}")
 
+    try:
+        n_players = start_leaderboard_index()
+        print(f"🏆 فهرس لوحة الشرف: {n_players} لاعب (إعادة بناء كل {LEADERBOARD_RECONCILE_SECONDS}s)")
+    except Exception as e:
+        print(f"⚠️ start_leaderboard_index: {e}")
+
     try:
         _meta = get_meta()
         if not _meta.get("last_reset_at"):
@@ -4042,17 +4240,43 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"⚠️ seed last_reset_at: {e}")
 
-    threading.Thread(target=weekly_reset_checker, daemon=True).start()
+    scheduler.schedule_in("weekly_reset", 0, weekly_reset_job)
     print("🗓️ مجدول التصفير الأسبوعي يعمل (كل جمعة 00:00 بتوقيت الرياض)")
 
-    time_mod.sleep(5)
-
-    bot.infinity_polling(
-        timeout=30,
-        long_polling_timeout=20,
-        restart_on_change=False,
-        allowed_updates=[
-            "message", "callback_query",
-            "inline_query", "chosen_inline_result",
-        ],
-    )
\ No newline at end of file
+    # Render يرسل SIGTERM عند الإيقاف/إعادة النشر → SystemExit حتى تُكتب الزيادات المعلّقة
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    allowed_updates = [
+        "message", "callback_query",
+        "inline_query", "chosen_inline_result",
+    ]
+
+    try:
+        if BOT_MODE == "webhook":
+            import webhook_server
+            if WEBHOOK_URL:
+                try:
+                    bot.set_webhook(
+                        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+                        secret_token=WEBHOOK_SECRET or None,
+                        allowed_updates=allowed_updates,
+                    )
+                    print(f"✅ تم تعيين الـ webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+                except Exception as e:
+                    print(f"⚠️ تعذر تعيين الـ webhook: {e}")
+            else:
+                print("⚠️ WEBHOOK_URL غير مضبوط — الخادم يعمل محلياً فقط (للتجربة)")
+            webhook_server.serve(bot, PORT, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET)
+        else:
+            time_mod.sleep(5)
+            bot.infinity_polling(
+                timeout=30,
+                long_polling_timeout=20,
+                restart_on_change=False,
+                allowed_updates=allowed_updates,
+            )
+    finally:
+        n = flush_pending_writes()
+        print(f"💾 write-behind: كُتبت {n} وثيقة قبل الإغلاق")
+        n = flush_games()
+        print(f"💾 المباريات: حُفظت {n} لقطة قبل الإغلاق")
\ No newline at end of file
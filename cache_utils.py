@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+كاش LRU محدود الحجم مع انتهاء صلاحية (TTL) — آمن للاستخدام من عدة threads.
+يُستخدم بدل القواميس العادية التي تكبر بلا حد في عامل Render طويل التشغيل.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUTTLCache:
+    """
+    - max_entries: الحد الأقصى للعناصر؛ الأقل استخداماً يُطرد أولاً.
+    - ttl: مدة الصلاحية بالثواني منذ آخر كتابة (None = بلا انتهاء).
+    العدّادات: hits / misses / evictions (طرد بسبب الحجم) / expirations.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None):
+        self.max_entries = int(max_entries)
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (value, stored_at)
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, stored_at, now):
+        return self.ttl is not None and (now - stored_at) >= self.ttl
+
+    def get(self, key, default=None):
+        """يعيد القيمة إن كانت موجودة وصالحة (ويحدّث ترتيب LRU)، وإلا default."""
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            if self._expired(item[1], now):
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def mutate(self, key, fn):
+        """
+        يطبّق fn(value) على القيمة المخزّنة تحت القفل ويجدّد صلاحيتها.
+        لا يفعل شيئاً إن لم يكن المفتاح موجوداً أو انتهت صلاحيته. يعيد True إن طُبّق.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[1], now):
+                return False
+            fn(item[0])
+            self._data[key] = (item[0], now)
+            self._data.move_to_end(key)
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def purge_expired(self):
+        """يحذف كل العناصر المنتهية. يعيد عدد المحذوف."""
+        if self.ttl is None:
+            return 0
+        now = time.time()
+        with self._lock:
+            dead = [k for k, (_, ts) in self._data.items() if self._expired(ts, now)]
+            for k in dead:
+                del self._data[k]
+            self.expirations += len(dead)
+        return len(dead)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
@@ -12,3 +12,13 @@ ADMIN_ID = int(os.environ.get("ADMIN_ID", "0"))
 
 # === إعدادات Firebase (من متغيرات البيئة في Render) ===
 FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS")
+
+# === وضع التشغيل: polling (افتراضي) أو webhook ===
+BOT_MODE = os.environ.get("BOT_MODE", "polling").strip().lower()
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "4"))  # threads معالجة التحديثات
+
+# === إعدادات الـ webhook (عند BOT_MODE=webhook) ===
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")          # مثال: https://xo-bot.onrender.com
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")    # يُطابق X-Telegram-Bot-Api-Secret-Token
+PORT = int(os.environ.get("PORT", "8080"))               # Render يمرّر PORT تلقائياً
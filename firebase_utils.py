@@ -4,17 +4,29 @@
 أدوات Firebase - تخزين إحصائيات اللاعبين ومباريات PvP للعبة XO
 """
 
+import atexit
 import json
+import threading
 import time  # تمت الإضافة هنا
+from datetime import datetime, timezone
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
 
+from cache_utils import LRUTTLCache
 from config import FIREBASE_CREDENTIALS
+from leaderboard_index import LeaderboardIndex
+import scheduler
 
 # متغيرات نظام التخزين المؤقت لتقليل الضغط
-_user_cache = {}
 CACHE_TTL_SECONDS = 60  # مدة بقاء البيانات في الذاكرة بالثواني
+USER_CACHE_MAX_ENTRIES = 5000  # أقصى عدد مستخدمين في الذاكرة (الأقل استخداماً يُطرد)
+# {uid_str: data} — LRU محدود + TTL، آمن للـ threads
+_user_cache = LRUTTLCache(max_entries=USER_CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+
+# Write-behind: زيادات record_result تُدمج لكل مستخدم وتُكتب كـ batch واحد
+WRITE_BEHIND_FLUSH_MS = 2000    # أقصى تأخير قبل الكتابة
+WRITE_BEHIND_MAX_OPS = 100      # عدد العمليات الذي يفرض كتابة فورية
 
 def init_firebase():
     """تهيئة اتصال Firebase"""
@@ -43,31 +55,27 @@ db = init_firebase()
 def get_or_create_user(user_id, name="", username=""):
     """جلب مستخدم أو إنشاؤه بسجل إحصائيات صفري"""
     uid_str = str(user_id)
-    current_time = time.time()
     
     # 1. فحص الكاش أولاً
-    if uid_str in _user_cache:
-        cached = _user_cache[uid_str]
-        if (current_time - cached['timestamp']) < CACHE_TTL_SECONDS:
-            data = cached['data']
-            updates = {}
-            if name and data.get("name") != name:
-                updates["name"] = name
-                data["name"] = name
-            if username != data.get("username", ""):
-                updates["username"] = username
-                data["username"] = username
-            if updates:
-                db.collection("users").document(uid_str).update(updates)
-                _user_cache[uid_str]['timestamp'] = current_time
-            return {"id": uid_str, **data}
+    data = _user_cache.get(uid_str)
+    if data is not None:
+        updates = {}
+        if name and data.get("name") != name:
+            updates["name"] = name
+        if username != data.get("username", ""):
+            updates["username"] = username
+        if updates:
+            db.collection("users").document(uid_str).update(updates)
+            _user_cache.mutate(uid_str, lambda d: d.update(updates))
+            _leaderboard.upsert(uid_str, updates)
+        return season_view({"id": uid_str, **data})
 
     # 2. الجلب من Firebase
     ref = db.collection("users").document(uid_str)
     doc = ref.get()
     
     if doc.exists:
-        data = doc.to_dict()
+        data = _with_pending(uid_str, doc.to_dict())
         updates = {}
         if name and data.get("name") != name:
             updates["name"] = name
@@ -77,9 +85,10 @@ def get_or_create_user(user_id, name="", username=""):
             data["username"] = username
         if updates:
             ref.update(updates)
-            
-        _user_cache[uid_str] = {'data': data, 'timestamp': current_time}
-        return {"id": doc.id, **data}
+            _leaderboard.upsert(uid_str, updates)
+
+        _user_cache.set(uid_str, data)
+        return season_view({"id": doc.id, **data})
 
     # 3. مستخدم جديد
     new_data = {
@@ -87,6 +96,7 @@ def get_or_create_user(user_id, name="", username=""):
         "name": name or "لاعب",
         "username": username or "",
         "points": 0,
+        "season_id": current_season(),
         "wins": 0,
         "losses": 0,
         "draws": 0,
@@ -102,7 +112,8 @@ def get_or_create_user(user_id, name="", username=""):
         "created_at": firestore.SERVER_TIMESTAMP,
     }
     ref.set(new_data)
-    _user_cache[uid_str] = {'data': new_data, 'timestamp': current_time}
+    _user_cache.set(uid_str, new_data)
+    _leaderboard.upsert(uid_str, new_data, points=0)
     return {"id": uid_str, **new_data}
 
 
@@ -137,7 +148,6 @@ def record_result(user_id, mode, result, award_points=True, points_override=None
         return
 
     uid_str = str(user_id)
-    ref = db.collection("users").document(uid_str)
     
     total_key = {"win": "wins", "loss": "losses", "draw": "draws"}[result]
     mode_key = f"{mode}_{ {'win':'wins','loss':'losses','draw':'draws'}[result] }"
@@ -147,71 +157,294 @@ def record_result(user_id, mode, result, award_points=True, points_override=None
     else:
         pts = POINTS_TABLE.get((mode, result), 0)
 
-    updates = {
-        total_key: firestore.Increment(1),
-        mode_key: firestore.Increment(1),
-    }
+    deltas = {total_key: 1, mode_key: 1}
     
     points_to_add = 0
     if pts and award_points:
-        updates["points"] = firestore.Increment(pts)
+        deltas["points"] = pts
         points_to_add = pts
-        
-    ref.update(updates)
+        # أول نقاط في موسم جديد: صفّر نقاط الموسم السابق قبل الزيادة
+        ensure_current_season(uid_str)
+
+    _queue_increments(uid_str, deltas)
     
     # تحديث الكاش لتجنب عرض نقاط قديمة
-    if uid_str in _user_cache:
-        cache_data = _user_cache[uid_str]['data']
+    def _bump(cache_data):
         cache_data[total_key] = cache_data.get(total_key, 0) + 1
         cache_data[mode_key] = cache_data.get(mode_key, 0) + 1
         if points_to_add:
             cache_data["points"] = cache_data.get("points", 0) + points_to_add
-        _user_cache[uid_str]['timestamp'] = time.time()
 
+    _user_cache.mutate(uid_str, _bump)
+    if points_to_add:
+        leaderboard_add_points(uid_str, points_to_add)
 
-def get_user_stats(user_id):
-    """جلب إحصائيات مستخدم"""
-    uid_str = str(user_id)
-    current_time = time.time()
-    
-    if uid_str in _user_cache:
-        cached = _user_cache[uid_str]
-        if (current_time - cached['timestamp']) < CACHE_TTL_SECONDS:
-            return {"id": uid_str, **cached['data']}
 
+def _load_user(uid_str):
+    """سجل المستخدم كما هو مخزّن (من الكاش أو Firestore + الزيادات المعلّقة)، أو None."""
+    data = _user_cache.get(uid_str)
+    if data is not None:
+        return data
     doc = db.collection("users").document(uid_str).get()
     if doc.exists:
-        data = doc.to_dict()
-        _user_cache[uid_str] = {'data': data, 'timestamp': current_time}
-        return {"id": doc.id, **data}
+        data = _with_pending(uid_str, doc.to_dict())
+        _user_cache.set(uid_str, data)
+        return data
     return None
 
 
+def get_user_stats(user_id):
+    """جلب إحصائيات مستخدم (نقاط موسم سابق تظهر 0)"""
+    uid_str = str(user_id)
+    data = _load_user(uid_str)
+    if data is None:
+        return None
+    return season_view({"id": uid_str, **data})
+
+
+def invalidate_user(user_id):
+    """يحذف سجل المستخدم من الكاش — يُستدعى بعد أي كتابة خارج record_result."""
+    _user_cache.pop(str(user_id))
+
+
+def patch_cached_user(user_id, fields):
+    """يحدّث حقولاً في سجل المستخدم المخزّن (إن وُجد) بعد كتابتها في Firestore."""
+    _user_cache.mutate(str(user_id), lambda d: d.update(fields))
+
+
+def user_cache_stats():
+    """عدّادات كاش المستخدمين (hits/misses/evictions...) لعرضها في /status."""
+    _user_cache.purge_expired()
+    return _user_cache.stats()
+
+
+# ============================
+# === Write-behind للإحصائيات ===
+# ============================
+# {uid_str: {field: delta}} — زيادات لم تُكتب بعد، ونسخة منها قيد الكتابة حالياً.
+# القراءات من Firestore تُضاف إليها هذه الزيادات حتى يبقى الكاش صحيحاً.
+_pending_increments = {}
+_inflight_increments = {}
+_pending_ops = 0
+_wb_lock = threading.Lock()
+_wb_flush_lock = threading.Lock()
+_wb_wakeup = threading.Event()
+_wb_thread = None
+
+
+def _merge_deltas(target, uid_str, deltas):
+    cur = target.setdefault(uid_str, {})
+    for k, v in deltas.items():
+        cur[k] = cur.get(k, 0) + v
+
+
+def _drop_inflight(items):
+    """يطرح زيادات items من _inflight_increments (تحت _wb_lock)."""
+    for uid_str, deltas in items:
+        cur = _inflight_increments.get(uid_str)
+        if cur is None:
+            continue
+        for k, v in deltas.items():
+            left = cur.get(k, 0) - v
+            if left:
+                cur[k] = left
+            else:
+                cur.pop(k, None)
+        if not cur:
+            del _inflight_increments[uid_str]
+
+
+def _with_pending(uid_str, data):
+    """يضيف الزيادات المعلّقة/قيد الكتابة إلى بيانات قادمة من Firestore."""
+    with _wb_lock:
+        extra = {}
+        for src in (_inflight_increments, _pending_increments):
+            for k, v in src.get(uid_str, {}).items():
+                extra[k] = extra.get(k, 0) + v
+    for k, v in extra.items():
+        data[k] = (data.get(k, 0) or 0) + v
+    return data
+
+
+def _queue_increments(uid_str, deltas):
+    global _pending_ops, _wb_thread
+    with _wb_lock:
+        _merge_deltas(_pending_increments, uid_str, deltas)
+        _pending_ops += 1
+        full = _pending_ops >= WRITE_BEHIND_MAX_OPS
+        if _wb_thread is None:
+            _wb_thread = threading.Thread(target=_write_behind_loop, daemon=True)
+            _wb_thread.start()
+    if full:
+        _wb_wakeup.set()
+
+
+def flush_pending_writes():
+    """
+    يكتب كل الزيادات المعلّقة في batch واحد (أو أكثر إن تجاوزت 450 وثيقة).
+    عند الفشل تُعاد الزيادات للطابور لتُكتب في الدورة التالية. يعيد عدد الوثائق.
+    """
+    global _pending_increments, _pending_ops
+    with _wb_flush_lock:
+        with _wb_lock:
+            if not _pending_increments:
+                return 0
+            taken = _pending_increments
+            _pending_increments = {}
+            _pending_ops = 0
+            for uid_str, deltas in taken.items():
+                _merge_deltas(_inflight_increments, uid_str, deltas)
+
+        items = list(taken.items())
+        written = 0
+        try:
+            for i in range(0, len(items), 450):
+                chunk = items[i:i + 450]
+                batch = db.batch()
+                for uid_str, deltas in chunk:
+                    batch.set(
+                        db.collection("users").document(uid_str),
+                        {k: firestore.Increment(v) for k, v in deltas.items() if v},
+                        merge=True,
+                    )
+                batch.commit()
+                # صارت في Firestore: تُطرح من inflight فوراً حتى لا تُحسب مرتين
+                # في قراءة تقع بين هذه الدفعة والدفعات التالية
+                with _wb_lock:
+                    _drop_inflight(chunk)
+                written += len(chunk)
+        except Exception as e:
+            print(f"⚠️ flush_pending_writes: {e}")
+            with _wb_lock:
+                rest = items[written:]
+                _drop_inflight(rest)
+                for uid_str, deltas in rest:
+                    _merge_deltas(_pending_increments, uid_str, deltas)
+                    _pending_ops += 1
+        return written
+
+
+def _write_behind_loop():
+    while True:
+        _wb_wakeup.wait(WRITE_BEHIND_FLUSH_MS / 1000)
+        _wb_wakeup.clear()
+        try:
+            flush_pending_writes()
+        except Exception as e:
+            print(f"⚠️ write-behind loop: {e}")
+
+
+# كتابة مضمونة عند الإغلاق (الخروج الطبيعي أو SystemExit من معالج SIGTERM)
+atexit.register(flush_pending_writes)
+
+
+# ============================
+# === فهرس لوحة الشرف ===
+# ============================
+# أعلى N وترتيب اللاعب من الذاكرة؛ record_result و adjust_points يحدّثانه
+# مباشرة، وإعادة بناء دورية من Firestore تصحّح أي انحراف.
+LEADERBOARD_RECONCILE_SECONDS = 3600
+LEADERBOARD_RETRY_SECONDS = 60    # إعادة المحاولة إن تخطّينا البناء لعدم تحميل meta/leaderboard
+
+_leaderboard = LeaderboardIndex()
+_lb_rebuild_lock = threading.Lock()
+_lb_reconcile_thread = None
+
+
+def leaderboard_add_points(user_id, delta):
+    """يُبلغ الفهرس بتغيّر نقاط لاعب (بعد كتابتها أو جدولتها)."""
+    uid_str = str(user_id)
+    if _leaderboard.add_points(uid_str, delta):
+        return
+    data = get_user_stats(uid_str)  # يشمل الزيادة المعلّقة
+    if data is not None:
+        _leaderboard.upsert(uid_str, data, points=data.get("points", 0) or 0)
+
+
+def rebuild_leaderboard():
+    """
+    يقرأ نقاط كل المستخدمين (مع الزيادات المعلّقة) ويعيد بناء الفهرس.
+    يعيد عدد التصحيحات (0 في البناء الأول)، أو None إن تُخطّي البناء لأن
+    meta/leaderboard لم تُحمَّل (الموسم مجهول فلا نعرف أي النقاط حالية).
+    """
+    current_season()  # يحمّل meta/leaderboard إن لم تكن في الذاكرة
+    if not meta_loaded("leaderboard"):
+        print(f"⚠️ rebuild_leaderboard: meta/leaderboard غير محمّلة — إعادة المحاولة بعد "
+              f"{LEADERBOARD_RETRY_SECONDS}s")
+        scheduler.schedule_in("leaderboard_rebuild_retry", LEADERBOARD_RETRY_SECONDS,
+                              _reconcile_leaderboard)
+        return None
+    with _lb_rebuild_lock:
+        _leaderboard.begin_rebuild()
+        entries = {}
+        try:
+            docs = db.collection("users").select(
+                ["user_id", "name", "username", "points", "season_id"]
+            ).stream()
+            for d in docs:
+                data = season_view(_with_pending(d.id, d.to_dict() or {}))
+                entries[d.id] = {
+                    "user_id": data.get("user_id") or int(d.id),
+                    "name": data.get("name") or "لاعب",
+                    "username": data.get("username") or "",
+                    "points": int(data.get("points", 0) or 0),
+                }
+        except Exception:
+            _leaderboard.abort_rebuild()
+            raise
+        return _leaderboard.finish_rebuild(entries)
+
+
+def _reconcile_leaderboard_worker():
+    try:
+        drift = rebuild_leaderboard()
+        if drift:
+            print(f"♻️ leaderboard reconcile: صُحّح {drift} لاعب")
+    except Exception as e:
+        print(f"⚠️ leaderboard reconcile: {e}")
+
+
+def _reconcile_leaderboard():
+    """من المجدول: يطلق إعادة البناء على thread مستقل (مسح users يستغرق ثوانٍ)."""
+    global _lb_reconcile_thread
+    if _lb_reconcile_thread is not None and _lb_reconcile_thread.is_alive():
+        return  # الدورة السابقة لم تنتهِ بعد
+    _lb_reconcile_thread = threading.Thread(target=_reconcile_leaderboard_worker,
+                                            daemon=True, name="leaderboard-reconcile")
+    _lb_reconcile_thread.start()
+
+
+def start_leaderboard_index():
+    """البناء الأول ثم إعادة البناء الدورية على المجدول. يعيد عدد اللاعبين."""
+    scheduler.schedule_every("leaderboard_reconcile", LEADERBOARD_RECONCILE_SECONDS,
+                             _reconcile_leaderboard)
+    rebuild_leaderboard()
+    return len(_leaderboard)
+
+
+def leaderboard_stats():
+    return {"loaded": _leaderboard.loaded, "players": len(_leaderboard),
+            "drift": _leaderboard.drift}
+
+
 def get_leaderboard(limit=25):
-    """أعلى اللاعبين حسب النقاط"""
+    """أعلى اللاعبين حسب النقاط (من الفهرس، أو استعلام Firestore قبل بنائه)."""
+    if _leaderboard.loaded:
+        return _leaderboard.top(limit)
+    # نقاط المواسم السابقة لم تُصفَّر فعلياً: نجلب أكثر ونستبعدها
     docs = db.collection("users") \
         .order_by("points", direction=firestore.Query.DESCENDING) \
-        .limit(limit) \
+        .limit(limit * 4) \
         .stream()
-    return [{"id": d.id, **d.to_dict()} for d in docs]
+    users = [{"id": d.id, **d.to_dict()} for d in docs]
+    return [u for u in users if is_current_season(u)][:limit]
 
 
-def reset_all_points():
-    """يُصفّر حقل `points` لكل اللاعبين — عبر batch writes."""
-    count = 0
-    batch = db.batch()
-    ops = 0
-    for d in db.collection("users").stream():
-        batch.update(d.reference, {"points": 0})
-        ops += 1
-        count += 1
-        if ops >= 450:
-            batch.commit()
-            batch = db.batch()
-            ops = 0
-    if ops:
-        batch.commit()
-    return count
+def get_leaderboard_rank(points):
+    """ترتيب من يملك points (1 + عدد من نقاطهم أعلى)، أو None قبل بناء الفهرس."""
+    if not _leaderboard.loaded:
+        return None
+    return _leaderboard.count_above(points) + 1
 
 
 def archive_season(season_id, reset_time_utc, top_users):
@@ -261,19 +494,225 @@ def set_last_reset(ts):
     db.collection("meta").document("leaderboard").set(
         {"last_reset_at": ts}, merge=True
     )
+    _meta_patch("leaderboard", {"last_reset_at": ts})
+
+
+# ============================
+# === وثائق meta في الذاكرة ===
+# ============================
+
+# meta/config و flags و help_sections و leaderboard تُقرأ مرة واحدة وتُخدم من الذاكرة.
+# تبقى محدّثة عبر on_snapshot، وإن لم يعمل المستمع تُعاد قراءتها كل
+# META_REFRESH_SECONDS. كتابات المالك تحدّث النسخة المحلية فوراً.
+META_DOCS = ("config", "flags", "help_sections", "leaderboard")
+META_REFRESH_SECONDS = 60
+
+_meta = {}             # {name: dict}
+_meta_loaded_at = {}   # {name: monotonic}
+_meta_ok = set()       # وثائق قُرئت فعلاً من Firestore مرة على الأقل (لا نسخة فارغة بعد فشل)
+_meta_refreshing = set()
+_meta_watches = {}
+_meta_listeners = []   # fn(name, data) عند تغيّر وثيقة
+_meta_lock = threading.Lock()
+
+
+def _meta_store(name, data, authoritative=True):
+    """يحفظ النسخة الجديدة ويُبلغ المستمعين إن تغيّرت."""
+    with _meta_lock:
+        changed = _meta.get(name) != data
+        _meta[name] = data
+        _meta_loaded_at[name] = time.monotonic()
+        if authoritative:
+            _meta_ok.add(name)
+        listeners = list(_meta_listeners) if changed else []
+    for fn in listeners:
+        try:
+            fn(name, dict(data))
+        except Exception as e:
+            print(f"⚠️ meta listener ({name}): {e}")
+
+
+def _meta_load(name):
+    try:
+        doc = db.collection("meta").document(name).get()
+        data = (doc.to_dict() or {}) if doc.exists else {}
+    except Exception as e:
+        print(f"⚠️ meta/{name}: {e}")
+        with _meta_lock:
+            # نحتفظ بالنسخة السابقة ونؤجّل المحاولة التالية حتى انتهاء المدة
+            _meta.setdefault(name, {})
+            _meta_loaded_at[name] = time.monotonic()
+            return _meta[name]
+    _meta_store(name, data)
+    return data
+
+
+def _meta_get(name):
+    """نسخة وثيقة meta/{name} من الذاكرة (تُقرأ من Firestore فقط عند الحاجة)."""
+    with _meta_lock:
+        data = _meta.get(name)
+        stale = (
+            data is None
+            or (name not in _meta_watches
+                and time.monotonic() - _meta_loaded_at.get(name, 0) > META_REFRESH_SECONDS)
+        )
+        if stale and data is not None and name in _meta_refreshing:
+            stale = False  # thread آخر يعيد القراءة — النسخة الحالية تكفي
+        if stale:
+            _meta_refreshing.add(name)
+    if stale:
+        try:
+            data = _meta_load(name)
+        finally:
+            with _meta_lock:
+                _meta_refreshing.discard(name)
+    return dict(data)
+
+
+def _meta_patch(name, updates=None, removed=()):
+    """يطبّق كتابة المالك على النسخة المحلية (إن كانت محمّلة) دون انتظار المستمع."""
+    with _meta_lock:
+        if name not in _meta:
+            return
+        data = dict(_meta[name])
+    data.update(updates or {})
+    for k in removed:
+        data.pop(k, None)
+    _meta_store(name, data, authoritative=False)
+
+
+def _meta_on_snapshot(name):
+    def _callback(doc_snapshots, changes, read_time):
+        for doc in doc_snapshots:
+            _meta_store(name, (doc.to_dict() or {}) if doc.exists else {})
+    return _callback
+
+
+def start_meta_listeners():
+    """يحمّل وثائق meta ويبدأ مستمع on_snapshot لكل منها. يعيد True إن بدأت كلها."""
+    ok = True
+    for name in META_DOCS:
+        if name in _meta_watches:
+            continue
+        _meta_load(name)
+        try:
+            watch = db.collection("meta").document(name).on_snapshot(_meta_on_snapshot(name))
+        except Exception as e:
+            print(f"⚠️ meta/{name} listener: {e}")
+            ok = False
+            continue
+        with _meta_lock:
+            _meta_watches[name] = watch
+    return ok
+
+
+def meta_loaded(name):
+    """هل قُرئت meta/{name} من Firestore فعلاً؟ (False إن كانت النسخة فارغة بعد فشل القراءة)"""
+    with _meta_lock:
+        return name in _meta_ok
+
+
+def on_meta_change(fn):
+    """يسجّل fn(name, data) يُستدعى عند تغيّر أي وثيقة meta (من المستمع أو كتابة محلية)."""
+    with _meta_lock:
+        _meta_listeners.append(fn)
+
+
+# ============================
+# === المواسم (season epoch) ===
+# ============================
+
+# meta/leaderboard.season_id رقم الموسم الحالي، وكل مستخدم يحمل season_id بجانب
+# points. نقاط موسم سابق تُعامل كـ 0 عند القراءة، وتُصفَّر فعلياً أول مرة يكسب
+# فيها المستخدم نقاطاً في الموسم الجديد. التصفير الأسبوعي = أرشفة + رفع الرقم.
+_season_lock = threading.Lock()
+
+
+def current_season():
+    return int(_meta_get("leaderboard").get("season_id", 0) or 0)
+
+
+def is_current_season(data):
+    """
+    هل النقاط المخزّنة من الموسم الحالي؟ قبل قراءة meta/leaderboard فعلاً
+    الموسم مجهول (season_id=0 افتراضي)، فتُعامل النقاط المخزّنة كحالية.
+    """
+    season = current_season()
+    if not meta_loaded("leaderboard"):
+        return True
+    return int((data or {}).get("season_id", 0) or 0) == season
+
+
+def season_view(data):
+    """نسخة للعرض: نقاط موسم سابق = 0 (بدون كتابة). بلا meta/leaderboard تعاد كما هي."""
+    if data is None or is_current_season(data):
+        return data
+    return {**data, "points": 0, "season_id": current_season()}
+
+
+def ensure_current_season(user_id):
+    """
+    قبل أي تغيير في نقاط المستخدم: إن كانت من موسم سابق تُكتب 0 مع season_id
+    الحالي. يعيد True إن حدثت الكتابة.
+    لا يكتب شيئاً ما لم تُقرأ meta/leaderboard فعلاً: season_id=0 الافتراضي بعد
+    فشل القراءة سيبدو "موسماً سابقاً" لكل مستخدم فيمحو نقاطه.
+    """
+    uid_str = str(user_id)
+    if not meta_loaded("leaderboard"):
+        _meta_load("leaderboard")  # محاولة قراءة واحدة قبل الرفض
+        if not meta_loaded("leaderboard"):
+            print(f"⚠️ ensure_current_season({uid_str}): meta/leaderboard غير محمّلة — لا تصفير")
+            return False
+    cached = _user_cache.get(uid_str)
+    if cached is not None and is_current_season(cached):
+        return False
+    with _season_lock:
+        season = current_season()
+        data = _load_user(uid_str)
+        if data is not None and int(data.get("season_id", 0) or 0) == season:
+            return False
+        db.collection("users").document(uid_str).set(
+            {"points": 0, "season_id": season}, merge=True
+        )
+        _user_cache.mutate(uid_str, lambda d: d.update(points=0, season_id=season))
+    return True
+
+
+def start_new_season(reset_at):
+    """
+    التصفير الأسبوعي بكلفة ثابتة: تُكتب الزيادات المعلّقة (نقاط الموسم المنتهي)
+    ثم يُرفع season_id في meta/leaderboard مع last_reset_at.
+    يعيد عدد اللاعبين الذين كانت لديهم نقاط (من الفهرس).
+    """
+    ref = db.collection("meta").document("leaderboard")
+
+    @firestore.transactional
+    def _bump(transaction):
+        snap = ref.get(transaction=transaction)
+        meta = (snap.to_dict() or {}) if snap.exists else {}
+        season = int(meta.get("season_id", 0) or 0) + 1
+        transaction.set(ref, {"season_id": season, "last_reset_at": reset_at}, merge=True)
+        return season
+
+    with _season_lock:
+        flush_pending_writes()
+        season = _bump(db.transaction())
+        _meta_patch("leaderboard", {"season_id": season, "last_reset_at": reset_at})
+        active = _leaderboard.nonzero_count()
+        _leaderboard.reset_points(0)
+    print(f"🆕 season_id={season}")
+    return active
 
 
 def get_flags():
-    """جلب أعلام التفعيل (feature flags) من meta/flags."""
-    doc = db.collection("meta").document("flags").get()
-    if doc.exists:
-        return doc.to_dict()
-    return {}
+    """أعلام التفعيل (feature flags) من meta/flags — من الذاكرة."""
+    return _meta_get("flags")
 
 
 def set_flag(name, value):
     """تعيين علم ميزة."""
     db.collection("meta").document("flags").set({name: bool(value)}, merge=True)
+    _meta_patch("flags", {name: bool(value)})
 
 
 def export_all():
@@ -289,6 +728,10 @@ def export_all():
             return [_json_safe(x) for x in v]
         return v
 
+    # الكتابات المؤجلة (write-behind + لقطات المباريات) أولاً حتى تكون النسخة كاملة
+    flush_pending_writes()
+    flush_games()
+
     result = {}
     for col in ("users", "games", "seasons", "meta", "queue"):
         docs = []
@@ -331,25 +774,75 @@ def backfill_points():
 # ============================
 # === مباريات PvP ===
 # ============================
-
-def create_game(game_id, player_x_id, player_x_name, x_chat_id):
-    """إنشاء مباراة PvP جديدة: المنشئ يلعب كـ ❌"""
-    db.collection("games").document(game_id).set({
-        "player_x_id": int(player_x_id),
-        "player_x_name": player_x_name,
+# مخزن المباريات في الذاكرة هو المصدر الموثوق للمباريات النشطة.
+# Firestore (مجموعة games) نسخة للاستمرارية: تُكتب اللقطات بشكل غير متزامن
+# وتُعاد تحميلها عند الإقلاع حتى تنجو المباريات من إعادة التشغيل.
+GAME_PERSIST_INTERVAL_MS = 500      # أقصى تأخير قبل كتابة لقطة المباراة
+FINISHED_GAME_MEMORY_SECONDS = 300  # مدة بقاء المباراة المنتهية في الذاكرة بعد حفظها
+ACTIVE_GAME_STATUSES = ("waiting", "posted", "playing")
+
+_games = {}          # {game_id: dict} بدون حقل "id"
+_games_dirty = {}    # {game_id: True (حفظ) | False (حذف)}
+_games_finished_at = {}
+_games_lock = threading.RLock()
+_games_flush_lock = threading.Lock()
+_games_wakeup = threading.Event()
+_games_thread = None
+
+
+def _game_view(game_id, data):
+    return {"id": game_id, **data}
+
+
+def _mark_game_dirty(game_id, save=True):
+    global _games_thread
+    with _games_lock:
+        _games_dirty[game_id] = save
+        if _games_thread is None:
+            _games_thread = threading.Thread(target=_games_persist_loop, daemon=True)
+            _games_thread.start()
+    _games_wakeup.set()
+
+
+def _put_game(game_id, data):
+    with _games_lock:
+        _games[game_id] = data
+        if data.get("status") == "finished":
+            _games_finished_at.setdefault(game_id, time.time())
+        else:
+            _games_finished_at.pop(game_id, None)
+    _mark_game_dirty(game_id)
+
+
+def _new_game_doc():
+    return {
+        "player_x_id": None,
+        "player_x_name": None,
         "player_o_id": None,
         "player_o_name": None,
         "board": "---------",  # 9 خانات
         "turn": "X",
         "status": "waiting",
         "winner": None,
-        "x_chat_id": int(x_chat_id) if x_chat_id else None,
+        "x_chat_id": None,
         "x_msg_id": None,
         "o_chat_id": None,
         "o_msg_id": None,
         "inline_message_id": None,
-        "created_at": firestore.SERVER_TIMESTAMP,
-    })
+        # يزيد مع كل تعديل — أساس compare-and-set للحركات والإنهاء
+        "version": 0,
+        # وقت محلي (وليس SERVER_TIMESTAMP) لأن الذاكرة هي المصدر الموثوق
+        "created_at": datetime.now(timezone.utc),
+    }
+
+
+def create_game(game_id, player_x_id, player_x_name, x_chat_id):
+    """إنشاء مباراة PvP جديدة: المنشئ يلعب كـ ❌"""
+    data = _new_game_doc()
+    data["player_x_id"] = int(player_x_id)
+    data["player_x_name"] = player_x_name
+    data["x_chat_id"] = int(x_chat_id) if x_chat_id else None
+    _put_game(game_id, data)
 
 
 def create_game_symbol(game_id, creator_id, creator_name, symbol):
@@ -359,159 +852,244 @@ def create_game_symbol(game_id, creator_id, creator_name, symbol):
     إذا اختار O → هو player_o، والدور للـ X الذي سينضم.
     """
     symbol = symbol.upper()
-    base = {
-        "player_x_id": None,
-        "player_x_name": None,
-        "player_o_id": None,
-        "player_o_name": None,
-        "board": "---------",
-        "turn": "X",
-        "status": "waiting",
-        "winner": None,
-        "x_chat_id": None,
-        "x_msg_id": None,
-        "o_chat_id": None,
-        "o_msg_id": None,
-        "inline_message_id": None,
-        "created_at": firestore.SERVER_TIMESTAMP,
-    }
+    base = _new_game_doc()
     if symbol == "X":
         base["player_x_id"] = int(creator_id)
         base["player_x_name"] = creator_name
     else:
         base["player_o_id"] = int(creator_id)
         base["player_o_name"] = creator_name
-    db.collection("games").document(game_id).set(base)
+    _put_game(game_id, base)
 
 
 def get_game(game_id):
+    """من الذاكرة أولاً؛ عند عدم الوجود تُقرأ من Firestore وتُضاف للمخزن."""
+    with _games_lock:
+        data = _games.get(game_id)
+        if data is not None:
+            return _game_view(game_id, dict(data))
+        if _games_dirty.get(game_id) is False:
+            return None  # محذوفة وبانتظار الحذف من Firestore
     doc = db.collection("games").document(game_id).get()
-    if doc.exists:
-        return {"id": doc.id, **doc.to_dict()}
-    return None
+    if not doc.exists:
+        return None
+    data = doc.to_dict()
+    with _games_lock:
+        # ربما أُنشئت/عُدّلت في الذاكرة أثناء القراءة — الذاكرة أولى
+        current = _games.setdefault(game_id, data)
+        if current.get("status") == "finished":
+            _games_finished_at.setdefault(game_id, time.time())
+        return _game_view(game_id, dict(current))
 
 
-# ============================
-# === طابور "العب الآن" ===
-# ============================
+def update_game(game_id, data):
+    with _games_lock:
+        game = _games.get(game_id)
+    if game is None and get_game(game_id) is None:
+        # غير موجودة إطلاقاً — نفس سلوك Firestore update (NotFound)
+        db.collection("games").document(game_id).update(data)
+        return
+    with _games_lock:
+        game = dict(_games[game_id])
+        game.update(data)
+        game["version"] = game.get("version", 0) + 1
+        _put_game(game_id, game)
 
-def queue_add(user_id, name, chat_id):
-    """أضف لاعباً للطابور (أو حدّث بياناته إن كان موجوداً)."""
-    db.collection("queue").document(str(user_id)).set({
-        "user_id": int(user_id),
-        "name": name or "لاعب",
-        "chat_id": int(chat_id),
-        "joined_at": firestore.SERVER_TIMESTAMP,
-    })
 
+def update_game_cas(game_id, expected_version, data):
+    """
+    compare-and-set: يطبّق data فقط إن كانت نسخة المباراة في الذاكرة = expected_version.
+    الذاكرة هي نقطة الالتزام (مرجع المباراة الوحيد)؛ يعيد False عند التعارض أو عدم الوجود.
+    """
+    if get_game(game_id) is None:
+        return False
+    with _games_lock:
+        current = _games.get(game_id)
+        if current is None or current.get("version", 0) != expected_version:
+            return False
+        game = dict(current)
+        game.update(data)
+        game["version"] = expected_version + 1
+        _put_game(game_id, game)
+    return True
 
-def queue_remove(user_id):
-    """أزل لاعباً من الطابور (بصمت إن لم يكن موجوداً)."""
-    try:
-        db.collection("queue").document(str(user_id)).delete()
-    except Exception:
-        pass
+
+def delete_game(game_id):
+    with _games_lock:
+        _games.pop(game_id, None)
+        _games_finished_at.pop(game_id, None)
+    _mark_game_dirty(game_id, save=False)
 
 
-def queue_in(user_id):
-    """هل اللاعب حالياً في الطابور؟"""
-    return db.collection("queue").document(str(user_id)).get().exists
+def get_pending_games():
+    """كل المباريات التي لم تنتهِ (waiting | posted | playing) — من الذاكرة."""
+    with _games_lock:
+        return [
+            _game_view(gid, dict(g)) for gid, g in _games.items()
+            if g.get("status") in ACTIVE_GAME_STATUSES
+        ]
 
 
-def queue_size():
-    """عدد اللاعبين المنتظرين."""
+def get_active_game_for_user(uid):
+    """يبحث عن أول مباراة PvP نشطة (playing) للمستخدم — يعيد dict أو None."""
     try:
-        # count() أخف من stream()
-        agg = db.collection("queue").count().get()
-        return int(agg[0][0].value)
-    except Exception:
-        # fallback
-        return sum(1 for _ in db.collection("queue").limit(500).stream())
+        uid = int(uid)
+    except (TypeError, ValueError):
+        return None
+    with _games_lock:
+        for gid, g in _games.items():
+            if g.get("status") != "playing":
+                continue
+            if g.get("player_x_id") == uid or g.get("player_o_id") == uid:
+                return _game_view(gid, dict(g))
+    return None
+
+
+def load_active_games():
+    """يُستدعى مرة عند الإقلاع: يحمّل المباريات غير المنتهية من Firestore إلى الذاكرة."""
+    docs = db.collection("games") \
+        .where(filter=FieldFilter("status", "in", list(ACTIVE_GAME_STATUSES))) \
+        .stream()
+    n = 0
+    with _games_lock:
+        for d in docs:
+            _games.setdefault(d.id, d.to_dict())
+            n += 1
+    return n
 
 
-def queue_try_match(new_user_id, new_name, new_chat_id):
+@firestore.transactional
+def _write_games_chunk(transaction, chunk):
     """
-    محاولة مطابقة ذرّية:
-      - إن وجد منتظراً غيرك → احذفه من الطابور وأرجعه (مباراة!).
-      - إن لم يوجد → أضفك للطابور وأرجع None (انتظار).
-    ذرّية عبر Firestore Transaction لمنع race conditions.
+    يكتب اللقطات داخل Transaction ولا يطغى على وثيقة نسختها أحدث أو مساوية
+    (نسخة أخرى من البوت أو flush أقدم). الحذف غير مشروط.
     """
-    queue_ref = db.collection("queue")
+    col = db.collection("games")
+    refs = [col.document(gid) for gid, data in chunk if data is not None]
+    stored = {}
+    if refs:
+        for snap in transaction.get_all(refs):
+            if snap.exists:
+                stored[snap.id] = (snap.to_dict() or {}).get("version", -1)
+    for gid, data in chunk:
+        ref = col.document(gid)
+        if data is None:
+            transaction.delete(ref)
+        elif data.get("version", 0) > stored.get(gid, -1):
+            transaction.set(ref, data)
+
+
+def flush_games():
+    """يكتب لقطات المباريات المعدّلة (وحذف المحذوفة) على دفعات transactional. يعيد عدد العمليات."""
+    with _games_flush_lock:
+        with _games_lock:
+            if not _games_dirty:
+                return 0
+            ops = []
+            for gid, save in _games_dirty.items():
+                data = _games.get(gid) if save else None
+                ops.append((gid, dict(data) if data is not None else None))
+            _games_dirty.clear()
+
+        written = 0
+        try:
+            for i in range(0, len(ops), 450):
+                _write_games_chunk(db.transaction(), ops[i:i + 450])
+                written += len(ops[i:i + 450])
+        except Exception as e:
+            print(f"⚠️ flush_games: {e}")
+            with _games_lock:
+                for gid, data in ops[written:]:
+                    # لا نطغى على تعديل أحدث وصل أثناء الكتابة
+                    _games_dirty.setdefault(gid, data is not None)
+
+        # إخلاء المباريات المنتهية من الذاكرة بعد حفظها بمدة كافية
+        cutoff = time.time() - FINISHED_GAME_MEMORY_SECONDS
+        with _games_lock:
+            for gid, ts in list(_games_finished_at.items()):
+                if ts < cutoff and gid not in _games_dirty:
+                    _games.pop(gid, None)
+                    _games_finished_at.pop(gid, None)
+        return written
+
+
+def _games_persist_loop():
+    while True:
+        _games_wakeup.wait(GAME_PERSIST_INTERVAL_MS / 1000)
+        _games_wakeup.clear()
+        try:
+            flush_games()
+        except Exception as e:
+            print(f"⚠️ games persist loop: {e}")
 
-    @firestore.transactional
-    def _txn(transaction):
-        # ابحث عن أقدم منتظر غير الـ new_user_id
-        docs = list(queue_ref.order_by("joined_at").limit(5).stream(transaction=transaction))
-        opponent = None
-        for d in docs:
-            if d.id != str(new_user_id):
-                opponent = d
-                break
-        if opponent is not None:
-            transaction.delete(opponent.reference)
-            data = opponent.to_dict()
-            return {"id": opponent.id, **data}
-        # لا يوجد منافس → أضف الداخل للطابور
-        transaction.set(queue_ref.document(str(new_user_id)), {
-            "user_id": int(new_user_id),
-            "name": new_name or "لاعب",
-            "chat_id": int(new_chat_id),
-            "joined_at": firestore.SERVER_TIMESTAMP,
-        })
-        return None
 
-    transaction = db.transaction()
-    return _txn(transaction)
+atexit.register(flush_games)
 
 
-def get_pending_games():
-    """جلب كل المباريات التي لم تنتهِ (waiting | posted | playing) لفحص انتهاء الصلاحية."""
-    docs = db.collection("games") \
-        .where(filter=FieldFilter("status", "in", ["waiting", "posted", "playing"])) \
-        .stream()
-    return [{"id": d.id, **d.to_dict()} for d in docs]
+def games_store_stats():
+    with _games_lock:
+        active = sum(1 for g in _games.values() if g.get("status") in ACTIVE_GAME_STATUSES)
+        return {"in_memory": len(_games), "active": active, "dirty": len(_games_dirty)}
 
 
-def update_game(game_id, data):
-    db.collection("games").document(game_id).update(data)
+# ============================
+# === طابور "العب الآن" ===
+# ============================
 
+# مجموعة queue نسخة دائمة لحوض المطابقة في matchmaking (الذي يطابق من الذاكرة)،
+# تُقرأ مرة عند التشغيل لاستعادة المنتظرين
 
-def delete_game(game_id):
-    db.collection("games").document(game_id).delete()
+def _queue_entry(user_id, name, chat_id, joined_at):
+    return {
+        "user_id": int(user_id),
+        "name": name or "لاعب",
+        "chat_id": int(chat_id),
+        "joined_at": joined_at,
+    }
 
 
-def get_active_game_for_user(uid):
-    """يبحث عن أول مباراة PvP نشطة (playing) للمستخدم — يعيد dict أو None."""
+def queue_add(user_id, name, chat_id, msg_id=None, points=None):
+    """أضف لاعباً للطابور (أو حدّث بياناته إن كان موجوداً)."""
+    entry = _queue_entry(user_id, name, chat_id, firestore.SERVER_TIMESTAMP)
+    if msg_id is not None:
+        entry["msg_id"] = int(msg_id)
+    if points is not None:
+        entry["points"] = int(points)
+    db.collection("queue").document(str(user_id)).set(entry)
+
+
+def queue_remove(user_id):
+    """أزل لاعباً من الطابور (بصمت إن لم يكن موجوداً)."""
     try:
-        # بحث بصفته player_x
-        q1 = db.collection("games") \
-            .where(filter=FieldFilter("status", "==", "playing")) \
-            .where(filter=FieldFilter("player_x_id", "==", int(uid))) \
-            .limit(1).stream()
-        for d in q1:
-            return {"id": d.id, **d.to_dict()}
-        # بحث بصفته player_o
-        q2 = db.collection("games") \
-            .where(filter=FieldFilter("status", "==", "playing")) \
-            .where(filter=FieldFilter("player_o_id", "==", int(uid))) \
-            .limit(1).stream()
-        for d in q2:
-            return {"id": d.id, **d.to_dict()}
-    except Exception as e:
-        print(f"⚠️ get_active_game_for_user: {e}")
-    return None
+        db.collection("queue").document(str(user_id)).delete()
+    except Exception:
+        pass
+
+
+def queue_remove_many(user_ids):
+    """أزل عدة لاعبين في batch واحد."""
+    ids = [str(u) for u in user_ids]
+    if not ids:
+        return
+    batch = db.batch()
+    for k in ids:
+        batch.delete(db.collection("queue").document(k))
+    batch.commit()
+
+
+def queue_load_all():
+    """كل وثائق الطابور (استعلام واحد — لاستعادة حوض المطابقة عند التشغيل)."""
+    return [d.to_dict() or {} for d in db.collection("queue").stream()]
+
 
 # ==========================================
 # === نظام أقسام المساعدة المرنة (Dynamic Help) ===
 # ==========================================
 
 def get_help_sections():
-    """يجلب جميع أقسام المساعدة من قاعدة البيانات."""
+    """يجلب جميع أقسام المساعدة (من نسخة الذاكرة)."""
     try:
-        doc = db.collection("meta").document("help_sections").get()
-        if doc.exists:
-            return doc.to_dict() or {}
-        return {}
+        return _meta_get("help_sections")
     except Exception as e:
         print(f"⚠️ get_help_sections error: {e}")
         return {}
@@ -525,6 +1103,7 @@ def set_help_section(tab_id, title, content):
                 "content": content
             }
         }, merge=True)
+        _meta_patch("help_sections", {tab_id: {"title": title, "content": content}})
         return True
     except Exception as e:
         print(f"⚠️ set_help_section error: {e}")
@@ -537,6 +1116,7 @@ def delete_help_section(tab_id):
         db.collection("meta").document("help_sections").update({
             tab_id: firestore.DELETE_FIELD
         })
+        _meta_patch("help_sections", removed=(tab_id,))
         return True
     except Exception as e:
         print(f"⚠️ delete_help_section error: {e}")
@@ -547,11 +1127,9 @@ def delete_help_section(tab_id):
 # ==========================================
 
 def get_bot_config():
+    """meta/config من الذاكرة (تُحدَّث بالمستمع أو كل META_REFRESH_SECONDS)."""
     try:
-        doc = db.collection("meta").document("config").get()
-        if doc.exists:
-            return doc.to_dict() or {}
-        return {}
+        return _meta_get("config")
     except Exception as e:
         print(f"⚠️ get_bot_config error: {e}")
         return {}
@@ -559,6 +1137,7 @@ def get_bot_config():
 def set_bot_config(key, value):
     try:
         db.collection("meta").document("config").set({key: value}, merge=True)
+        _meta_patch("config", {key: value})
         return True
     except Exception as e:
         print(f"⚠️ set_bot_config error: {e}")
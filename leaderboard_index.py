@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+فهرس لوحة الشرف في الذاكرة:
+  - SortedList على (-points, uid) → أعلى N وترتيب أي لاعب في O(log n)
+  - يُبنى مرة من Firestore ثم يُحدَّث تدريجياً مع كل تغيّر في النقاط
+  - إعادة البناء الدورية (reconcile) تصحّح أي انحراف دون أن تمحو
+    تحديثات وصلت أثناء قراءة Firestore
+"""
+import threading
+
+from sortedcontainers import SortedList
+
+PROFILE_FIELDS = ("user_id", "name", "username")
+
+
+class LeaderboardIndex:
+    def __init__(self):
+        self._sorted = SortedList()   # (-points, uid)
+        self._entries = {}            # uid → {"user_id", "name", "username", "points"}
+        self._touched = None          # أثناء إعادة البناء: uids تغيّرت محلياً
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.drift = 0                # عدد التصحيحات في آخر إعادة بناء
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _put(self, uid, entry):
+        prev = self._entries.get(uid)
+        if prev is not None:
+            self._sorted.remove((-prev["points"], uid))
+        self._entries[uid] = entry
+        self._sorted.add((-entry["points"], uid))
+        if self._touched is not None:
+            self._touched.add(uid)
+
+    def upsert(self, uid, profile=None, points=None):
+        """يحدّث بيانات العرض و/أو النقاط (ينشئ اللاعب إن لم يكن موجوداً)."""
+        uid = str(uid)
+        with self._lock:
+            prev = self._entries.get(uid)
+            entry = dict(prev) if prev else {"user_id": int(uid), "name": "لاعب",
+                                             "username": "", "points": 0}
+            for k in PROFILE_FIELDS:
+                if profile and profile.get(k) is not None:
+                    entry[k] = profile[k]
+            if points is not None:
+                entry["points"] = int(points)
+            if prev is not None and prev == entry:
+                return
+            self._put(uid, entry)
+
+    def add_points(self, uid, delta):
+        """يضيف delta لنقاط لاعب موجود. يعيد False إن لم يكن في الفهرس."""
+        uid = str(uid)
+        with self._lock:
+            prev = self._entries.get(uid)
+            if prev is None:
+                return False
+            if delta:
+                self._put(uid, dict(prev, points=prev["points"] + int(delta)))
+            return True
+
+    def reset_points(self, value=0):
+        """تصفير الجميع (عند بدء موسم جديد)."""
+        with self._lock:
+            for uid, entry in list(self._entries.items()):
+                if entry["points"] != value:
+                    self._put(uid, dict(entry, points=value))
+
+    def nonzero_count(self):
+        """عدد اللاعبين الذين نقاطهم ليست 0."""
+        with self._lock:
+            return (self._sorted.bisect_left((0, ""))
+                    + len(self._sorted) - self._sorted.bisect_left((1, "")))
+
+    def top(self, n):
+        with self._lock:
+            return [{"id": uid, **self._entries[uid]} for _, uid in self._sorted[:max(0, n)]]
+
+    def count_above(self, points):
+        """عدد اللاعبين الذين نقاطهم أعلى من points."""
+        with self._lock:
+            return self._sorted.bisect_left((-int(points), ""))
+
+    def points_of(self, uid):
+        with self._lock:
+            entry = self._entries.get(str(uid))
+            return None if entry is None else entry["points"]
+
+    def begin_rebuild(self):
+        with self._lock:
+            self._touched = set()
+
+    def abort_rebuild(self):
+        with self._lock:
+            self._touched = None
+
+    def finish_rebuild(self, entries):
+        """
+        يستبدل المحتوى بـ entries ({uid: entry} من Firestore)، ما عدا من تغيّر
+        محلياً منذ begin_rebuild (قيمته المحلية أحدث). يعيد عدد التصحيحات.
+        """
+        with self._lock:
+            touched = self._touched or set()
+            self._touched = None
+            drift = 0
+            for uid in [u for u in self._entries if u not in entries and u not in touched]:
+                self._sorted.remove((-self._entries.pop(uid)["points"], uid))
+                drift += 1
+            for uid, entry in entries.items():
+                if uid in touched:
+                    continue
+                prev = self._entries.get(uid)
+                if prev != entry:
+                    if prev is None or prev["points"] != entry["points"]:
+                        drift += 1
+                    self._put(uid, entry)
+            if not self.loaded:
+                drift = 0  # البناء الأول ليس انحرافاً
+            self.loaded = True
+            self.drift = drift
+            return drift
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+محرك مطابقة Quick Match داخل العملية:
+  - حوض انتظار في الذاكرة هو المرجع؛ Firestore (مجموعة queue) للاستمرارية فقط
+  - تمريرة مطابقة دورية (batch) تزاوج اللاعبين حسب نطاق النقاط
+  - النطاق يتّسع مع مدة الانتظار حتى لا يبقى أحد بلا خصم
+"""
+import threading
+from datetime import datetime, timezone
+
+import scheduler
+from firebase_utils import queue_add, queue_load_all, queue_remove_many
+
+MATCH_TICK_SECONDS = 1.0        # الفاصل بين تمريرات المطابقة
+BASE_POINTS_BAND = 50           # فرق النقاط المقبول لحظة الانضمام
+BAND_WIDEN_PER_SECOND = 10      # اتساع النطاق لكل ثانية انتظار
+
+# {uid: {"id", "name", "chat_id", "msg_id", "points", "joined_at"}}
+_pool = {}
+_lock = threading.Lock()
+_on_match = None
+_stats = {"passes": 0, "pairs": 0}
+
+
+def _band(entry, now):
+    waited = (now - entry["joined_at"]).total_seconds()
+    return BASE_POINTS_BAND + BAND_WIDEN_PER_SECOND * max(0.0, waited)
+
+
+def start(on_match):
+    """
+    يسجّل on_match(x_entry, o_entry) ويبدأ التمريرة الدورية على المجدول.
+    الأقدم انتظاراً يلعب ❌ كما في الطابور السابق.
+    """
+    global _on_match
+    _on_match = on_match
+    scheduler.schedule_every("matchmaking", MATCH_TICK_SECONDS, run_pass)
+
+
+def restore():
+    """يعيد بناء الحوض من مجموعة queue (استعلام واحد عند التشغيل). يعيد المدخلات."""
+    restored = []
+    for d in queue_load_all():
+        if not d.get("msg_id"):
+            continue  # وثيقة من النسخة القديمة بلا رسالة بحث — لا يمكن إكمالها
+        joined_at = d.get("joined_at")
+        if not isinstance(joined_at, datetime):
+            joined_at = datetime.now(timezone.utc)
+        elif joined_at.tzinfo is None:
+            joined_at = joined_at.replace(tzinfo=timezone.utc)
+        entry = {
+            "id": int(d["user_id"]),
+            "name": d.get("name") or "لاعب",
+            "chat_id": int(d["chat_id"]),
+            "msg_id": int(d["msg_id"]),
+            "points": int(d.get("points", 0) or 0),
+            "joined_at": joined_at,
+        }
+        restored.append(entry)
+    with _lock:
+        for e in restored:
+            _pool[e["id"]] = e
+    return restored
+
+
+def join(uid, name, chat_id, msg_id, points, joined_at=None):
+    """
+    يضيف اللاعب للحوض (نقرة مكررة تحدّث الرسالة دون تصفير مدة الانتظار).
+    joined_at لمدخل جديد (افتراضياً الآن) — ليطابق جلسة البحث المسجّلة قبله.
+    """
+    uid = int(uid)
+    now = joined_at or datetime.now(timezone.utc)
+    with _lock:
+        prev = _pool.get(uid)
+        entry = {
+            "id": uid,
+            "name": name or "لاعب",
+            "chat_id": int(chat_id),
+            "msg_id": int(msg_id),
+            "points": int(points or 0),
+            "joined_at": prev["joined_at"] if prev else now,
+        }
+        _pool[uid] = entry
+    try:
+        queue_add(uid, entry["name"], chat_id, msg_id=msg_id, points=entry["points"])
+    except Exception as e:
+        print(f"⚠️ matchmaking queue_add: {e}")
+    return dict(entry)
+
+
+def leave(uid):
+    """يزيل اللاعب من الحوض. يعيد False إن لم يكن فيه (ربما زُوِّج للتو)."""
+    with _lock:
+        removed = _pool.pop(int(uid), None) is not None
+    if removed:
+        try:
+            queue_remove_many([uid])
+        except Exception as e:
+            print(f"⚠️ matchmaking queue_remove: {e}")
+    return removed
+
+
+def size():
+    with _lock:
+        return len(_pool)
+
+
+def stats():
+    with _lock:
+        return {"waiting": len(_pool), **_stats}
+
+
+def _pair(entries, now):
+    """مزاوجة جشعة على قائمة مرتّبة بالنقاط: كل لاعبين متجاورين ضمن نطاق أطولهما انتظاراً."""
+    entries = sorted(entries, key=lambda e: (e["points"], e["joined_at"]))
+    pairs = []
+    i = 0
+    while i < len(entries) - 1:
+        a, b = entries[i], entries[i + 1]
+        if abs(a["points"] - b["points"]) <= max(_band(a, now), _band(b, now)):
+            pairs.append((a, b) if a["joined_at"] <= b["joined_at"] else (b, a))
+            i += 2
+        else:
+            i += 1
+    return pairs
+
+
+def run_pass():
+    """تمريرة واحدة: تزاوج من تستطيع، تحذفهم من الحوض، وتسلّمهم لـ on_match."""
+    now = datetime.now(timezone.utc)
+    with _lock:
+        _stats["passes"] += 1
+        if len(_pool) < 2:
+            return 0
+        pairs = _pair(list(_pool.values()), now)
+        for x, o in pairs:
+            _pool.pop(x["id"], None)
+            _pool.pop(o["id"], None)
+        _stats["pairs"] += len(pairs)
+    if not pairs:
+        return 0
+
+    def _dispatch():
+        try:
+            queue_remove_many([p["id"] for pair in pairs for p in pair])
+        except Exception as e:
+            print(f"⚠️ matchmaking queue_remove_many: {e}")
+        for x, o in pairs:
+            try:
+                _on_match(x, o)
+            except Exception as e:
+                print(f"⚠️ matchmaking on_match: {e}")
+
+    # الرسائل لتيليجرام خارج thread المجدول حتى لا تتأخر المهلات الأخرى
+    threading.Thread(target=_dispatch, daemon=True).start()
+    return len(pairs)
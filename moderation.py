@@ -2,12 +2,22 @@
 # -*- coding: utf-8 -*-
 """
 أدوات الإشراف للمالك: حظر/كتم/تحذير/حد المباريات/مكافحة farming
-كل البيانات تُخزَّن في وثيقة المستخدم ضمن مجموعة `users` — لا تُمسح عند تصفير النقاط.
+بيانات الإشراف تُخزَّن في وثيقة المستخدم ضمن مجموعة `users` — لا تُمسح عند تصفير النقاط.
+العدّادات اليومية (المباريات، الأزواج) في وثائق يومية مستقلة: daily_matches و pair_counts.
+حالة الحظر/الكتم تُقرأ من نفس سجل المستخدم المخزّن في كاش firebase_utils،
+وكل كتابة هنا تُبطل ذلك السجل.
 """
 
+import atexit
+import threading
 from datetime import datetime, timezone, timedelta
 from firebase_admin import firestore
-from firebase_utils import db
+from firebase_utils import (
+    db, get_user_stats, invalidate_user, leaderboard_add_points,
+    ensure_current_season, season_view,
+)
+
+import scheduler
 
 
 # ====== قراءة الحالة ======
@@ -16,11 +26,20 @@ def _user_ref(uid):
     return db.collection("users").document(str(uid))
 
 
+def _set_user(uid, data):
+    """كتابة merge لوثيقة المستخدم ثم إبطال نسخته في الكاش."""
+    _user_ref(uid).set(data, merge=True)
+    invalidate_user(uid)
+
+
+def _update_user(uid, data):
+    _user_ref(uid).update(data)
+    invalidate_user(uid)
+
+
 def get_user_doc(uid):
-    doc = _user_ref(uid).get()
-    if doc.exists:
-        return {"id": doc.id, **doc.to_dict()}
-    return None
+    """سجل المستخدم من الكاش المشترك (قراءة Firestore واحدة عند انتهاء صلاحيته)."""
+    return get_user_stats(uid)
 
 
 def is_banned(uid):
@@ -45,7 +64,7 @@ def is_banned(uid):
                 until_dt = until_dt.replace(tzinfo=timezone.utc)
             if until_dt and now >= until_dt:
                 # انتهى الحظر — فكّ تلقائياً
-                _user_ref(uid).update({
+                _update_user(uid, {
                     "banned": False,
                     "ban_until": None,
                 })
@@ -75,7 +94,7 @@ def _log_action(uid, action_type, reason, by):
             "by": int(by) if by else 0,
         })
         log = log[-30:]
-        _user_ref(uid).set({"actions_log": log}, merge=True)
+        _set_user(uid, {"actions_log": log})
     except Exception as e:
         print(f"⚠️ _log_action: {e}")
 
@@ -88,41 +107,43 @@ def ban_user(uid, reason="", duration_hours=None, by=0):
         data["ban_until"] = until
     else:
         data["ban_until"] = None
-    _user_ref(uid).set(data, merge=True)
+    _set_user(uid, data)
     kind = f"ban_{duration_hours}h" if duration_hours else "ban_permanent"
     _log_action(uid, kind, reason, by)
 
 
 def unban_user(uid, by=0):
-    _user_ref(uid).set({"banned": False, "ban_until": None}, merge=True)
+    _set_user(uid, {"banned": False, "ban_until": None})
     _log_action(uid, "unban", "", by)
 
 
 def mute_user(uid, by=0):
-    _user_ref(uid).set({"muted": True}, merge=True)
+    _set_user(uid, {"muted": True})
     _log_action(uid, "mute", "", by)
 
 
 def unmute_user(uid, by=0):
-    _user_ref(uid).set({"muted": False}, merge=True)
+    _set_user(uid, {"muted": False})
     _log_action(uid, "unmute", "", by)
 
 
 def warn_user(uid, reason="", by=0):
     """يزيد عدّاد التحذيرات ويعيد العدد الجديد."""
-    _user_ref(uid).update({"warnings": firestore.Increment(1)})
+    _update_user(uid, {"warnings": firestore.Increment(1)})
     _log_action(uid, "warn", reason, by)
     u = get_user_doc(uid) or {}
     return int(u.get("warnings", 0))
 
 
 def clear_warnings(uid, by=0):
-    _user_ref(uid).set({"warnings": 0}, merge=True)
+    _set_user(uid, {"warnings": 0})
     _log_action(uid, "clear_warnings", "", by)
 
 
 def adjust_points(uid, delta, reason="", by=0):
-    _user_ref(uid).update({"points": firestore.Increment(int(delta))})
+    ensure_current_season(uid)
+    _update_user(uid, {"points": firestore.Increment(int(delta))})
+    leaderboard_add_points(uid, int(delta))
     _log_action(uid, f"points_{'+' if delta >= 0 else ''}{int(delta)}", reason, by)
 
 
@@ -137,7 +158,7 @@ def list_all_users(order_by="created_at"):
     """كل المستخدمين المسجّلين (للمالك). لا يُمسح أحد على التصفير."""
     try:
         docs = list(db.collection("users").stream())
-        users = [{"id": d.id, **d.to_dict()} for d in docs]
+        users = [season_view({"id": d.id, **d.to_dict()}) for d in docs]
         # ترتيب: الأحدث أولاً (الذين ليس لديهم created_at يُوضعون في الآخر)
         def _key(u):
             v = u.get(order_by)
@@ -197,6 +218,108 @@ def _today_str():
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
 
+# عدّادات المباريات اليومية: وثيقة لكل مستخدم لكل يوم daily_matches/{date}_{uid}
+# (اليوم جزء من المفتاح → لا تصفير يدوي، و expire_at لسياسة TTL مثل pair_counts).
+# المسار السريع: مستخدم بعيد عن الحد يُزاد في الذاكرة وتُكتب الزيادات دورياً
+# بـ Increment؛ القريب من الحد يمر بـ Transaction يقرأ ويزيد ذرّياً.
+DAILY_MATCHES_TTL_DAYS = 2
+DAILY_FLUSH_SECONDS = 5
+DAILY_FAST_PATH_MIN_MARGIN = 5      # لا مسار سريع إن كان المتبقي أقل من هذا...
+DAILY_FAST_PATH_MARGIN_RATIO = 0.1  # ...أو من 10% من الحد
+
+_dm_known = {}      # {(date, uid): آخر عدد معروف (مكتوب + معلّق)}
+_dm_pending = {}    # {(date, uid): زيادة لم تُكتب بعد}
+_dm_flushing = set()  # مفاتيح زياداتها في batch لم يكتمل بعد
+_dm_slow = set()      # مفاتيح داخل Transaction الآن (المسار السريع معطّل لها)
+_dm_lock = threading.Lock()
+_dm_cond = threading.Condition(_dm_lock)
+_dm_flush_lock = threading.Lock()
+_dm_key_locks = [threading.Lock() for _ in range(64)]  # Transaction واحد لكل مستخدم
+_dm_flusher_started = False
+_dm_flush_thread = None
+
+
+def _daily_ref(date, uid):
+    return db.collection("daily_matches").document(f"{date}_{uid}")
+
+
+def _daily_fields(date, uid):
+    day_start = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return {
+        "uid": str(uid),
+        "date": date,
+        "expire_at": day_start + timedelta(days=DAILY_MATCHES_TTL_DAYS),
+    }
+
+
+def _ensure_daily_flusher():
+    global _dm_flusher_started
+    if _dm_flusher_started:
+        return
+    _dm_flusher_started = True
+    scheduler.schedule_every("daily_matches_flush", DAILY_FLUSH_SECONDS, _flush_daily_matches_async)
+
+
+def _flush_daily_matches_async():
+    """من المجدول: الـ batch commit على thread مستقل حتى لا يتأخر باقي المؤقّتات."""
+    global _dm_flush_thread
+    if _dm_flush_thread is not None and _dm_flush_thread.is_alive():
+        return  # الكتابة السابقة لم تنتهِ — الزيادات تنتظر الدورة التالية
+    with _dm_lock:
+        if not _dm_pending:
+            return
+    _dm_flush_thread = threading.Thread(target=flush_daily_matches, daemon=True,
+                                        name="daily-matches-flush")
+    _dm_flush_thread.start()
+
+
+def flush_daily_matches():
+    """يكتب زيادات المسار السريع بـ Increment في batch. يعيد عدد الوثائق."""
+    with _dm_flush_lock:
+        today = _today_str()
+        with _dm_lock:
+            ops = list(_dm_pending.items())
+            _dm_pending.clear()
+            _dm_flushing.update(k for k, _ in ops)
+            # أيام سابقة لم تعد مطلوبة في الذاكرة (زياداتها المعلّقة تُكتب الآن)
+            for k in [k for k in _dm_known if k[0] != today]:
+                del _dm_known[k]
+        if not ops:
+            return 0
+        written = 0
+        try:
+            for i in range(0, len(ops), 450):
+                batch = db.batch()
+                for (date, uid), delta in ops[i:i + 450]:
+                    batch.set(_daily_ref(date, uid), {
+                        **_daily_fields(date, uid),
+                        "count": firestore.Increment(delta),
+                    }, merge=True)
+                batch.commit()
+                written += len(ops[i:i + 450])
+        except Exception as e:
+            print(f"⚠️ flush_daily_matches: {e}")
+            with _dm_lock:
+                for k, delta in ops[written:]:
+                    _dm_pending[k] = _dm_pending.get(k, 0) + delta
+        finally:
+            with _dm_cond:
+                _dm_flushing.difference_update(k for k, _ in ops)
+                _dm_cond.notify_all()
+        return written
+
+
+atexit.register(flush_daily_matches)
+
+
+def _legacy_count_today(uid, today):
+    """عدد اليوم من الحقول القديمة matches_today (ليوم النشر فقط)."""
+    u = get_user_doc(uid) or {}
+    if (u.get("matches_today_date") or "") != today:
+        return 0
+    return int(u.get("matches_today", 0) or 0)
+
+
 def check_and_increment_daily_matches(uid, daily_limit):
     """
     يُزيد عدّاد مباريات اليوم إذا ما بلغ الحد.
@@ -205,104 +328,135 @@ def check_and_increment_daily_matches(uid, daily_limit):
     """
     if not daily_limit:
         return True, 0, 0
-    u = get_user_doc(uid) or {}
+    limit = int(daily_limit)
     today = _today_str()
-    cnt = int(u.get("matches_today", 0) or 0)
-    date = u.get("matches_today_date") or ""
-    if date != today:
-        cnt = 0
-    if cnt >= int(daily_limit):
-        return False, cnt, int(daily_limit)
-    _user_ref(uid).set({
-        "matches_today": cnt + 1,
-        "matches_today_date": today,
-    }, merge=True)
-    return True, cnt + 1, int(daily_limit)
-
-
-def record_pair_match(uid1, uid2, pair_limit=3):
-    """
-    يسجّل مباراة بين لاعبَين (بعد انتهائها).
-    يعيد count بعد التسجيل — لو تجاوز الحد فالمفروض تُصدر تنبيه + لا نمنح نقاطاً.
-    """
+    key = (today, str(uid))
+    margin = max(DAILY_FAST_PATH_MIN_MARGIN, int(limit * DAILY_FAST_PATH_MARGIN_RATIO))
+
+    with _dm_lock:
+        known = _dm_known.get(key)
+        if key not in _dm_slow and known is not None and known + 1 <= limit - margin:
+            _dm_known[key] = known + 1
+            _dm_pending[key] = _dm_pending.get(key, 0) + 1
+            fast = True
+        else:
+            fast = False
+    if fast:
+        _ensure_daily_flusher()
+        return True, known + 1, limit
+
+    with _dm_key_locks[hash(key) % len(_dm_key_locks)]:
+        with _dm_cond:
+            # زيادات هذا المستخدم في batch جارٍ يجب أن تصل قبل أن نقرأ العدد
+            while key in _dm_flushing:
+                _dm_cond.wait()
+            _dm_slow.add(key)
+            pending = _dm_pending.pop(key, 0)
+        try:
+            allowed, cnt = _daily_txn(today, uid, limit, pending)
+        except Exception:
+            with _dm_lock:
+                _dm_pending[key] = _dm_pending.get(key, 0) + pending
+                _dm_slow.discard(key)
+            raise
+        with _dm_lock:
+            _dm_known[key] = cnt
+            _dm_slow.discard(key)
+    return allowed, cnt, limit
+
+
+def _daily_txn(today, uid, limit, pending):
+    """يقرأ العدد المخزّن + المعلّق ويزيد إن لم يبلغ الحد — ذرّياً. يعيد (allowed, count)."""
+    ref = _daily_ref(today, uid)
+
+    @firestore.transactional
+    def _txn(transaction):
+        snap = ref.get(transaction=transaction)
+        if snap.exists:
+            stored = int((snap.to_dict() or {}).get("count", 0) or 0)
+        else:
+            stored = _legacy_count_today(uid, today)
+        cnt = stored + pending
+        allowed = cnt < limit
+        if allowed:
+            cnt += 1
+        if cnt != stored or not snap.exists:
+            transaction.set(ref, {**_daily_fields(today, uid), "count": cnt}, merge=True)
+        return allowed, cnt
+
+    return _txn(db.transaction())
+
+
+# عدّادات الأزواج: وثيقة لكل زوج لكل يوم في مجموعة pair_counts بمعرّف {date}_{a}_{b}
+# تُحدَّث بـ Increment (بلا قراءة ثم كتابة، وبلا وثيقة مركزية يتزاحم عليها الجميع).
+# الحقل expire_at مخصّص لسياسة TTL في Firestore (تُفعَّل مرة من الكونسول على
+# مجموعة pair_counts) فتُحذف وثائق الأيام الماضية تلقائياً.
+PAIR_COUNTS_TTL_DAYS = 2
+
+
+def _pair_ref(uid1, uid2):
+    """يعيد (ref, a, b, today) أو None لزوج غير صالح (نفس اللاعب / معرّف فارغ)."""
     if not (uid1 and uid2) or int(uid1) == int(uid2):
-        return 0
+        return None
     a, b = sorted([str(uid1), str(uid2)])
-    key = f"{a}_{b}"
     today = _today_str()
-    ref = db.collection("meta").document("pair_counts")
-    try:
-        snap = ref.get()
-        data = snap.to_dict() if snap.exists else {}
-        date = data.get("_date") or ""
-        if date != today:
-            # تصفير يومي
-            data = {"_date": today}
-        cnt = int(data.get(key, 0) or 0) + 1
-        data[key] = cnt
-        data["_date"] = today
-        ref.set(data)
-        return cnt
-    except Exception as e:
-        print(f"⚠️ record_pair_match: {e}")
-        return 0
+    ref = db.collection("pair_counts").document(f"{today}_{a}_{b}")
+    return ref, a, b, today
+
+
+def _bump_pair(uid1, uid2, field, amount):
+    """كتابة Increment واحدة بلا قراءة لاحقة — من يحتاج القيمة يقرأها بـ _read_pair."""
+    target = _pair_ref(uid1, uid2)
+    if target is None:
+        return
+    ref, a, b, today = target
+    day_start = datetime.strptime(today, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    ref.set({
+        "a": a,
+        "b": b,
+        "date": today,
+        "expire_at": day_start + timedelta(days=PAIR_COUNTS_TTL_DAYS),
+        field: firestore.Increment(int(amount)),
+    }, merge=True)
 
 
-def get_pair_count(uid1, uid2):
+def _read_pair(uid1, uid2, field):
     if not (uid1 and uid2):
         return 0
-    a, b = sorted([str(uid1), str(uid2)])
-    key = f"{a}_{b}"
-    today = _today_str()
+    target = _pair_ref(uid1, uid2)
+    if target is None:
+        return 0
     try:
-        snap = db.collection("meta").document("pair_counts").get()
+        snap = target[0].get()
         if not snap.exists:
             return 0
-        data = snap.to_dict() or {}
-        if data.get("_date") != today:
-            return 0
-        return int(data.get(key, 0) or 0)
+        return int((snap.to_dict() or {}).get(field, 0) or 0)
     except Exception:
         return 0
 
 
+def record_pair_match(uid1, uid2, pair_limit=3):
+    """
+    يسجّل مباراة بين لاعبَين (بعد انتهائها). العدد الحالي من get_pair_count.
+    """
+    try:
+        _bump_pair(uid1, uid2, "count", 1)
+    except Exception as e:
+        print(f"⚠️ record_pair_match: {e}")
+
+
+def get_pair_count(uid1, uid2):
+    return _read_pair(uid1, uid2, "count")
+
+
 def get_pair_points(uid1, uid2):
     """يُرجع مجموع النقاط الممنوحة لكل لاعب من الزوج اليوم."""
-    if not (uid1 and uid2):
-        return 0
-    a, b = sorted([str(uid1), str(uid2)])
-    key = f"{a}_{b}_pts"
-    today = _today_str()
-    try:
-        snap = db.collection("meta").document("pair_counts").get()
-        if not snap.exists:
-            return 0
-        data = snap.to_dict() or {}
-        if data.get("_date") != today:
-            return 0
-        return int(data.get(key, 0) or 0)
-    except Exception:
-        return 0
+    return _read_pair(uid1, uid2, "points")
 
 
 def add_pair_points(uid1, uid2, pts):
-    """يضيف pts إلى عدّاد نقاط الزوج اليوم. يعيد المجموع بعد الإضافة."""
-    if not (uid1 and uid2) or int(uid1) == int(uid2):
-        return 0
-    a, b = sorted([str(uid1), str(uid2)])
-    key = f"{a}_{b}_pts"
-    today = _today_str()
-    ref = db.collection("meta").document("pair_counts")
+    """يضيف pts إلى عدّاد نقاط الزوج اليوم (المجموع من get_pair_points)."""
     try:
-        snap = ref.get()
-        data = snap.to_dict() if snap.exists else {}
-        if data.get("_date") != today:
-            data = {"_date": today}
-        new_total = int(data.get(key, 0) or 0) + int(pts)
-        data[key] = new_total
-        data["_date"] = today
-        ref.set(data, merge=True)
-        return new_total
+        _bump_pair(uid1, uid2, "points", pts)
     except Exception as e:
         print(f"⚠️ add_pair_points: {e}")
-        return 0
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+مجدول مهام زمنية موحّد قائم على heap:
+  - كل مهمة لها مفتاح فريد؛ إعادة الجدولة بنفس المفتاح تستبدل الموعد السابق
+  - thread واحد ينام حتى أقرب موعد بالضبط (بدل الاستطلاع الدوري في كل وحدة)
+  - مهام لمرة واحدة (schedule_at / schedule_in) ومهام دورية (schedule_every)
+  - الإلغاء كسول: المدخلات القديمة في الـ heap تُتجاهل عند خروجها
+  - قياس التأخر (lag): الفرق بين الموعد المطلوب ولحظة التنفيذ الفعلية
+"""
+import heapq
+import itertools
+import threading
+import time
+
+_heap = []     # (when_ts, seq, key)
+_tasks = {}    # key -> (when_ts, seq, fn, args, interval)
+_seq = itertools.count()
+_cond = threading.Condition()
+_thread = None
+
+_stats = {"fired": 0, "errors": 0, "lag_last": 0.0, "lag_max": 0.0, "lag_total": 0.0}
+
+
+def _push(key, when_ts, fn, args, interval):
+    seq = next(_seq)
+    _tasks[key] = (when_ts, seq, fn, args, interval)
+    heapq.heappush(_heap, (when_ts, seq, key))
+
+
+def schedule_at(key, when_ts, fn, *args):
+    """يجدول fn(*args) عند when_ts (ثوانٍ epoch). يستبدل أي مهمة سابقة بنفس المفتاح."""
+    with _cond:
+        _push(key, when_ts, fn, args, None)
+        _cond.notify()
+    _ensure_thread()
+
+
+def schedule_in(key, delay_seconds, fn, *args):
+    schedule_at(key, time.time() + delay_seconds, fn, *args)
+
+
+def schedule_every(key, interval_seconds, fn, *args, first_delay=None):
+    """
+    يجدول fn(*args) كل interval_seconds (أول تنفيذ بعد first_delay أو بعد interval).
+    المواعيد تُحسب من الموعد السابق لا من نهاية التنفيذ، مع تخطّي ما فات.
+    """
+    first = interval_seconds if first_delay is None else first_delay
+    with _cond:
+        _push(key, time.time() + first, fn, args, float(interval_seconds))
+        _cond.notify()
+    _ensure_thread()
+
+
+def cancel(key):
+    """يلغي المهمة إن وُجدت. يعيد True إن كانت مجدولة."""
+    with _cond:
+        return _tasks.pop(key, None) is not None
+
+
+def is_scheduled(key):
+    with _cond:
+        return key in _tasks
+
+
+def pending_count():
+    with _cond:
+        return len(_tasks)
+
+
+def stats():
+    """عدد المهام المعلّقة والمنفّذة والأخطاء، وتأخر التنفيذ بالمللي ثانية."""
+    with _cond:
+        fired = _stats["fired"]
+        return {
+            "pending": len(_tasks),
+            "heap": len(_heap),
+            "fired": fired,
+            "errors": _stats["errors"],
+            "lag_last_ms": _stats["lag_last"] * 1000,
+            "lag_max_ms": _stats["lag_max"] * 1000,
+            "lag_avg_ms": (_stats["lag_total"] / fired * 1000) if fired else 0.0,
+        }
+
+
+def _ensure_thread():
+    global _thread
+    with _cond:
+        if _thread is not None:
+            return
+        _thread = threading.Thread(target=_run, daemon=True, name="scheduler")
+        _thread.start()
+
+
+def _run():
+    while True:
+        with _cond:
+            while True:
+                if not _heap:
+                    _cond.wait()
+                    continue
+                when_ts, seq, key = _heap[0]
+                task = _tasks.get(key)
+                if task is None or task[1] != seq:
+                    heapq.heappop(_heap)  # أُلغيت أو أُعيدت جدولتها
+                    continue
+                now = time.time()
+                delay = when_ts - now
+                if delay > 0:
+                    _cond.wait(delay)
+                    continue
+                heapq.heappop(_heap)
+                fn, args, interval = task[2], task[3], task[4]
+                if interval:
+                    nxt = when_ts + interval
+                    if nxt <= now:
+                        nxt = now + interval
+                    _push(key, nxt, fn, args, interval)
+                else:
+                    del _tasks[key]
+                lag = now - when_ts
+                _stats["fired"] += 1
+                _stats["lag_last"] = lag
+                _stats["lag_total"] += lag
+                if lag > _stats["lag_max"]:
+                    _stats["lag_max"] = lag
+                break
+        try:
+            fn(*args)
+        except Exception as e:
+            with _cond:
+                _stats["errors"] += 1
+            print(f"⚠️ scheduler task {key}: {e}")
@@ -9,6 +9,8 @@ import base64
 import hashlib
 import time
 
+import scheduler
+
 # ====== Fernet (تشفير الحقول الحساسة) ======
 _fernet_cache = {"obj": None, "tried": False}
 
@@ -141,15 +143,24 @@ TWOFA_TTL = 120  # ثانية
 
 
 def request_2fa(uid, action: str):
-    """يبدأ طلب 2FA — يعيد True إذا تم التسجيل."""
-    _pending_2fa[uid] = {
+    """يبدأ طلب 2FA — يعيد True إذا تم التسجيل. ينتهي تلقائياً عبر المجدول."""
+    now = time.time()
+    entry = {
         "action": action,
-        "ts": time.time(),
-        "expires": time.time() + TWOFA_TTL,
+        "ts": now,
+        "expires": now + TWOFA_TTL,
     }
+    _pending_2fa[uid] = entry
+    scheduler.schedule_at(f"2fa:{uid}", entry["expires"], _expire_2fa, uid, entry)
     return True
 
 
+def _expire_2fa(uid, entry):
+    # لا نحذف طلباً أحدث سُجّل لنفس المستخدم بعد هذا الموعد
+    if _pending_2fa.get(uid) is entry:
+        _pending_2fa.pop(uid, None)
+
+
 def get_pending_2fa(uid):
     """يعيد طلب 2FA المعلّق إن وُجد ولم تنتهِ صلاحيته."""
     p = _pending_2fa.get(uid)
@@ -162,8 +173,10 @@ def get_pending_2fa(uid):
 
 
 def consume_2fa(uid):
+    scheduler.cancel(f"2fa:{uid}")
     return _pending_2fa.pop(uid, None)
 
 
 def cancel_2fa(uid):
+    scheduler.cancel(f"2fa:{uid}")
     _pending_2fa.pop(uid, None)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+اختبار ضغط لـ compare-and-set على مباريات PvP (بلا Firestore ولا تيليجرام حقيقيين):
+  - 40 حركة متزامنة فائزة على نفس النسخة → تنجح واحدة فقط
+  - 10 استدعاءات finalize_pvp متزامنة → تُسجَّل النتيجة مرة واحدة
+  - انتهاء صلاحية تحدٍّ ضد انضمام متزامن → ينجح أحدهما فقط
+  - handle_join_game من لاعبَين معاً → خصم واحد، ومؤقّت الانتهاء يُلغى
+  - handle_join_game ضد on_chosen_inline → لا يعود "playing" إلى "posted"
+
+يُثبَّت Firestore وهمي في الذاكرة مكان firebase_admin قبل استيراد البوت،
+ويُستبدل عميل تيليجرام بعميل صامت. يفشل (AssertionError) عند أي سباق.
+
+    python stress_pvp_cas.py
+"""
+import copy
+import os
+import sys
+import threading
+import time
+import types
+
+
+# ====== Firestore وهمي ======
+
+class _Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class _Snap:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class _Ref:
+    def __init__(self, store, path, doc_id):
+        self.store, self.path, self.id = store, path, str(doc_id)
+
+    def get(self, transaction=None):
+        with self.store.lock:
+            return _Snap(self, self.store.docs.get((self.path, self.id)))
+
+    def set(self, data, merge=False):
+        with self.store.lock:
+            key = (self.path, self.id)
+            doc = dict(self.store.docs.get(key) or {}) if merge else {}
+            for k, v in data.items():
+                doc[k] = doc.get(k, 0) + v.value if isinstance(v, _Increment) else v
+            self.store.docs[key] = doc
+
+    def update(self, data):
+        with self.store.lock:
+            if (self.path, self.id) not in self.store.docs:
+                raise KeyError(f"{self.path}/{self.id}")
+            self.set(data, merge=True)
+
+    def delete(self):
+        with self.store.lock:
+            self.store.docs.pop((self.path, self.id), None)
+
+    def collection(self, name):
+        return _Query(self.store, f"{self.path}/{self.id}/{name}")
+
+
+class _Query:
+    def __init__(self, store, path, filters=(), limit=None):
+        self.store, self.path, self.filters, self._limit = store, path, list(filters), limit
+
+    def document(self, doc_id=None):
+        return _Ref(self.store, self.path, doc_id)
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field, filter.op, filter.value
+        return _Query(self.store, self.path, self.filters + [(field, op, value)], self._limit)
+
+    def order_by(self, *_a, **_k):
+        return self
+
+    def select(self, _fields):
+        return self
+
+    def start_after(self, _snap):
+        return self
+
+    def limit(self, n):
+        return _Query(self.store, self.path, self.filters, n)
+
+    def stream(self, transaction=None):
+        ops = {"==": lambda a, b: a == b, "!=": lambda a, b: a != b,
+               "in": lambda a, b: a in b, ">": lambda a, b: a > b}
+        with self.store.lock:
+            rows = [(k[1], v) for k, v in self.store.docs.items() if k[0] == self.path]
+        for field, op, value in self.filters:
+            rows = [(i, v) for i, v in rows if field in v and ops[op](v[field], value)]
+        rows = rows[:self._limit] if self._limit else rows
+        return [_Snap(_Ref(self.store, self.path, i), copy.deepcopy(v)) for i, v in rows]
+
+    def get(self):
+        return self.stream()
+
+
+class _Batch:
+    def __init__(self, store):
+        self.store, self.ops = store, []
+
+    def set(self, ref, data, merge=False):
+        self.ops.append(lambda: ref.set(data, merge=merge))
+
+    def update(self, ref, data):
+        self.ops.append(lambda: ref.update(data))
+
+    def delete(self, ref):
+        self.ops.append(ref.delete)
+
+    def commit(self):
+        with self.store.lock:
+            for op in self.ops:
+                op()
+
+
+class _Transaction(_Batch):
+    def get_all(self, refs):
+        return [r.get() for r in refs]
+
+    def get(self, ref):
+        return ref.get()
+
+
+class FakeStore:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.RLock()
+
+    def collection(self, name):
+        return _Query(self, name)
+
+    def batch(self):
+        return _Batch(self)
+
+    def transaction(self):
+        return _Transaction(self)
+
+
+def _transactional(fn):
+    # القفل العام يجعل كل Transaction متسلسلاً — يكافئ إعادة المحاولة عند التعارض
+    def _run(transaction, *args, **kwargs):
+        with STORE.lock:
+            result = fn(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return _run
+
+
+STORE = FakeStore()
+
+
+def install_fake_firestore():
+    fa = types.ModuleType("firebase_admin")
+    fa.initialize_app = lambda *a, **k: None
+    cred = types.ModuleType("firebase_admin.credentials")
+    cred.Certificate = lambda _d: None
+    fs = types.ModuleType("firebase_admin.firestore")
+    fs.client = lambda: STORE
+    fs.SERVER_TIMESTAMP = "SERVER_TIMESTAMP"
+    fs.DELETE_FIELD = object()
+    fs.Increment = _Increment
+    fs.transactional = _transactional
+    fs.Query = types.SimpleNamespace(DESCENDING="DESCENDING", ASCENDING="ASCENDING")
+    fa.credentials, fa.firestore = cred, fs
+    bq = types.ModuleType("google.cloud.firestore_v1.base_query")
+
+    class FieldFilter:
+        def __init__(self, field, op, value):
+            self.field, self.op, self.value = field, op, value
+
+    bq.FieldFilter = FieldFilter
+    modules = {
+        "firebase_admin": fa, "firebase_admin.credentials": cred, "firebase_admin.firestore": fs,
+        "google": types.ModuleType("google"), "google.cloud": types.ModuleType("google.cloud"),
+        "google.cloud.firestore_v1": types.ModuleType("google.cloud.firestore_v1"),
+        "google.cloud.firestore_v1.base_query": bq,
+    }
+    sys.modules.update(modules)
+    os.environ.setdefault("FIREBASE_CREDENTIALS", "{}")
+    os.environ.setdefault("BOT_TOKEN", "0:stress")
+
+
+class _SilentTelegram:
+    """يرد فوراً على send/edit دون شبكة."""
+
+    def __init__(self):
+        self._ids = iter(range(1, 10**9))
+        self.sent = []   # (chat_id, text)
+
+    def send_message(self, chat_id, text, **_kw):
+        self.sent.append((chat_id, text))
+        return types.SimpleNamespace(message_id=next(self._ids), chat=types.SimpleNamespace(id=chat_id))
+
+    def edit_message_text(self, text, **_kw):
+        return True
+
+
+# ====== السيناريوهات ======
+
+def _race(n, fn):
+    """يشغّل fn(i) في n thread تنطلق معاً ويعيد النتائج."""
+    start = threading.Barrier(n)
+    results = [None] * n
+
+    def _worker(i):
+        start.wait()
+        results[i] = fn(i)
+
+    threads = [threading.Thread(target=_worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _new_playing_game(fu, game_id, px, po):
+    fu.create_game_symbol(game_id, px, "X", "X")
+    game = fu.get_game(game_id)
+    assert fu.update_game_cas(game_id, game["version"], {
+        "player_o_id": po, "player_o_name": "O", "status": "playing",
+        "board": "XX-OO----", "turn": "X",
+    })
+    return fu.get_game(game_id)
+
+
+def stress_moves(fu, n=40):
+    game = _new_playing_game(fu, "stress-moves", 101, 102)
+    version = game["version"]
+    wins = _race(n, lambda i: fu.update_game_cas("stress-moves", version, {
+        "board": "XXXOO----", "status": "finished", "winner": "X", "mover": i,
+    }))
+    after = fu.get_game("stress-moves")
+    assert wins.count(True) == 1, f"{wins.count(True)} حركات نجحت بدل 1"
+    assert after["version"] == version + 1, after["version"]
+    print(f"✅ {n} حركة متزامنة → فائز واحد (mover={after['mover']})")
+
+
+def stress_finalize(bot, fu, n=10):
+    px, po = 201, 202
+    _new_playing_game(fu, "stress-finalize", px, po)
+    _race(n, lambda _i: bot.finalize_pvp("stress-finalize", "X", wait=False))
+    fu.flush_pending_writes()
+    x = STORE.docs.get(("users", str(px)), {})
+    o = STORE.docs.get(("users", str(po)), {})
+    assert x.get("pvp_wins") == 1 and x.get("wins") == 1, x
+    assert o.get("pvp_losses") == 1 and o.get("losses") == 1, o
+    assert fu.get_game("stress-finalize")["status"] == "finished"
+    print(f"✅ {n} استدعاء finalize_pvp متزامن → نتيجة واحدة مسجّلة")
+
+
+def stress_expire_vs_join(bot, fu, rounds=50):
+    for r in range(rounds):
+        game_id = f"stress-expire-{r}"
+        fu.create_game_symbol(game_id, 301, "X", "X")
+        version = fu.get_game(game_id)["version"]
+        joined, expired = _race(2, lambda i: (
+            fu.update_game_cas(game_id, version, {"player_o_id": 302, "status": "playing"})
+            if i == 0 else bot.expire_game(game_id, "⌛", wait=False, expected_version=version)
+        ))
+        game = fu.get_game(game_id)
+        assert joined != expired, (r, joined, expired)
+        assert (game is not None and game["status"] == "playing") == joined, (r, game)
+        if game:
+            fu.delete_game(game_id)
+    print(f"✅ {rounds} سباق انتهاء/انضمام → نتيجة واحدة في كل مرة")
+
+
+def _drain_outbound(timeout=10):
+    """ينتظر حتى يفرغ طابور telegram_io — الإرسال الافتراضي لا ينتظر النتيجة."""
+    import telegram_io
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        st = telegram_io.stats()
+        if not st["queued"] and not st["busy_chats"]:
+            return
+        time.sleep(0.005)
+    raise AssertionError("طابور telegram_io لم يفرغ")
+
+
+def _new_challenge(bot, fu, game_id, creator):
+    fu.create_game(game_id, creator, "X", creator)
+    fu.update_game(game_id, {"x_msg_id": 1})
+    bot.arm_challenge_expiry(game_id)
+
+
+def stress_join_handlers(bot, fu, scheduler, tg, rounds=30):
+    for r in range(rounds):
+        game_id = f"stress-join-{r}"
+        creator, a, b = 400000 + r * 3, 400001 + r * 3, 400002 + r * 3
+        _new_challenge(bot, fu, game_id, creator)
+        _race(2, lambda i: bot.handle_join_game((a, b)[i], f"P{i}", game_id))
+        game = fu.get_game(game_id)
+        assert game["status"] == "playing" and game["player_o_id"] in (a, b), (r, game)
+        loser = b if game["player_o_id"] == a else a
+        _drain_outbound()
+        assert [t for c, t in tg.sent if c == loser] == ["⚠️ هذا التحدّي بدأ بالفعل أو انتهى."], \
+            (r, "الخاسر حصل على لوح أيضاً")
+        assert game.get("o_chat_id") == game["player_o_id"], (r, game)
+        assert not scheduler.is_scheduled(f"expire:{game_id}"), r
+        fu.delete_game(game_id)
+    print(f"✅ {rounds} انضمام متزامن عبر handle_join_game → خصم واحد وبلا مؤقّت انتهاء")
+
+
+def stress_join_vs_chosen_inline(bot, fu, rounds=30):
+    """
+    أسوأ تداخل بالقوة: on_chosen_inline يقرأ المباراة (waiting) ثم يتوقف حتى
+    ينضم الخصم، ثم يكمل الكتابة — يجب ألا يعيد "playing" إلى "posted".
+    """
+    real_get_game = bot.get_game
+    for r in range(rounds):
+        game_id = f"stress-inline-{r}"
+        creator, joiner = 500000 + r * 2, 500001 + r * 2
+        _new_challenge(bot, fu, game_id, creator)
+        read_done, joined = threading.Event(), threading.Event()
+
+        def _paused_get_game(gid):
+            game = real_get_game(gid)
+            if threading.current_thread().name == "chosen" and not read_done.is_set():
+                read_done.set()
+                joined.wait(5)
+            return game
+
+        bot.get_game = _paused_get_game
+        chosen = types.SimpleNamespace(result_id=game_id, inline_message_id=f"im-{r}")
+        t = threading.Thread(target=bot.on_chosen_inline, args=(chosen,), name="chosen")
+        try:
+            t.start()
+            read_done.wait(5)
+            bot.handle_join_game(joiner, "O", game_id)
+            joined.set()
+            t.join()
+        finally:
+            bot.get_game = real_get_game
+        game = fu.get_game(game_id)
+        assert game["player_o_id"] == joiner and game["status"] == "playing", (r, game)
+        assert game.get("inline_message_id") == f"im-{r}", (r, game)
+        fu.delete_game(game_id)
+    print(f"✅ {rounds} انضمام بين قراءة chosen_inline_result وكتابته → تبقى playing")
+
+
+def main():
+    install_fake_firestore()
+    import firebase_utils as fu
+    import telegram_io
+    import bot
+    import scheduler
+
+    tg = _SilentTelegram()
+    telegram_io.init(tg)
+    stress_moves(fu)
+    stress_finalize(bot, fu)
+    stress_expire_vs_join(bot, fu)
+    stress_join_handlers(bot, fu, scheduler, tg)
+    stress_join_vs_chosen_inline(bot, fu)
+    telegram_io.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+موزّع الرسائل الصادرة لتيليجرام:
+  - pool محدود من الـ threads يرسل الطلبات لمحادثات مختلفة بالتوازي
+  - تنظيم المعدّل (token bucket) لكل محادثة وعلى مستوى البوت كله
+  - عند 429 يُحترم retry_after: تتوقف المحادثة مؤقتاً ويُعاد الطلب لاحقاً
+  - التعديلات المعلّقة لنفس الرسالة تُدمج: يُرسل الأحدث فقط
+  - طلب واحد جارٍ لكل محادثة في كل لحظة → الترتيب داخل المحادثة محفوظ
+  - الافتراضي إطلاق دون انتظار (لا ينام عامل التحديثات على تنظيم المعدّل)؛
+    wait=True فقط لمن يحتاج Message أو الاستثناء
+  - ذاكرة آخر محتوى لكل رسالة: تعديل مطابق لما أُرسل لا يصل لتيليجرام أصلاً
+"""
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait as _wait_futures
+
+from cache_utils import LRUTTLCache
+
+OUTBOUND_WORKERS = 8        # أقصى عدد طلبات HTTP متزامنة لتيليجرام
+OUTBOUND_WAIT_TIMEOUT = 60  # أقصى انتظار (ثوانٍ) عند wait=True
+
+GLOBAL_RATE, GLOBAL_BURST = 30.0, 30        # رسالة/ثانية للبوت كله
+PRIVATE_RATE, PRIVATE_BURST = 1.0, 3        # لكل محادثة خاصة (أو رسالة inline)
+GROUP_RATE, GROUP_BURST = 20 / 60.0, 5      # لكل مجموعة
+CHAT_BUCKETS_MAX_ENTRIES = 50_000   # محادثات نتذكر دلوها
+CHAT_BUCKET_IDLE_TTL = 60           # > burst/rate لأي نوع: الدلو الخامل ممتلئ فلا فرق بحذفه
+MAX_RATE_LIMIT_RETRIES = 5
+
+RENDER_CACHE_MAX_ENTRIES = 20_000   # رسائل نتذكر آخر محتوى لها
+RENDER_CACHE_TTL = 6 * 3600         # بعدها يُرسل التعديل حتى لو طابق
+_RENDER_FIELDS = ("parse_mode", "reply_markup", "entities",
+                  "disable_web_page_preview", "link_preview_options")
+
+_bot = None
+_executor = ThreadPoolExecutor(max_workers=OUTBOUND_WORKERS, thread_name_prefix="tg-out")
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """الثواني المتبقية حتى يتوفر رمز (0 = متاح الآن)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Op:
+    __slots__ = ("fn", "args", "kwargs", "chat", "msg", "label", "future", "retries",
+                 "render")
+
+    def __init__(self, fn, args, kwargs, chat, msg, label, render=None):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.chat = chat
+        self.msg = msg
+        self.label = label
+        self.future = Future()
+        self.retries = 0
+        self.render = render
+
+
+def _render_hash(text, kwargs):
+    """hash للنص والأزرار وخيارات العرض — ما يظهر للمستخدم فقط."""
+    parts = [text]
+    for f in _RENDER_FIELDS:
+        v = kwargs.get(f)
+        if v is not None and hasattr(v, "to_json"):
+            v = v.to_json()
+        parts.append(v if v is None or isinstance(v, (str, int, bool)) else repr(v))
+    return hash(tuple(parts))
+
+
+_cond = threading.Condition()
+_queue = deque()         # _Op بترتيب الوصول
+_queued_edits = {}       # msg key → _Op معلّق (لم يبدأ إرساله)
+_busy_chats = set()      # محادثات لديها طلب جارٍ
+_blocked_until = {}      # chat → monotonic (بعد 429)
+_chat_buckets = LRUTTLCache(max_entries=CHAT_BUCKETS_MAX_ENTRIES, ttl=CHAT_BUCKET_IDLE_TTL)
+_global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+_thread = None
+_stats = {"sent": 0, "coalesced": 0, "rate_limited": 0, "failed": 0, "unchanged": 0}
+
+# msg key → hash آخر محتوى مطلوب (أُرسل أو بالطابور)
+_render_cache = LRUTTLCache(max_entries=RENDER_CACHE_MAX_ENTRIES, ttl=RENDER_CACHE_TTL)
+
+
+def init(bot):
+    """يربط الموزّع بنسخة TeleBot ويبدأ thread التوزيع."""
+    global _bot, _thread
+    _bot = bot
+    with _cond:
+        if _thread is None:
+            _thread = threading.Thread(target=_dispatch_loop, daemon=True, name="tg-dispatch")
+            _thread.start()
+
+
+def _bucket_for(chat):
+    b = _chat_buckets.get(chat)
+    if b is None:
+        if isinstance(chat, int) and chat < 0:
+            b = TokenBucket(GROUP_RATE, GROUP_BURST)
+        else:
+            b = TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+        _chat_buckets.set(chat, b)
+    return b
+
+
+def _chat_key(chat_id):
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id
+
+
+def _enqueue(op):
+    with _cond:
+        if op.msg is not None:
+            if _render_cache.get(op.msg) == op.render:
+                _stats["unchanged"] += 1
+                op.future.set_result(None)
+                return op.future
+            _render_cache.set(op.msg, op.render)
+        if op.msg is not None:
+            prev = _queued_edits.get(op.msg)
+            if prev is not None:
+                # تعديل أحدث لنفس الرسالة: استبدل الحمولة واحتفظ بمكانها في الطابور
+                prev_future = prev.future
+                prev.fn, prev.args, prev.kwargs = op.fn, op.args, op.kwargs
+                prev.label, prev.future, prev.render = op.label, op.future, op.render
+                _stats["coalesced"] += 1
+                prev_future.set_result(None)
+                return op.future
+            _queued_edits[op.msg] = op
+        _queue.append(op)
+        _cond.notify()
+    return op.future
+
+
+def _next_ready(now):
+    """أول طلب جاهز للإرسال (أو None) + أقصر مدة انتظار حتى يجهز طلب ما."""
+    soonest = None
+    for op in _queue:
+        if op.chat in _busy_chats:
+            continue
+        blocked = _blocked_until.get(op.chat, 0) - now
+        if blocked > 0:
+            soonest = blocked if soonest is None else min(soonest, blocked)
+            continue
+        wait_chat = _bucket_for(op.chat).wait_time(now)
+        if wait_chat > 0:
+            soonest = wait_chat if soonest is None else min(soonest, wait_chat)
+            continue
+        wait_global = _global_bucket.wait_time(now)
+        if wait_global > 0:
+            return None, wait_global
+        return op, 0.0
+    return None, soonest
+
+
+def _dispatch_loop():
+    while True:
+        with _cond:
+            while True:
+                op, delay = _next_ready(time.monotonic())
+                if op is not None:
+                    break
+                _cond.wait(delay)
+            _queue.remove(op)
+            if op.msg is not None and _queued_edits.get(op.msg) is op:
+                del _queued_edits[op.msg]
+            _busy_chats.add(op.chat)
+            bucket = _bucket_for(op.chat)
+            bucket.take()
+            _chat_buckets.set(op.chat, bucket)  # تجديد المهلة: الدلو يُحذف بعد خموله فقط
+            _global_bucket.take()
+        _executor.submit(_execute, op)
+
+
+def _retry_after(exc):
+    if getattr(exc, "error_code", None) != 429:
+        return None
+    params = (getattr(exc, "result_json", None) or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+
+def _execute(op):
+    requeued = False
+    try:
+        result = op.fn(*op.args, **op.kwargs)
+    except Exception as e:
+        retry_after = _retry_after(e)
+        if retry_after is not None and op.retries < MAX_RATE_LIMIT_RETRIES:
+            op.retries += 1
+            with _cond:
+                _stats["rate_limited"] += 1
+                _blocked_until[op.chat] = time.monotonic() + retry_after
+                newer = _queued_edits.get(op.msg) if op.msg is not None else None
+                if newer is not None:
+                    # وصل تعديل أحدث أثناء الإرسال — هذا الطلب لم يعد مطلوباً
+                    op.future.set_result(None)
+                else:
+                    if op.msg is not None:
+                        _queued_edits[op.msg] = op
+                    _queue.appendleft(op)
+                requeued = True
+            return
+        if "message is not modified" in str(e):
+            op.future.set_result(None)
+            return
+        with _cond:
+            _stats["failed"] += 1
+            if op.msg is not None and _render_cache.get(op.msg) == op.render:
+                _render_cache.pop(op.msg)
+        if op.label:
+            print(f"⚠️ {op.label}: {e}")
+        op.future.set_exception(e)
+        return
+    finally:
+        with _cond:
+            _busy_chats.discard(op.chat)
+            if not requeued:
+                _blocked_until.pop(op.chat, None)
+            _cond.notify()
+    with _cond:
+        _stats["sent"] += 1
+    if op.msg is None and op.render is not None and getattr(result, "message_id", None):
+        # رسالة جديدة: تعديل لاحق بنفس المحتوى لا حاجة له
+        _render_cache.set((op.chat, result.message_id), op.render)
+    op.future.set_result(result)
+
+
+def _result(future, wait):
+    if not wait:
+        return future
+    return future.result(timeout=OUTBOUND_WAIT_TIMEOUT)
+
+
+def send_message(chat_id, text, wait=False, label=None, **kwargs):
+    """
+    bot.send_message عبر الموزّع. يعيد Future فوراً (وتُطبع الأخطاء مع label)،
+    ومع wait=True يعيد Message أو يرفع الاستثناء كما يفعل telebot.
+    """
+    if not wait:
+        label = label or "send_message"  # لا أحد ينتظر الاستثناء: اطبعه على الأقل
+    op = _Op(_bot.send_message, (chat_id, text), kwargs, _chat_key(chat_id), None, label,
+             render=_render_hash(text, kwargs))
+    return _result(_enqueue(op), wait)
+
+
+def edit_message_text(text, chat_id=None, message_id=None, inline_message_id=None,
+                      wait=False, label=None, **kwargs):
+    """
+    bot.edit_message_text عبر الموزّع — التعديلات المعلّقة لنفس الرسالة تُدمج،
+    والتعديل المطابق لآخر محتوى مطلوب لا يُرسل إطلاقاً (النتيجة None).
+    "message is not modified" لا تُعتبر خطأ.
+    """
+    if not wait:
+        label = label or "edit_message_text"
+    render = _render_hash(text, kwargs)
+    if inline_message_id:
+        chat = msg = ("inline", inline_message_id)
+        kwargs["inline_message_id"] = inline_message_id
+    else:
+        chat = _chat_key(chat_id)
+        msg = (chat, message_id)
+        kwargs["chat_id"] = chat_id
+        kwargs["message_id"] = message_id
+    op = _Op(_bot.edit_message_text, (text,), kwargs, chat, msg, label, render=render)
+    return _result(_enqueue(op), wait)
+
+
+def wait_all(futures, timeout=OUTBOUND_WAIT_TIMEOUT):
+    futures = [f for f in futures if f is not None]
+    if futures:
+        _wait_futures(futures, timeout=timeout)
+
+
+def stats():
+    with _cond:
+        return {"queued": len(_queue), "busy_chats": len(_busy_chats),
+                "render_cache": len(_render_cache), "chat_buckets": len(_chat_buckets),
+                **_stats}
+
+
+def shutdown(wait=True):
+    _executor.shutdown(wait=wait)
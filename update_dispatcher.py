@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+موزّع تحديثات مرتّب حسب المفتاح:
+  - N عامل (thread)، لكل عامل طابور خاص
+  - التحديثات ذات المفتاح نفسه (مباراة / مستخدم) تذهب دائماً للعامل نفسه
+    → تُعالج بالترتيب وبلا سباق read-modify-write على نفس المباراة
+  - المفاتيح المختلفة تُعالج بالتوازي
+  - id_fn اختياري: العنصر المكرر (نفس المعرّف ضمن آخر dedup_window) يُتجاهل
+"""
+import collections
+import queue
+import threading
+
+
+class OrderedDispatcher:
+    def __init__(self, handler, key_fn, workers=4, name="updates", id_fn=None, dedup_window=10000):
+        self.handler = handler
+        self.key_fn = key_fn
+        self.id_fn = id_fn
+        self.workers = max(1, int(workers))
+        self._queues = [queue.Queue() for _ in range(self.workers)]
+        self._seen = set()
+        self._seen_order = collections.deque(maxlen=max(1, int(dedup_window)))
+        self._processed = 0
+        self._errors = 0
+        self._duplicates = 0
+        self._lock = threading.Lock()
+        for i, q in enumerate(self._queues):
+            threading.Thread(
+                target=self._run, args=(q,), daemon=True, name=f"{name}-{i}",
+            ).start()
+
+    def _is_duplicate(self, item):
+        """يسجّل معرّف العنصر ويعيد True إن ورد من قبل (إعادة إرسال webhook مثلاً)."""
+        if self.id_fn is None:
+            return False
+        try:
+            item_id = self.id_fn(item)
+        except Exception:
+            return False
+        with self._lock:
+            if item_id in self._seen:
+                self._duplicates += 1
+                return True
+            if len(self._seen_order) == self._seen_order.maxlen:
+                self._seen.discard(self._seen_order[0])
+            self._seen_order.append(item_id)
+            self._seen.add(item_id)
+        return False
+
+    def submit(self, item):
+        """يضع العنصر في طابور عامل مفتاحه. يعيد False إن كان مكرراً فتُجوهل."""
+        if self._is_duplicate(item):
+            return False
+        try:
+            key = self.key_fn(item)
+        except Exception as e:
+            print(f"⚠️ dispatcher key: {e}")
+            key = None
+        self._queues[hash(key) % self.workers].put(item)
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                self.handler(item)
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"⚠️ dispatcher handler: {e}")
+            else:
+                with self._lock:
+                    self._processed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": sum(q.qsize() for q in self._queues),
+                "max_queue": max(q.qsize() for q in self._queues),
+                "processed": self._processed,
+                "errors": self._errors,
+                "duplicates": self._duplicates,
+            }
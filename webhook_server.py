@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+خادم webhook بديل عن long polling:
+  - ThreadingHTTPServer: كل طلب في thread خاص، والتحديث يُسلَّم لـ TeleBot
+    الذي يوزّعه على threads المعالجة (BOT_WORKERS)
+  - POST {WEBHOOK_PATH}: تحديث تيليجرام بصيغة JSON (يُتحقق من secret token إن وُجد)
+  - GET /healthz: فحص الحياة لـ Render
+
+تجربة محلية:
+    BOT_MODE=webhook WEBHOOK_SECRET=s3cret python bot.py
+    curl -X POST localhost:8080/webhook \
+         -H "X-Telegram-Bot-Api-Secret-Token: s3cret" \
+         -H "Content-Type: application/json" -d @update.json
+"""
+import hmac
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+MAX_BODY_BYTES = 1 << 20
+
+_stats = {"received": 0, "rejected": 0, "errors": 0, "started_at": time.time()}
+_stats_lock = threading.Lock()
+
+
+def _count(field):
+    with _stats_lock:
+        _stats[field] += 1
+
+
+def make_handler(bot, path, secret):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, code, body=b"", content_type="text/plain; charset=utf-8"):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] == "/healthz":
+                with _stats_lock:
+                    info = dict(_stats, uptime=int(time.time() - _stats["started_at"]))
+                self._reply(200, json.dumps(info).encode(), "application/json")
+            else:
+                self._reply(404)
+
+        def do_POST(self):
+            if self.path.split("?", 1)[0] != path:
+                self._reply(404)
+                return
+            if secret:
+                got = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+                if not hmac.compare_digest(got, secret):
+                    _count("rejected")
+                    self._reply(403)
+                    return
+            try:
+                length = int(self.headers.get("Content-Length", "0"))
+            except ValueError:
+                length = 0
+            if length <= 0 or length > MAX_BODY_BYTES:
+                _count("rejected")
+                self._reply(400)
+                return
+            try:
+                update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+            except Exception as e:
+                _count("errors")
+                print(f"⚠️ webhook: تحديث غير صالح: {e}")
+                self._reply(400)
+                return
+            # الرد فوراً؛ المعالجة الفعلية في threads الـ bot
+            self._reply(200)
+            _count("received")
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                _count("errors")
+                print(f"⚠️ webhook process: {e}")
+
+        def log_message(self, fmt, *args):
+            pass  # صامت — تيليجرام يرسل طلبات كثيرة
+
+    return WebhookHandler
+
+
+def serve(bot, port, path="/webhook", secret="", host="0.0.0.0"):
+    """يشغّل الخادم حتى الإيقاف (KeyboardInterrupt / SystemExit)."""
+    server = ThreadingHTTPServer((host, port), make_handler(bot, path, secret))
+    server.daemon_threads = True
+    print(f"🌐 خادم webhook يعمل على {host}:{port}{path} (فحص: /healthz)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
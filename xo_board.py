@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+نواة لوحة XO بتمثيل Bitboard:
+  - اللوحة = (x_bits, o_bits) عددان من 9 بتات (الخانة i = البت i)
+  - كشف الفوز عبر أقنعة الخطوط بدل مقارنة النصوص
+  - التحويل من/إلى نص Firestore ("X-O------") عند الحدود فقط
+
+تشغيل `python xo_board.py` يطبع قياساً مصغّراً (microbenchmark) مقارنةً بالتمثيل القديم.
+"""
+
+EMPTY = "-"
+PLAYER_X = "X"
+PLAYER_O = "O"
+
+WIN_LINES = [
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),
+    (0, 4, 8), (2, 4, 6),
+]
+WIN_MASKS = tuple((1 << a) | (1 << b) | (1 << c) for a, b, c in WIN_LINES)
+FULL_MASK = 0x1FF
+
+EMPTY_BOARD = (0, 0)
+EMPTY_BOARD_STR = EMPTY * 9
+
+
+# جدول 512 خانة: هل يحتوي قناع البتات على خط فوز؟ (يُبنى مرة عند الاستيراد)
+_HAS_LINE = bytes(
+    any(bits & m == m for m in WIN_MASKS) for bits in range(FULL_MASK + 1)
+)
+
+# ذاكرة التحويل نص ⇄ bitboard (3^9 وضعية كحد أقصى — تُملأ عند الحاجة)
+_FROM_STR = {}
+_TO_STR = {}
+
+
+# ====== التحويل ======
+
+def from_str(s):
+    """نص من 9 خانات (كما يُخزَّن في Firestore) → (x_bits, o_bits)."""
+    s = s or EMPTY_BOARD_STR
+    board = _FROM_STR.get(s)
+    if board is not None:
+        return board
+    x = o = 0
+    for i, v in enumerate(s):
+        if v == PLAYER_X:
+            x |= 1 << i
+        elif v == PLAYER_O:
+            o |= 1 << i
+    board = (x, o)
+    _FROM_STR[s] = board
+    return board
+
+
+def to_str(board):
+    """(x_bits, o_bits) → نص من 9 خانات للتخزين."""
+    s = _TO_STR.get(board)
+    if s is not None:
+        return s
+    x, o = board
+    s = "".join(
+        PLAYER_X if x >> i & 1 else PLAYER_O if o >> i & 1 else EMPTY
+        for i in range(9)
+    )
+    _TO_STR[board] = s
+    return s
+
+
+def key(board):
+    """مفتاح صحيح واحد من 18 بت (بتات X ثم بتات O << 9) — لجداول البحث."""
+    return board[0] | (board[1] << 9)
+
+
+# ====== القراءة ======
+
+def cell(board, i):
+    bit = 1 << i
+    if board[0] & bit:
+        return PLAYER_X
+    if board[1] & bit:
+        return PLAYER_O
+    return EMPTY
+
+
+def is_free(board, i):
+    return not (board[0] | board[1]) >> i & 1
+
+
+def free_cells(board):
+    occupied = board[0] | board[1]
+    return [i for i in range(9) if not occupied >> i & 1]
+
+
+def turn_of(board):
+    """الطرف الذي عليه الدور (X يبدأ دائماً)."""
+    return PLAYER_X if bin(board[0]).count("1") == bin(board[1]).count("1") else PLAYER_O
+
+
+def has_line(bits):
+    return bool(_HAS_LINE[bits])
+
+
+def winner(board):
+    """يعيد 'X' أو 'O' أو 'draw' أو None (المباراة مستمرة)."""
+    x, o = board
+    if _HAS_LINE[x]:
+        return PLAYER_X
+    if _HAS_LINE[o]:
+        return PLAYER_O
+    if (x | o) == FULL_MASK:
+        return "draw"
+    return None
+
+
+# ====== الكتابة ======
+
+def place(board, i, symbol):
+    """يعيد لوحة جديدة بعد وضع symbol في الخانة i (لا يتحقق من أنها فارغة)."""
+    bit = 1 << i
+    if symbol == PLAYER_X:
+        return board[0] | bit, board[1]
+    return board[0], board[1] | bit
+
+
+# ====== قياس مصغّر ======
+
+def _bench(rounds=200_000):
+    import timeit
+
+    # التمثيل القديم: قائمة نصوص + تحويل list/str في كل حركة PvP
+    def legacy_move(stored="XO-X-O---", pos=6, turn=PLAYER_X):
+        b = list(stored)
+        if b[pos] != EMPTY:
+            return None
+        b[pos] = turn
+        result = None
+        for a, c, d in WIN_LINES:
+            if b[a] != EMPTY and b[a] == b[c] == b[d]:
+                result = b[a]
+                break
+        if result is None and EMPTY not in b:
+            result = "draw"
+        return "".join(b), result
+
+    def bitboard_move(stored="XO-X-O---", pos=6, turn=PLAYER_X):
+        b = from_str(stored)
+        if not is_free(b, pos):
+            return None
+        b = place(b, pos, turn)
+        return to_str(b), winner(b)
+
+    # المسار الداخلي (ضد البوت): اللوحة تبقى bitboard بلا تحويل نصي
+    legacy_board = list("XO-X-O---")
+    bit_board = from_str("XO-X-O---")
+
+    def legacy_check():
+        b = legacy_board
+        for a, c, d in WIN_LINES:
+            if b[a] != EMPTY and b[a] == b[c] == b[d]:
+                return b[a]
+        return "draw" if EMPTY not in b else None
+
+    def bitboard_check():
+        return winner(place(bit_board, 6, PLAYER_X))
+
+    assert legacy_move() == bitboard_move()
+    for label, old, new in (
+        ("PvP move (str ⇄ board)", legacy_move, bitboard_move),
+        ("bot move (in-memory)  ", legacy_check, bitboard_check),
+    ):
+        t_old = timeit.timeit(old, number=rounds)
+        t_new = timeit.timeit(new, number=rounds)
+        print(
+            f"{label}: legacy {t_old / rounds * 1e6:.2f}µs  "
+            f"bitboard {t_new / rounds * 1e6:.2f}µs  "
+            f"(×{t_old / t_new:.2f})"
+        )
+
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+محرك XO للبوت الصعب:
+  - جدول لعب مثالي محسوب مسبقاً لكل الوضعيات الممكنة (~5478 وضعية)
+  - كل حركة للبوت الصعب = بحث O(1) في الجدول بدل Minimax حي
+  - بحث حي احتياطي: Alpha-Beta + جدول تحويلات (transposition table) محدود الحجم
+    يدمج الوضعيات المتماثلة (دوران/انعكاس) ويحسب hits/misses
+"""
+import random
+import threading
+
+from xo_board import FULL_MASK, PLAYER_X, has_line, key, turn_of
+
+
+# ====== بناء الجدول ======
+# {key: (نتيجة للطرف الذي عليه الدور, (أفضل الحركات...))}
+# النتيجة: 1 فوز، 0 تعادل، -1 خسارة (بدون تفضيل للعمق — مطابقة لـ Minimax القديم)
+_TABLE = {}
+
+
+def _solve(x, o):
+    """Negamax كامل مع حفظ النتائج — يُستدعى مرة واحدة عند الاستيراد."""
+    k = key((x, o))
+    hit = _TABLE.get(k)
+    if hit is not None:
+        return hit[0]
+    x_to_move = bin(x).count("1") == bin(o).count("1")
+    me, opp = (x, o) if x_to_move else (o, x)
+    free = FULL_MASK & ~(x | o)
+    best = -2
+    best_moves = []
+    for i in range(9):
+        bit = 1 << i
+        if not free & bit:
+            continue
+        mine = me | bit
+        if has_line(mine):
+            score = 1
+        elif (mine | opp) == FULL_MASK:
+            score = 0
+        else:
+            nx, no = (mine, opp) if x_to_move else (opp, mine)
+            score = -_solve(nx, no)
+        if score > best:
+            best = score
+            best_moves = [i]
+        elif score == best:
+            best_moves.append(i)
+    _TABLE[k] = (best, tuple(best_moves))
+    return best
+
+
+_solve(0, 0)
+
+
+def table_size():
+    """عدد الوضعيات غير المنتهية المخزّنة في الجدول."""
+    return len(_TABLE)
+
+
+def best_move(board):
+    """
+    أفضل حركة للطرف الذي عليه الدور في bitboard (عشوائياً بين الحركات المتساوية).
+    يعيد None إن لم تكن الوضعية في الجدول (لوحة منتهية أو غير قابلة للوصول).
+    """
+    entry = _TABLE.get(key(board))
+    if entry is None:
+        return None
+    return random.choice(entry[1])
+
+
+# ====== بحث حي: Alpha-Beta + جدول تحويلات ======
+
+TT_MAX_ENTRIES = 20_000
+
+# التماثلات الثمانية للوحة 3×3 كتبديلات للخانات: p[i] = موضع الخانة i بعد التحويل
+_ROT = (6, 3, 0, 7, 4, 1, 8, 5, 2)    # دوران 90°
+_FLIP = (2, 1, 0, 5, 4, 3, 8, 7, 6)   # انعكاس أفقي
+
+
+def _compose(p, q):
+    """تطبيق p ثم q."""
+    return tuple(q[p[i]] for i in range(9))
+
+
+def _symmetries():
+    perms = []
+    p = tuple(range(9))
+    for _ in range(4):
+        perms.append(p)
+        perms.append(_compose(p, _FLIP))
+        p = _compose(p, _ROT)
+    return perms
+
+
+# لكل تماثل: جدول 512 خانة يحوّل قناع 9 بتات مباشرة
+_SYM_MASKS = tuple(
+    tuple(
+        sum(1 << p[i] for i in range(9) if bits >> i & 1)
+        for bits in range(FULL_MASK + 1)
+    )
+    for p in _symmetries()
+)
+
+# ترتيب الحركات: المركز ثم الزوايا ثم الأطراف — يزيد القطع في Alpha-Beta
+_MOVE_ORDER = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+
+_EXACT, _LOWER, _UPPER = 0, 1, 2
+
+# {مفتاح قانوني: (flag, score)} — dict مرتّب بالإدراج، الأقدم يُطرد أولاً
+_tt = {}
+_tt_stats = {"hits": 0, "misses": 0, "evictions": 0}
+_search_lock = threading.Lock()
+
+
+def _canonical(me, opp):
+    """أصغر مفتاح بين التماثلات الثمانية — الوضعيات المتماثلة تتشارك خانة واحدة."""
+    return min(t[me] | (t[opp] << 9) for t in _SYM_MASKS)
+
+
+def _tt_store(k, flag, score):
+    if k not in _tt and len(_tt) >= TT_MAX_ENTRIES:
+        _tt.pop(next(iter(_tt)))
+        _tt_stats["evictions"] += 1
+    _tt[k] = (flag, score)
+
+
+def _negamax(me, opp, alpha, beta):
+    """النتيجة من منظور `me` (الطرف الذي عليه الدور): 1 / 0 / -1."""
+    alpha_orig = alpha
+    k = _canonical(me, opp)
+    entry = _tt.get(k)
+    if entry is not None:
+        _tt_stats["hits"] += 1
+        flag, score = entry
+        if flag == _EXACT:
+            return score
+        if flag == _LOWER:
+            alpha = max(alpha, score)
+        else:
+            beta = min(beta, score)
+        if alpha >= beta:
+            return score
+    else:
+        _tt_stats["misses"] += 1
+
+    occupied = me | opp
+    best = -2
+    for i in _MOVE_ORDER:
+        bit = 1 << i
+        if occupied & bit:
+            continue
+        mine = me | bit
+        if has_line(mine):
+            score = 1
+        elif (mine | opp) == FULL_MASK:
+            score = 0
+        else:
+            score = -_negamax(opp, mine, -beta, -alpha)
+        if score > best:
+            best = score
+        if best > alpha:
+            alpha = best
+        if alpha >= beta:
+            break
+
+    if best <= alpha_orig:
+        flag = _UPPER
+    elif best >= beta:
+        flag = _LOWER
+    else:
+        flag = _EXACT
+    _tt_store(k, flag, best)
+    return best
+
+
+def search_best_move(board, ai_symbol):
+    """
+    بحث Alpha-Beta حي لـ ai_symbol على bitboard — عشوائي بين الحركات المتساوية.
+    يعيد None إن لم توجد خانات فارغة أو كانت اللوحة منتهية.
+    """
+    x, o = board
+    me, opp = (x, o) if ai_symbol == PLAYER_X else (o, x)
+    if has_line(me) or has_line(opp):
+        return None
+    moves = [i for i in range(9) if not (me | opp) >> i & 1]
+    if not moves:
+        return None
+    random.shuffle(moves)
+
+    best = -2
+    best_moves = []
+    with _search_lock:
+        for i in moves:
+            mine = me | (1 << i)
+            if has_line(mine):
+                score = 1
+            elif (mine | opp) == FULL_MASK:
+                score = 0
+            else:
+                # نافذة تبدأ تحت أفضل نتيجة بدرجة: تكفي لكشف التعادل مع الأفضل
+                score = -_negamax(opp, mine, -2, -(best - 1))
+            if score > best:
+                best = score
+                best_moves = [i]
+            elif score == best:
+                best_moves.append(i)
+    return best_moves[0] if best_moves else None
+
+
+def best_move_hard(board, ai_symbol, human_symbol):
+    """
+    حركة البوت الصعب: بحث O(1) في جدول اللعب المثالي إن كان الدور لـ ai_symbol،
+    وإلا بحث Alpha-Beta حي مع جدول التحويلات.
+    """
+    if turn_of(board) == ai_symbol:
+        m = best_move(board)
+        if m is not None:
+            return m
+    return search_best_move(board, ai_symbol)
+
+
+def engine_stats():
+    """إحصائيات المحرك: حجم الجدول المثالي وحالة جدول التحويلات."""
+    hits = _tt_stats["hits"]
+    misses = _tt_stats["misses"]
+    lookups = hits + misses
+    return {
+        "table_size": len(_TABLE),
+        "tt_size": len(_tt),
+        "tt_max": TT_MAX_ENTRIES,
+        "tt_hits": hits,
+        "tt_misses": misses,
+        "tt_evictions": _tt_stats["evictions"],
+        "tt_hit_rate": (hits / lookups) if lookups else 0.0,
+    }